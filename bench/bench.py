@@ -0,0 +1,493 @@
+"""Benchmark module.
+
+Measures the host-side cost of the library against an in-process fake
+uiautomator Device, Adb and adb server client, so performance work can be
+compared between commits on any Linux box without a phone. The real
+persistent shell session is used, talking to a fake `adb shell` that runs the
+local sh with a canned dumpsys on its PATH. Every fake device round trip can
+be given a latency to model a real DUT; the default of 0 isolates the
+framework overhead. The import_* benchmarks start a fresh interpreter per
+call to time module imports, with import_python as the bare interpreter
+startup.
+
+Usage, from the repository root:
+    python -m bench.bench [--latency S] [--seconds S] [--json PATH]
+                          [--compare PATH] [NAME ...]
+
+The JSON output holds calls per second and CPU microseconds per call for
+every benchmark, and --compare prints the ratio to an earlier output.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy
+
+from lib.base import cfg
+from lib.base import common
+from lib.base import util
+from lib.base import yml
+
+TELEPHONY = ('  mCallState=0\n'
+             '  mServiceState=0 0 voice home LTE LTE CSS not supported\n'
+             '  mDataConnectionState=2\n')
+FOCUS = ('  mCurrentFocus=Window{1 u0 %s/.Main}\n'
+         '  mFocusedApp=AppWindowToken{2 token=Token{3 '
+         'ActivityRecord{4 u0 %s/.Main t5}}}\n')
+POLICY = ('  mScreenOnFully=true\n'
+          '  mShowingLockscreen=false\n')
+INPUT_METHOD = '  mInputShown=false\n'
+DISPLAY = POLICY + INPUT_METHOD
+NODE = ('<node index="0" text="%s" resource-id="%s" class="%s" '
+        'package="com.tct.launcher" content-desc="%s" checkable="false" '
+        'checked="false" clickable="true" enabled="true" focusable="true" '
+        'focused="false" scrollable="false" long-clickable="false" '
+        'password="false" selected="false" bounds="[0,0][1080,1920]" />')
+
+
+class FakeLatency(object):
+    """Sleep shared by every fake device round trip."""
+
+    seconds = 0
+
+    @classmethod
+    def wait(cls):
+        """Simulate one device round trip."""
+        if cls.seconds:
+            time.sleep(cls.seconds)
+
+
+class FakeShell(object):
+    """Canned dumpsys output for the adb server client fallback."""
+
+    serial = 'FAKE0001'
+
+    def __init__(self, pkg='com.tct.launcher'):
+        self.pkg = pkg
+
+    def run(self, cmd, timeout=None):
+        """Answer a shell command."""
+        # pylint: disable=I0011,W0613
+        FakeLatency.wait()
+        if 'telephony.registry' in cmd:
+            return TELEPHONY
+        if 'dumpsys window windows' in cmd:
+            return FOCUS % (self.pkg, self.pkg)
+        if 'window policy' in cmd:
+            return DISPLAY
+        return ''
+
+
+class FakePopen(object):
+    """Finished process with canned output."""
+
+    def __init__(self, out):
+        self.out = out
+        self.returncode = 0
+
+    def communicate(self):
+        """Return the canned output."""
+        FakeLatency.wait()
+        return (self.out, '')
+
+
+class FakeAdb(object):
+    """Stands in for uiautomator.Adb.
+
+    Attributes:
+        path (str): Fake adb executable, see fake_adb().
+    """
+
+    adbHostPortOptions = []
+
+    def __init__(self, path='adb'):
+        self.path = path
+
+    def device_serial(self):
+        """Serial number of the fake device."""
+        return FakeShell.serial
+
+    def adb(self):
+        """Path to the fake adb executable."""
+        return self.path
+
+    def cmd(self, *args):
+        """Answer an adb command without spawning a process."""
+        # pylint: disable=I0011,W0613
+        return FakePopen('')
+
+
+class FakeAdbClient(object):
+    """Stands in for adbclient.AdbClient, serving a fixed frame."""
+
+    def __init__(self, png):
+        self.png = png
+
+    def exec_out(self, serial, cmd):
+        """Return the PNG frame for screencap."""
+        # pylint: disable=I0011,W0613
+        FakeLatency.wait()
+        return self.png
+
+    def shell(self, serial, cmd):
+        """Answer a shell command."""
+        # pylint: disable=I0011,W0613
+        return FakeShell().run(cmd)
+
+
+class _Chain(object):
+    """Callable that also accepts any attribute, e.g. click.wait()."""
+
+    def __init__(self, result=True):
+        self.result = result
+
+    def __call__(self, *args, **kwargs):
+        FakeLatency.wait()
+        return self.result
+
+    def __getattr__(self, name):
+        return _Chain(self.result)
+
+
+class FakeObject(object):
+    """Stands in for a uiautomator selector object."""
+
+    def __init__(self, device, selector):
+        self.device = device
+        self.selector = selector
+
+    @property
+    def exists(self):
+        """Check the selector against the fake screen."""
+        FakeLatency.wait()
+        return all(item in self.device.screen
+                   for item in self.selector.items())
+
+    def __len__(self):
+        return 1 if self.exists else 0
+
+    @property
+    def wait(self):
+        """wait.exists() and wait.gone() against the fake screen."""
+        found = self.exists
+        return _Wait(found)
+
+    def __getattr__(self, name):
+        return _Chain()
+
+
+class _Wait(object):
+    """Answers of a selector wait."""
+
+    def __init__(self, found):
+        self.found = found
+
+    def exists(self, timeout=0):
+        """The element exists."""
+        # pylint: disable=I0011,W0613
+        return self.found
+
+    def gone(self, timeout=0):
+        """The element is gone."""
+        # pylint: disable=I0011,W0613
+        return not self.found
+
+
+class FakeDevice(object):
+    """Stands in for uiautomator.Device showing the homescreen.
+
+    Attributes:
+        screen (set): (selector key, value) pairs shown on the screen.
+    """
+
+    def __init__(self):
+        self.screen = set([
+            ('description', 'ALL APPS'),
+            ('resourceId', 'com.android.systemui:id/recents_view'),
+            ('text', 'Your recent screens appear here'),
+        ])
+        self.press = _Chain()
+        self.wait = _Chain()
+        self.info = {'currentPackageName': 'com.tct.launcher',
+                     'displayWidth': 1080, 'displayHeight': 1920}
+
+    def __call__(self, **selector):
+        return FakeObject(self, selector)
+
+    def dump(self, filename=None, compressed=True, pretty=True):
+        """Return a hierarchy dump of the fake screen."""
+        # pylint: disable=I0011,W0613
+        FakeLatency.wait()
+        nodes = []
+        for key, value in sorted(self.screen):
+            attrs = {'text': '', 'resourceId': '', 'description': ''}
+            attrs[key] = value
+            nodes.append(NODE % (attrs['text'], attrs['resourceId'],
+                                 'android.widget.TextView',
+                                 attrs['description']))
+        return ('<?xml version="1.0" encoding="UTF-8"?><hierarchy '
+                'rotation="0">%s</hierarchy>' % ''.join(nodes))
+
+    def screenshot(self, filename):
+        """Screenshot fallback, never used by the fakes."""
+        raise IOError('FakeDevice has no screenshot: %s' % filename)
+
+    def __getattr__(self, name):
+        return _Chain()
+
+
+FAKE_ADB = """#!/bin/sh
+# adb [-s SERIAL] shell: the local sh with the fake dumpsys on its PATH.
+while [ $# -gt 0 ] && [ "$1" != shell ]; do
+    shift
+done
+[ "$1" = shell ] || exit 1
+PATH=%(bin)s:$PATH exec sh
+"""
+
+FAKE_DUMPSYS = """#!/bin/sh
+%(sleep)s
+case "$*" in
+    telephony.registry) exec cat %(bin)s/telephony.txt ;;
+    'window windows') exec cat %(bin)s/focus.txt ;;
+    'window policy') exec cat %(bin)s/policy.txt ;;
+    input_method) exec cat %(bin)s/input_method.txt ;;
+esac
+"""
+
+
+def fake_adb(workdir, pkg='com.tct.launcher'):
+    """Write the fake adb executable and the dumpsys it serves.
+
+    Args:
+        workdir (str): Folder for the executables and canned outputs.
+        pkg (str, optional): Foreground package reported by dumpsys.
+
+    Returns:
+        path (str): Path to the fake adb.
+    """
+    bindir = os.path.join(workdir, 'bin')
+    os.makedirs(bindir)
+    sleep = 'sleep %g' % FakeLatency.seconds if FakeLatency.seconds else ''
+    files = {
+        'adb': FAKE_ADB % {'bin': bindir},
+        'dumpsys': FAKE_DUMPSYS % {'bin': bindir, 'sleep': sleep},
+        'telephony.txt': TELEPHONY,
+        'focus.txt': FOCUS % (pkg, pkg),
+        'policy.txt': POLICY,
+        'input_method.txt': INPUT_METHOD,
+    }
+    for name, text in files.items():
+        with open(os.path.join(bindir, name), 'w') as stream:
+            stream.write(text)
+    for name in ('adb', 'dumpsys'):
+        os.chmod(os.path.join(bindir, name), 0o755)
+    return os.path.join(bindir, 'adb')
+
+
+def fake_common(workdir):
+    """Build a Common object wired to the fakes.
+
+    Args:
+        workdir (str): Folder for the frame, template and config.
+    """
+    rng = numpy.random.RandomState(0)
+    noise = (rng.rand(1920, 1080, 3) * 255).astype(numpy.uint8)
+    frame = cv2.GaussianBlur(noise, (15, 15), 0)
+    cv2.imwrite(os.path.join(workdir, 'icon.png'), frame[600:696, 400:496])
+    png = cv2.imencode('.png', frame)[1].tostring()
+    com = common.Common(FakeDevice(), FakeAdb(fake_adb(workdir)), 'Bench',
+                        'MDEVICE')
+    logging.getLogger('Bench').setLevel(logging.WARNING)
+    com.adbc = FakeAdbClient(png)
+    return com
+
+
+def _setup(workdir):
+    """Create the config the benchmarks read."""
+    cfgdir = os.path.join(workdir, 'cfg')
+    os.makedirs(cfgdir)
+    with open(os.path.join(cfgdir, 'common.ini'), 'w') as stream:
+        stream.write('[Default]\ntest_type = mini\nnetwork_type = 3glte\n'
+                     '[NetworkSwitch]\nallow = true\n')
+    os.environ['CFG_PATH'] = cfgdir
+    os.environ['LOG_PATH'] = workdir
+    for name in ('att-3glte-full.yaml', 'mtbf.yaml'):
+        shutil.copy(os.path.join(_repo_cfg(), name), workdir)
+
+
+def _repo_cfg():
+    """Path to the cfg folder of the repository."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(here, os.pardir, 'cfg')
+
+
+def _import(module):
+    """Import a module in a fresh interpreter."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    root = os.path.join(here, os.pardir)
+    subprocess.check_call([sys.executable, '-c', 'import %s' % module],
+                          cwd=root)
+
+
+def benchmarks(com, workdir):
+    """Map benchmark names to zero-argument callables."""
+    icon = os.path.join(workdir, 'icon.png')
+    full = os.path.join(workdir, 'att-3glte-full.yaml')
+    mtbf = os.path.join(workdir, 'mtbf.yaml')
+
+    def _yml_parse():
+        """Parse without the compiled cache."""
+        with open(full) as stream:
+            return yml.yaml.load(stream, Loader=yml._LOADER)
+
+    return {
+        'shell_session': lambda: com.session.run('true'),
+        'network_check': lambda: com.network_check('LTE', stream=False),
+        'call_state': com.call_state,
+        'is_pkg': lambda: com.is_pkg('com.tct.launcher', 1),
+        'backto_homescreen': com.backto_homescreen,
+        'recent_apps_clear': com.recent_apps_clear,
+        'screen_turn_on': com.screen_turn_on,
+        'screenshot_img_comp': lambda: util.img_comp(com.screenshot(), icon),
+        'screencap_img_comp': lambda: com.is_img_shown(icon),
+        'cfg_cget': lambda: cfg.cget('NetworkSwitch', 'allow', 'bool'),
+        'yml_load_full': lambda: yml.YML(full),
+        'yml_load_mtbf': lambda: yml.YML(mtbf),
+        'yml_parse_full': _yml_parse,
+        'import_python': lambda: _import('sys'),
+        'import_util': lambda: _import('lib.base.util'),
+        'import_common': lambda: _import('lib.base.common'),
+    }
+
+
+def _cpu():
+    """User plus system CPU seconds of the process and its children."""
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def measure(func, seconds):
+    """Call func repeatedly for about the given wall time.
+
+    Returns:
+        stats (dict): calls, calls_per_sec and cpu_us_per_call.
+    """
+    func()
+    calls = 0
+    cpu0 = _cpu()
+    start = time.time()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            break
+    cpu = _cpu() - cpu0
+    return {
+        'calls': calls,
+        'calls_per_sec': calls / elapsed,
+        'cpu_us_per_call': cpu / calls * 1e6,
+    }
+
+
+def _revision():
+    """Current git revision, or None outside a checkout."""
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        with open(os.devnull, 'w') as devnull:
+            out = subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                stderr=devnull)
+        return out.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names=None, latency=0, seconds=1):
+    """Run the benchmarks.
+
+    Args:
+        names (list, optional): Benchmarks to run, all by default.
+        latency (float, optional): Seconds per fake device round trip.
+        seconds (float, optional): Wall time per benchmark.
+
+    Returns:
+        report (dict): Environment and the stats of every benchmark.
+    """
+    FakeLatency.seconds = latency
+    workdir = tempfile.mkdtemp(prefix='mtbf-bench-')
+    try:
+        _setup(workdir)
+        com = fake_common(workdir)
+        benches = benchmarks(com, workdir)
+        results = {}
+        try:
+            for name in sorted(names or benches):
+                results[name] = measure(benches[name], seconds)
+        finally:
+            com.session.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'latency': latency,
+        'results': results,
+    }
+
+
+def report(rep, base=None):
+    """Format a run, with the speedup against base if given."""
+    lines = ['revision %s, python %s, latency %gs' % (
+        rep['revision'], rep['python'], rep['latency'])]
+    lines.append('%-22s %12s %14s %9s' % ('BENCHMARK', 'CALLS/SEC',
+                                         'CPU(us)/CALL', 'SPEEDUP'))
+    for name in sorted(rep['results']):
+        stats = rep['results'][name]
+        speedup = ''
+        if base is not None and name in base['results']:
+            old = base['results'][name]['calls_per_sec']
+            speedup = '%8.2fx' % (stats['calls_per_sec'] / old)
+        lines.append('%-22s %12.1f %14.1f %9s' % (
+            name, stats['calls_per_sec'], stats['cpu_us_per_call'], speedup))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', help='benchmarks to run')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds per fake device round trip')
+    parser.add_argument('--seconds', type=float, default=1,
+                        help='wall time per benchmark')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='earlier --json output')
+    args = parser.parse_args(argv)
+    rep = run(args.names, args.latency, args.seconds)
+    base = None
+    if args.compare:
+        with open(args.compare) as stream:
+            base = json.load(stream)
+    print report(rep, base)
+    if args.json:
+        with open(args.json, 'w') as stream:
+            json.dump(rep, stream, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
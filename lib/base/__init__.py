@@ -0,0 +1 @@
+"""Base library shared by the test case modules and scripts."""
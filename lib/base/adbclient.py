@@ -0,0 +1,383 @@
+"""ADB Host Protocol Module
+
+Speaks the adb server's smart socket protocol directly, so device queries
+do not spawn an `adb` process. Each request is a 4 hex digit length followed
+by the request, and the server answers OKAY or FAIL plus a length-prefixed
+message. Device services are reached by switching the socket to a device
+with host:transport first.
+
+DeviceTracker keeps a host:track-devices connection open, so device
+connection checks and disconnect notifications need no polling.
+
+The asynchronous calls run on a shared thread pool and return
+multiprocessing.pool.AsyncResult handles, so many queries across devices can
+be in flight at once.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import socket
+import threading
+
+HOST = 'localhost'
+PORT = 5037
+
+
+def _recv_exact(sock, size):
+    """Read exactly size bytes from the socket."""
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise IOError('adb server closed the connection.')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv_all(sock):
+    """Read from the socket until the peer closes it."""
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+
+def _recv_msg(sock):
+    """Read one length-prefixed message."""
+    return _recv_exact(sock, int(_recv_exact(sock, 4), 16))
+
+
+class AdbClient(object):
+    """Client of the adb server's smart socket.
+
+    Attributes:
+        host (str): Host of the adb server.
+        port (int): Port of the adb server.
+        timeout (float): Socket timeout in seconds.
+    """
+
+    def __init__(self, host=None, port=None, timeout=60, workers=16):
+        """Summary
+
+        Args:
+            host (str, optional): Host of the adb server.
+            port (int, optional): Port of the adb server.
+            timeout (float, optional): Socket timeout in seconds.
+            workers (int, optional): Threads for the asynchronous calls.
+        """
+        self.host = host or HOST
+        self.port = int(port or os.environ.get('ANDROID_ADB_SERVER_PORT',
+                                               PORT))
+        self.timeout = timeout
+        self._workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Open a socket to the adb server."""
+        return socket.create_connection((self.host, self.port),
+                                        self.timeout)
+
+    @staticmethod
+    def request(sock, req):
+        """Send a request and check the server accepted it.
+
+        Raises:
+            IOError: The server answered FAIL.
+        """
+        sock.sendall('%04x%s' % (len(req), req))
+        status = _recv_exact(sock, 4)
+        if status == 'OKAY':
+            return
+        if status == 'FAIL':
+            raise IOError('%s: %s' % (req, _recv_msg(sock)))
+        raise IOError('%s: unexpected status %r' % (req, status))
+
+    def query(self, req):
+        """Run a host service and return its length-prefixed answer."""
+        sock = self.connect()
+        try:
+            self.request(sock, req)
+            return _recv_msg(sock)
+        finally:
+            sock.close()
+
+    def version(self):
+        """Get the protocol version of the adb server."""
+        return int(self.query('host:version'), 16)
+
+    def devices(self):
+        """List the attached devices.
+
+        Returns:
+            devices (list): (serial, state) pairs, e.g. ('0123', 'device').
+        """
+        return parse_devices(self.query('host:devices'))
+
+    def kill(self):
+        """Stop the adb server."""
+        sock = self.connect()
+        try:
+            self.request(sock, 'host:kill')
+        finally:
+            sock.close()
+
+    def transport(self, serial, service):
+        """Open a device service, e.g. 'shell:ls' on a device.
+
+        Args:
+            serial (str): Serial number, None for the only device.
+            service (str): Device service request.
+
+        Returns:
+            sock (socket.socket): Socket streaming the service.
+        """
+        sock = self.connect()
+        try:
+            if serial:
+                self.request(sock, 'host:transport:%s' % serial)
+            else:
+                self.request(sock, 'host:transport-any')
+            self.request(sock, service)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def exec_out(self, serial, cmd):
+        """Run a command and return its raw, untranslated stdout.
+
+        Args:
+            serial (str): Serial number of the device.
+            cmd (str): Shell command line.
+        """
+        sock = self.transport(serial, 'exec:%s' % cmd)
+        try:
+            return _recv_all(sock)
+        finally:
+            sock.close()
+
+    def shell(self, serial, cmd):
+        """Run a command on the device shell and return its output.
+
+        Args:
+            serial (str): Serial number of the device.
+            cmd (str): Shell command line.
+        """
+        sock = self.transport(serial, 'shell:%s' % cmd)
+        try:
+            return _recv_all(sock).replace('\r\n', '\n')
+        finally:
+            sock.close()
+
+    def _submit(self, func, *args):
+        """Run a call on the thread pool."""
+        with self._lock:
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self._workers)
+        return self._pool.apply_async(func, args)
+
+    def shell_async(self, serial, cmd):
+        """Start shell() without blocking.
+
+        Returns:
+            res (AsyncResult): res.get(timeout) returns the output.
+        """
+        return self._submit(self.shell, serial, cmd)
+
+    def exec_out_async(self, serial, cmd):
+        """Start exec_out() without blocking.
+
+        Returns:
+            res (AsyncResult): res.get(timeout) returns the output.
+        """
+        return self._submit(self.exec_out, serial, cmd)
+
+
+def _notify(callback, serial, state):
+    """Call a tracker callback, its errors do not stop the tracker."""
+    if callback is None:
+        return
+    try:
+        callback(serial, state)
+    except Exception:  # pylint: disable=I0011,W0703
+        pass
+
+
+class DeviceTracker(object):
+    """Background host:track-devices reader keeping a device state table.
+
+    The adb server pushes the whole device list every time a device
+    changes state, so connection checks are lookups in memory. Callbacks
+    are called on the tracker thread with (serial, state) when a device
+    becomes ready ('device') and when a ready device goes away or changes to
+    another state, e.g. 'offline'. Losing the adb server counts as every
+    device going away, and the tracker reconnects to it.
+
+    Attributes:
+        client (AdbClient): Client of the adb server.
+        ready (threading.Event): Set while the table is in sync.
+        retry (float): Seconds between reconnects to the adb server.
+    """
+
+    def __init__(self, client, retry=1.0):
+        """Summary
+
+        Args:
+            client (AdbClient): Client of the adb server.
+            retry (float, optional): Seconds between reconnects.
+        """
+        self.client = client
+        self.retry = retry
+        self.ready = threading.Event()
+        self._states = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._sock = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start tracking if it is not running yet."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='adb-track-devices')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                sock = self.client.connect()
+                self._sock = sock
+                try:
+                    self.client.request(sock, 'host:track-devices')
+                    sock.settimeout(None)
+                    while True:
+                        self._update(parse_devices(_recv_msg(sock)))
+                finally:
+                    self._sock = None
+                    sock.close()
+            except (IOError, socket.error):
+                pass
+            self._update(None)
+            self._stopped.wait(self.retry)
+
+    def _update(self, devices):
+        """Swap in a new device list and call the callbacks of changes."""
+        states = dict(devices or ())
+        with self._lock:
+            old, self._states = self._states, states
+            callbacks = list(self._callbacks)
+        if devices is None:
+            self.ready.clear()
+        else:
+            self.ready.set()
+        for serial in set(old) | set(states):
+            was = old.get(serial)
+            now = states.get(serial)
+            if was == now:
+                continue
+            for on_connect, on_disconnect in callbacks:
+                if now == 'device':
+                    _notify(on_connect, serial, now)
+                elif was == 'device':
+                    _notify(on_disconnect, serial, now)
+
+    def subscribe(self, on_connect=None, on_disconnect=None):
+        """Add callbacks taking (serial, state), once per pair."""
+        with self._lock:
+            if (on_connect, on_disconnect) not in self._callbacks:
+                self._callbacks.append((on_connect, on_disconnect))
+
+    def unsubscribe(self, on_connect=None, on_disconnect=None):
+        """Remove callbacks added by subscribe()."""
+        with self._lock:
+            if (on_connect, on_disconnect) in self._callbacks:
+                self._callbacks.remove((on_connect, on_disconnect))
+
+    def state(self, serial):
+        """Get the state of a device, e.g. 'device', None if not attached."""
+        with self._lock:
+            return self._states.get(serial)
+
+    def is_connected(self, serial):
+        """Check if a device is attached and ready."""
+        return self.state(serial) == 'device'
+
+    def devices(self):
+        """Get the (serial, state) pairs of the attached devices."""
+        with self._lock:
+            return self._states.items()
+
+    def stop(self):
+        """Stop tracking."""
+        self._stopped.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+def parse_devices(payload):
+    """Parse a host:devices payload into (serial, state) pairs."""
+    devices = []
+    for line in payload.splitlines():
+        parts = line.split('\t')
+        if len(parts) >= 2:
+            devices.append((parts[0], parts[1]))
+    return devices
+
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def client(host=None, port=None):
+    """Get the shared client of an adb server.
+
+    Args:
+        host (str, optional): Host of the adb server.
+        port (int, optional): Port of the adb server.
+    """
+    key = (host, port)
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = AdbClient(host, port)
+        return _CLIENTS[key]
+
+
+_TRACKERS = {}
+
+
+def tracker(host=None, port=None):
+    """Get the shared, started device tracker of an adb server.
+
+    Args:
+        host (str, optional): Host of the adb server.
+        port (int, optional): Port of the adb server.
+    """
+    key = (host, port)
+    with _CLIENTS_LOCK:
+        if key not in _TRACKERS:
+            _TRACKERS[key] = DeviceTracker(AdbClient(host, port))
+        devtracker = _TRACKERS[key]
+    devtracker.start()
+    return devtracker
+
+
+def adb_client(adb):
+    """Get the shared client of the adb server a uiautomator Adb uses."""
+    host = getattr(adb, 'adb_server_host', None)
+    port = getattr(adb, 'adb_server_port', None)
+    return client(host, port and int(port))
@@ -1,68 +1,169 @@
-"""Configuration Module"""
+"""Configuration Module
+
+Each ini file is parsed once into plain dictionaries and shared by every
+caller in the process. A file is parsed again only when its mtime changes,
+which is checked at most once per CHECK_INTERVAL seconds.
+
+The files are looked up in the cfg folder next to the main script, or in
+the folder named by the CFG_PATH environment variable.
+"""
 
 import os
 import sys
+import threading
+import time
 
+from ConfigParser import NoOptionError
+from ConfigParser import NoSectionError
 from ConfigParser import SafeConfigParser
 
+CHECK_INTERVAL = 1.0
 
-def cget(section, key, vtype=None):
-    """Retrieve values from common.ini."""
-    ccfg = SafeConfigParser()
-    ccfgpath = os.path.join(sys.path[0], 'cfg', 'common.ini')
-    if not os.path.isfile(ccfgpath):
-        raise IOError('%s NOT FOUND.' % ccfgpath)
-    ccfg.read(ccfgpath)
+_FILES = {}
+_LOCK = threading.Lock()
+
+
+class _Parsed(object):
+    """Parsed content of one ini file.
+
+    Attributes:
+        checked (float): Last time the mtime was compared.
+        items (dict): Section to the list of (key, value) pairs.
+        mtime (float): mtime of the file when it was parsed.
+        parser (SafeConfigParser): Parser holding the file content.
+        path (str): Path to the ini file.
+        typed (dict): Converted values, keyed by (section, key, vtype).
+        values (dict): Section to a dict of key to raw value.
+    """
+
+    def __init__(self, path, mtime):
+        """Summary
+
+        Args:
+            path (str): Path to the ini file.
+            mtime (float): mtime of the file.
+        """
+        self.path = path
+        self.parser = SafeConfigParser()
+        self.parser.read(path)
+        self.mtime = mtime
+        self.checked = time.time()
+        self.items = {}
+        for section in self.parser.sections():
+            self.items[section] = self.parser.items(section)
+        self.values = dict((s, dict(i)) for s, i in self.items.iteritems())
+        self.typed = {}
+
+    def get(self, section, key, vtype=None):
+        """Look up a value and convert it to vtype once."""
+        tkey = (section, key, vtype)
+        try:
+            return self.typed[tkey]
+        except KeyError:
+            pass
+        if section not in self.values:
+            raise NoSectionError(section)
+        try:
+            value = self.values[section][self.parser.optionxform(key)]
+        except KeyError:
+            raise NoOptionError(key, section)
+        self.typed[tkey] = _convert(value, vtype)
+        return self.typed[tkey]
+
+    def section(self, section):
+        """Get the (key, value) pairs of a section."""
+        if section not in self.items:
+            raise NoSectionError(section)
+        return self.items[section]
+
+
+def _convert(value, vtype):
+    """Convert a raw ini value like SafeConfigParser.get<vtype> does."""
     if vtype is None:
-        return ccfg.get(section, key)
+        return value
     elif vtype == 'bool':
-        return ccfg.getboolean(section, key)
+        states = SafeConfigParser._boolean_states
+        if value.lower() not in states:
+            raise ValueError('Not a boolean: %s' % value)
+        return states[value.lower()]
     elif vtype == 'float':
-        return ccfg.getfloat(section, key)
+        return float(value)
     elif vtype == 'int':
-        return ccfg.getint(section, key)
+        return int(value)
 
 
-def sread():
-    """Read the stability config file."""
+def _load(cfgfile):
+    """Get the parsed content of a file in the cfg directory."""
+    cfgdir = os.environ.get('CFG_PATH')
+    if cfgdir is None:
+        cfgdir = os.path.join(sys.path[0], 'cfg')
+    cfgpath = os.path.join(cfgdir, cfgfile)
+    parsed = _FILES.get(cfgpath)
+    now = time.time()
+    if parsed is not None and now - parsed.checked < CHECK_INTERVAL:
+        return parsed
+    with _LOCK:
+        if not os.path.isfile(cfgpath):
+            _FILES.pop(cfgpath, None)
+            raise IOError('%s NOT FOUND.' % cfgpath)
+        mtime = os.path.getmtime(cfgpath)
+        parsed = _FILES.get(cfgpath)
+        if parsed is None or parsed.mtime != mtime:
+            parsed = _Parsed(cfgpath, mtime)
+            _FILES[cfgpath] = parsed
+        parsed.checked = now
+        return parsed
+
+
+def clear():
+    """Drop every parsed file so the next lookup reads from disk."""
+    with _LOCK:
+        _FILES.clear()
+
+
+def cget(section, key, vtype=None):
+    """Retrieve values from common.ini."""
+    return _load('common.ini').get(section, key, vtype)
+
+
+def _scfgfile():
+    """Get the name of the stability config file."""
     ttype = cget('Default', 'test_type')
     ntype = cget('Default', 'network_type')
+    return '%s_%s.ini' % (ttype, ntype)
+
+
+def sread():
+    """Read the stability config file into a new parser.
+
+    The parser is the caller's own, unlike the shared content behind stui()
+    and stci(), so it may be modified.
+    """
     scfg = SafeConfigParser()
-    scfgfile = '%s_%s.ini' % (ttype, ntype)
-    scfgpath = os.path.join(sys.path[0], 'cfg', scfgfile)
-    if not os.path.isfile(scfgpath):
-        raise IOError('%s NOT FOUND.' % scfgpath)
-    scfg.read(scfgpath)
+    scfg.read(_load(_scfgfile()).path)
     return scfg
 
 
 def stui(section, key):
     """Get the total iterations for a test unit."""
-    scfg = sread()
-    return scfg.getint(section, key)
+    return _load(_scfgfile()).get(section, key, 'int')
 
 
 def stci(section):
     """Get the total iterations for a test case."""
-    scfg = sread()
-    return sum([int(x[1]) for x in scfg.items(section)])
+    parsed = _load(_scfgfile())
+    tkey = (section, None, 'total')
+    if tkey not in parsed.typed:
+        total = sum([int(x[1]) for x in parsed.section(section)])
+        parsed.typed[tkey] = total
+    return parsed.typed[tkey]
 
 
 def aget(section, key):
     """Return package name for app name."""
-    acfg = SafeConfigParser()
-    acfgpath = os.path.join(sys.path[0], 'cfg', 'apps.ini')
-    if not os.path.isfile(acfgpath):
-        raise IOError('%s NOT FOUND.' % acfgpath)
-    acfg.read(acfgpath)
-    return acfg.get(section, key)
+    return _load('apps.ini').get(section, key)
 
 
 def agetall(section):
     """Get dictionary key-value pairs of app names and/or package names."""
-    acfg = SafeConfigParser()
-    acfgpath = os.path.join(sys.path[0], 'cfg', 'apps.ini')
-    if not os.path.isfile(acfgpath):
-        raise IOError('%s NOT FOUND.' % acfgpath)
-    acfg.read(acfgpath)
-    return acfg.items(section)
+    return list(_load('apps.ini').section(section))
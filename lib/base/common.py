@@ -5,13 +5,32 @@ from __future__ import absolute_import
 from __future__ import division
 
 import os
-import re
+import socket
 import time
 
 from datetime import datetime
 
+from . import adbclient
 from . import cfg
+from . import dumper
+from . import hierarchy
+from . import perf
+from . import recover
+from . import shell
+from . import state
+from . import store
+from . import template
 from . import util
+from . import watcher
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+
+def _data_disconnected(tel):
+    """Telephony wait check for a disconnected data connection."""
+    if tel.data != 'Disconnected':
+        return 'Data is still %s.' % tel.data
+    return None
 
 
 class Common(object):
@@ -19,14 +38,25 @@ class Common(object):
 
     Attributes:
         adb (uiautomator.Adb): UIAutomator Adb.
+        adbc (adbclient.AdbClient): Client of the adb server's socket.
         dev (uiautomator.Device): UIAutomator Device.
         devname (str): MDEVICE or SDEVICE.
+        display (state.DisplayQuery): Screen, lock and keyboard state.
+        foreground (state.ForegroundTracker): Cached foreground package.
         log (logging): Python logging.
         pkgset (str): Package name for Settings.
+        recovery (recover.Recovery): Escalating recovery of the DUT.
+        session (shell.ShellSession): Persistent adb shell of the DUT.
         setact (str): Activity name for Settings.
         tcname (str): Name of the test case.
+        telephony (state.TelephonyRegistry): Cached telephony state.
+        telephony_ttl (float): Seconds a telephony snapshot stays fresh.
+        watcher (watcher.WatcherEngine): Host-side dialog watchers, None
+            when the device watchers are used.
     """
 
+    telephony_ttl = 0.5
+
     def __init__(self, dev, adb, tcname, devname):
         """Summary
 
@@ -41,80 +71,86 @@ class Common(object):
         self.devname = devname
         self.dev = dev
         self.adb = adb
+        self.adbc = adbclient.adb_client(adb)
+        self.session = shell.session(adb)
+        self.telephony = state.TelephonyRegistry(self.shell,
+                                                 self.telephony_ttl)
+        self.foreground = state.ForegroundTracker(self.shell)
+        self.display = state.DisplayQuery(self.shell)
+        self.watcher = None
+        if watcher.host():
+            self.watcher = watcher.WatcherEngine()
+        self.recovery = recover.Recovery(self)
         self.pkgset = 'com.android.settings'
         self.setact = '.TestingSettings'
+        perf.attach(self)
+
+    def shell(self, cmd):
+        """Run a command on the DUT's shell and return its output.
+
+        The persistent shell session is used when it is available, then the
+        adb server socket, and spawning `adb shell` as the last resort. A
+        command that timed out is not run again by the fallbacks.
+
+        Args:
+            cmd (str): Shell command line.
 
-    def _screendump_tcdir(self):
-        """Create a directory in the screendump folder titled as the TC name.
+        Raises:
+            IOError: The command timed out, shell.ShellTimeout or
+                socket.timeout.
         """
-        sdpath = util.screendump_path()
-        sdtcdir = os.path.join(sdpath, self.tcname.lower())
-        if not os.path.exists(sdtcdir):
-            os.makedirs(sdtcdir)
-        return sdtcdir
+        try:
+            return self.session.run(cmd)
+        except shell.ShellTimeout:
+            raise
+        except (IOError, OSError) as err:
+            self.log.warning('Shell session failed: %s', err)
+        try:
+            return self.adbc.shell(self.session.serial, cmd)
+        except socket.timeout:
+            raise
+        except IOError as err:
+            self.log.warning('adb server socket failed: %s', err)
+        return shell.adb_shell(self.adb, cmd)
+
+    def shell_async(self, cmd):
+        """Start a shell command on the DUT without blocking.
+
+        Each call gets its own adb server connection, so many commands can
+        run at once, also across devices.
+
+        Args:
+            cmd (str): Shell command line.
+
+        Returns:
+            res (AsyncResult): res.get(timeout) returns the output.
+        """
+        return self.adbc.shell_async(self.session.serial, cmd)
 
     def _is_keyboard_shown(self):
         """Check if the keyboard is currently displayed on the screen.
         """
-        cmd = 'shell dumpsys input_method'
-        res = self.adb.cmd(*cmd.split()).communicate()[0]
-        if 'mInputShown=true' in res:
-            return True
-        return False
+        return self.display.snapshot().keyboard
 
     def _is_locked(self):
         """Check if the DUT's screen is currently locked.
         """
-        regex = re.compile('mShowingLockscreen=(true|false)')
-        cmd = 'shell dumpsys window policy'
-        res = self.adb.cmd(*cmd.split()).communicate()[0]
-        sres = regex.search(res)
-        if sres is not None:
-            if sres.group(1) == 'true':
-                return True
-        return False
+        return self.display.snapshot().locked
 
     def _is_screen_on(self):
         """Check if the DUT's screen is current ON or OFF.
         """
-        regex = re.compile('mScreenOnFully=(true|false)')
-        cmd = 'shell dumpsys window policy'
-        res = self.adb.cmd(*cmd.split()).communicate()[0]
-        sres = regex.search(res)
-        if sres is not None:
-            if sres.group(1) == 'true':
-                return True
-        return False
+        return self.display.snapshot().screen_on
 
     def _service_state(self):
         """Get the network service state of the DUT.
         """
-        cmd = 'shell dumpsys telephony.registry'
-        res = self.adb.cmd(*cmd.split()).communicate()[0]
-        if 'mServiceState=0' in res:
-            return 'InService'
-        if 'mServiceState=1' in res:
-            return 'OutOfService'
-        if 'mServiceState=2' in res:
-            return 'EmergencyOnly'
-        if 'mServiceState=3' in res:
-            return 'NetworkOff'
-        return None
+        return self.telephony.snapshot().service
 
     def _data_state(self):
         """Get the state of the DUT's data connection.
         """
-        cmd = 'shell dumpsys telephony.registry'
-        res = self.adb.cmd(*cmd.split()).communicate()[0]
-        if 'mDataConnectionState=0' in res:
-            return 'Disconnected'
-        if 'mDataConnectionState=1' in res:
-            return 'Connecting'
-        if 'mDataConnectionState=2' in res:
-            return 'Connected'
-        if 'mDataConnectionState=3' in res:
-            return 'Suspended'
-        return None
+        return self.telephony.snapshot().data
 
     def _is_network_valid(self, network):
         """Check if the specified network is valid.
@@ -188,26 +224,7 @@ class Common(object):
         Args:
             network (str): 2G, 3G, LTE, 3GLTE, or 2G3GLTE.
         """
-        ssline = None
-        cmd = 'shell dumpsys telephony.registry'
-        res = self.adb.cmd(*cmd.split()).communicate()[0].splitlines()
-        for line in res:
-            if 'mServiceState' in line:
-                ssline = line.lower().strip()
-                break
-        is_2g = any(x in ssline for x in ['edge', 'gsm', 'gprs', '1xrtt'])
-        states3g = ['umts', 'hspap', 'evdo', 'hsupa', 'hsdpa', 'hspa']
-        is_3g = any(x in ssline for x in states3g)
-        is_lte = 'lte' in ssline
-        nets = {
-            '2G': is_2g,
-            '3G': is_3g,
-            'LTE': is_lte,
-            '2G3G': is_2g or is_3g,
-            '3GLTE': is_3g or is_lte,
-            '2G3GLTE': is_2g or is_3g or is_lte,
-        }
-        return nets[network]
+        return self.telephony.snapshot().network(network)
 
     def network_switch(self, network):
         """Switch the DUT's network.
@@ -239,56 +256,90 @@ class Common(object):
         self.backto_homescreen()
         return True
 
-    def network_check(self, network):
+    def network_check(self, network, timeout=60, stream=True):
         """Check the service, network, and the data connection of the DUT.
 
+        The service, the network and the data connection are waited for in
+        turn, each with its own deadline.
+
         Args:
             network (str): 2G, 3G, LTE, 3GLTE, or 2G3GLTE.
+            timeout (float, optional): Deadline of each stage in seconds.
+            stream (bool, optional): Follow radio state changes instead of
+                polling every second.
         """
         if not cfg.cget('NetworkSwitch', 'allow', 'bool'):
             return True
         if not self._is_network_valid(network):
             self.backto_homescreen()
             return False
-        for _ in xrange(60):
-            if self._service_state() == 'InService':
-                break
-            time.sleep(1)
-        else:
-            self.log.warning('Failed detect any service')
-            return False
-        for _ in xrange(60):
-            if self._network_state(network):
-                break
-            time.sleep(1)
-        else:
-            self.log.warning('Failed get %s service.', network)
-            return False
-        for _ in xrange(60):
-            if self._data_state() == 'Connected':
-                break
-            time.sleep(1)
-        else:
-            self.log.warning('Failed connect to network.')
-            return False
+
+        def _service(tel):
+            if tel.service != 'InService':
+                return 'Failed detect any service'
+            return None
+
+        def _network(tel):
+            if not tel.network(network):
+                return 'Failed get %s service.' % network
+            return None
+
+        def _data(tel):
+            if tel.data != 'Connected':
+                return 'Failed connect to network.'
+            return None
+
+        for check in (_service, _network, _data):
+            miss = self._telephony_wait(check, timeout, stream)
+            if miss is not None:
+                self.log.warning(miss)
+                return False
         return True
 
+    def _telephony_wait(self, check, timeout, stream=True):
+        """Wait until the telephony state satisfies check.
+
+        With stream set, the radio logcat buffer is followed and the state is
+        re-read when the radio logs a change, at most once per telephony
+        TTL, and at least every 5 seconds. Without it, or once the logcat
+        stream is gone, the state is polled every second. Both stop at a
+        single overall deadline.
+
+        Args:
+            check (callable): Takes a TelephonyState and returns None when
+                satisfied, otherwise a reason.
+            timeout (float): Overall deadline in seconds.
+            stream (bool, optional): Wake up on radio logcat events.
+
+        Returns:
+            miss (str): None if satisfied, otherwise the last reason.
+        """
+        events = None
+        if stream:
+            events = shell.logcat(self.adb, 'radio', state.RADIO_EVENTS)
+        deadline = time.time() + timeout
+        while True:
+            if events is not None:
+                events.clear()
+            miss = check(self.telephony.snapshot(maxage=0))
+            nextread = time.time() + max(.2, self.telephony.ttl)
+            remaining = deadline - time.time()
+            if miss is None or remaining <= 0:
+                return miss
+            if events is not None and not events.is_alive():
+                events = None
+            if events is None:
+                time.sleep(min(1, remaining))
+            elif events.wait(min(5, remaining)):
+                time.sleep(max(min(nextread, deadline) - time.time(), 0))
+
     def call_state(self):
         """Get the call state of the DUT.
 
         Returns:
             ret (str): Idle, Ringing, or InCall
         """
-        cmd = 'shell dumpsys telephony.registry'
-        res = self.adb.cmd(*cmd.split()).communicate()[0]
-        ret = None
-        if 'mCallState=0' in res:
-            ret = 'Idle'
-        if 'mCallState=1' in res:
-            ret = 'Ringing'
-        if 'mCallState=2' in res:
-            ret = 'InCall'
-        return ret
+        return self.telephony.snapshot().call
 
     def start_activity(self, pkg, act):
         """Start an app.
@@ -297,52 +348,49 @@ class Common(object):
             pkg (str): Package name of the app.
             act (str): Activity name.
         """
-        cmd = 'shell am start -n %s/%s' % (pkg, act)
-        self.adb.cmd(*cmd.split()).communicate()
+        self.shell('am start -n %s/%s' % (pkg, act))
+        self.foreground.invalidate()
         if self.is_pkg(pkg, 7):
             return True
         return False
 
     def get_current_pkg(self):
         """Get the current package."""
-        command = 'shell dumpsys window windows'
-        result = self.adb.cmd(*command.split()).communicate()[0].splitlines()
-        lines1 = []
-        for line in result:
-            if 'mCurrentFocus' in line or 'mFocusedApp' in line:
-                lines1.append(line.strip())
-        target_line = ''
-        for line in lines1:
-            if 'ActivityRecord' in line:
-                temp = line.split('ActivityRecord')
-                if len(temp) > 1:
-                    target_line = temp[1]
-                    break
-        pkg_name = ''
-        for line in target_line.split():
-            if '/' in line:
-                pkg_name = line.split('/')[0]
-        return pkg_name
+        return self.foreground.current()
 
     def is_pkg(self, pkg, timeout, keyword=None):
         """Check if the current pkg shown on the DUT is the exptected pkg.
 
+        The foreground package is polled with a sub-second, backing off
+        interval, and the check returns as soon as it matches. The device
+        info RPC is only asked when the dumpsys gives no package, and the
+        keyword is looked up in one hierarchy snapshot at most once a second.
+
         Args:
             pkg (str): The expected package name.
-            timeout (int): Time out if the app was not running.
+            timeout (int): Time out if the app was not running, 0 checks once.
+            keyword (str, optional): Text or description that also counts
+                as the app being shown.
         """
-        for _ in xrange(timeout):
-            if self.get_current_pkg() == pkg:
+        kwnext = [0]
+
+        def _check(curpkg):
+            """Accept the package, or the keyword on the screen."""
+            if curpkg == pkg:
                 return True
-            if self.dev.info['currentPackageName'] == pkg:
+            if not curpkg and self.dev.info['currentPackageName'] == pkg:
                 return True
-            if keyword is not None:
-                if self.dev(textMatches='(?i).*%s.*' % keyword):
+            if keyword is not None and time.time() >= kwnext[0]:
+                kwnext[0] = time.time() + 1
+                regex = '(?i).*%s.*' % keyword
+                snap = self.snapshot()
+                if snap.exists(textMatches=regex):
                     return True
-                if self.dev(descriptionMatches='(?i).*%s.*' % keyword):
+                if snap.exists(descriptionMatches=regex):
                     return True
-            time.sleep(1)
-        return False
+            return False
+
+        return self.foreground.wait(_check, timeout)
 
     def file_num(self, path, ext):
         """Get the quantity of files on the path with the specified extension.
@@ -351,8 +399,7 @@ class Common(object):
             path (str): Path to the files on the DUT.
             ext (str): File extension of the target files.
         """
-        cmd = 'shell ls %s' % path
-        res = self.adb.cmd(*cmd.split()).communicate()[0]
+        res = self.shell('ls %s' % path)
         return len([x for x in res.splitlines() if ext in x])
 
     def file_names(self, path, ext):
@@ -362,8 +409,7 @@ class Common(object):
             path (str): Path to the files on the DUT.
             ext (str): File extension of the target files.
         """
-        cmd = 'shell ls {0}'.format(path)
-        out = self.adb.cmd(*cmd.split()).communicate()[0]
+        out = self.shell('ls {0}'.format(path))
         return [x.strip() for x in out.splitlines() if ext in x]
 
     def data_reset(self):
@@ -371,14 +417,11 @@ class Common(object):
 
         This is similar to turning the airplane mode on and off.
         """
-        dcmd = 'shell svc data disable'
-        self.adb.cmd(*dcmd.split()).communicate()
-        for _ in xrange(7):
-            if self._data_state() == 'Disconnected':
-                break
-            time.sleep(1)
-        ecmd = 'shell svc data enable'
-        self.adb.cmd(*ecmd.split()).communicate()
+        self.shell('svc data disable')
+        self.telephony.invalidate()
+        self._telephony_wait(_data_disconnected, 7)
+        self.shell('svc data enable')
+        self.telephony.invalidate()
         if self.network_check('2G3GLTE'):
             return True
         return False
@@ -395,42 +438,123 @@ class Common(object):
             adb shell settings put global airplane_mode_on 0
 
         """
-        dcmd = 'shell settings put global airplane_mode_on 0'
-        self.adb.cmd(*dcmd.split()).communicate()
-        for _ in xrange(7):
-            if self._data_state() == 'Disconnected':
-                break
-            time.sleep(1)
-        ecmd = 'shell settings put global airplane_mode_on 1'
-        self.adb.cmd(*ecmd.split()).communicate()
+        self.shell('settings put global airplane_mode_on 0')
+        self.telephony.invalidate()
+        self._telephony_wait(_data_disconnected, 7)
+        self.shell('settings put global airplane_mode_on 1')
+        self.telephony.invalidate()
         if self.network_check('2G3GLTE'):
             return True
         return False
 
     def screendump(self):
         """Take a screenshot and the UI hierarchy dump of the DUT.
+
+        Both are fetched before returning, so recovery cannot change the
+        screen first; compressing and writing them to the artifact store is
+        left to the background screendump writer.
+
+        Returns:
+            job (dumper.Screendump): Job of the background writer.
         """
         curtime = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
-        sdtcdir = self._screendump_tcdir()
-        ssfile = '%s_%s.png' % (self.devname, curtime)
-        sspath = os.path.join(sdtcdir, ssfile)
-        self.dev.screenshot(sspath)
-        dpfile = '%s_%s.xml' % (self.devname, curtime)
-        dppath = os.path.join(sdtcdir, dpfile)
-        self.dev.dump(filename=dppath, compressed=False, pretty=True)
-        self.log.info('[Screen] %s', sspath)
-        self.log.info('[Dump] %s', dppath)
+        name = '%s_%s' % (self.devname, curtime)
+        try:
+            png = self._screencap_png()
+        except (IOError, OSError) as err:
+            self.log.warning('Failed to capture the screen: %s', err)
+            png = None
+        try:
+            xml = self.dev.dump(compressed=False)
+        except Exception as err:  # pylint: disable=I0011,W0703
+            self.log.warning('Failed to dump the UI hierarchy: %s', err)
+            xml = None
+        return dumper.submit(png, xml, name, self.log, store.store(),
+                             self.tcname, self.devname)
+
+    def _screencap_png(self):
+        """Stream a PNG screenshot of the DUT into memory.
+
+        Returns:
+            png (str): PNG data, or None if the capture failed.
+        """
+        try:
+            png = self.adbc.exec_out(self.session.serial, 'screencap -p')
+        except IOError:
+            png = self.adb.cmd('exec-out', 'screencap', '-p').communicate()[0]
+        if png.startswith(PNG_SIGNATURE):
+            return png
+        png = self.adb.cmd('shell', 'screencap', '-p').communicate()[0]
+        if not png.startswith(PNG_SIGNATURE):
+            png = png.replace('\r\n', '\n')
+        if png.startswith(PNG_SIGNATURE):
+            return png
+        self.log.warning('Failed to capture the screen.')
+        return None
+
+    def screencap(self, path=None):
+        """Capture the DUT's screen as an image array without a file.
+
+        Args:
+            path (str, optional): Also save the PNG to this path.
+
+        Returns:
+            img (numpy.ndarray): BGR image, or None if the capture failed.
+        """
+        png = self._screencap_png()
+        if png is None:
+            return None
+        if path is not None:
+            with open(path, 'wb') as stream:
+                stream.write(png)
+        return util.img_decode(png)
+
+    def is_img_shown(self, sip):
+        """Check if the small image sip is shown on the DUT's screen.
+
+        Args:
+            sip (str): Path to the small image.
+        """
+        img = self.screencap()
+        if img is None:
+            return False
+        return util.img_comp(img, sip)
+
+    def imgs_shown(self, names, roi=None):
+        """Check which resource templates are shown, using one capture.
+
+        Args:
+            names (list): Template names, relative paths under res_path()
+                without the extension.
+            roi (tuple, optional): (left, top, width, height) to search in.
+
+        Returns:
+            shown (dict): Template name to True if it is on the screen.
+        """
+        img = self.screencap()
+        if img is None:
+            return dict((name, False) for name in names)
+        matches = template.library().match(img, names, roi)
+        return dict((name, match is not None and match.found)
+                    for name, match in matches.iteritems())
 
     def screenshot(self):
-        """Take a screenshot of the DUT.
+        """Take a screenshot of the DUT into the tempdump folder.
+
+        The file belongs to the caller, who may edit or delete it. Unlike
+        screendumps it is not kept in the shared artifact store.
 
         Returns:
             sspath (str): Path to the screenshot.
         """
         curtime = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
-        tpddir = util.tempdump_path()
         ssfile = '%s_%s_%s.png' % (self.tcname, self.devname, curtime)
-        sspath = os.path.join(tpddir, ssfile)
+        sspath = os.path.join(util.tempdump_path(), ssfile)
+        png = self._screencap_png()
+        if png is not None:
+            with open(sspath, 'wb') as stream:
+                stream.write(png)
+            return sspath
         self.dev.screenshot(sspath)
         for _ in xrange(7):
             if os.path.exists(sspath):
@@ -456,12 +580,73 @@ class Common(object):
             if self.is_homescreen():
                 return True
             self.dev.press.back()
-            if self.is_pkg('com.android.browser', 1):
+            self.foreground.invalidate()
+            if self.is_pkg('com.android.browser', 0):
                 self.pkg_force_stop('com.android.browser')
         self.log.warning('Failed to go back to homescreen.')
 
         return False
 
+    def recover(self):
+        """Bring the DUT back to the homescreen, see recover.py.
+
+        Returns:
+            tier (str): Recovery tier that worked, None if none did.
+        """
+        return self.recovery.recover()
+
+    def snapshot(self):
+        """Dump the UI hierarchy once for many local selector queries.
+
+        With host-side watchers, dialogs found in the dump are dismissed and
+        the hierarchy is dumped again.
+
+        Returns:
+            snap (hierarchy.Hierarchy): Indexed UI hierarchy.
+        """
+        snap = hierarchy.Hierarchy(self.dev.dump(compressed=False))
+        if self.watcher is None:
+            return snap
+        for _ in xrange(3):
+            names = self.watcher.handle(self.dev, snap)
+            if not names:
+                break
+            self.log.info('Dismissed dialogs: %s', ', '.join(names))
+            snap = hierarchy.Hierarchy(self.dev.dump(compressed=False))
+        return snap
+
+    def dismiss_dialogs(self):
+        """Dismiss the dialogs on the screen with the host-side watchers.
+
+        Returns:
+            names (list): Names of the watchers that clicked.
+        """
+        if self.watcher is None:
+            return []
+        snap = hierarchy.Hierarchy(self.dev.dump(compressed=False))
+        return self.watcher.handle(self.dev, snap)
+
+    def snapshot_wait(self, check, timeout=3000, interval=500):
+        """Re-dump the UI hierarchy until check accepts it.
+
+        Args:
+            check (callable): Takes a Hierarchy, returns True when done.
+            timeout (int, optional): Time out in milliseconds.
+            interval (int, optional): Delay between dumps in milliseconds.
+
+        Returns:
+            snap (hierarchy.Hierarchy): The accepted snapshot, or None.
+        """
+        deadline = time.time() + timeout / 1000
+        while True:
+            snap = self.snapshot()
+            if check(snap):
+                return snap
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(interval / 1000, remaining))
+
     def recent_apps_show(self):
         """Show the recent apps view."""
         recentsid = util.genid('com.android.systemui', 'recents_view')
@@ -478,31 +663,29 @@ class Common(object):
 
     def screen_turn_on(self):
         """Turn the DUT's screen on if off, and then unlock if locked."""
-        if not self._is_screen_on():
+        disp = self.display.snapshot()
+        if not disp.screen_on:
             self.log.info('Turn on the screen.')
             self.dev.wakeup()
-        for _ in xrange(7):
-            if self._is_screen_on():
-                break
-            time.sleep(1)
-        else:
-            self.log.warning('Failed to turn on the screen.')
-            return False
-        if self._is_locked():
+            for _ in xrange(7):
+                disp = self.display.snapshot()
+                if disp.screen_on:
+                    break
+                time.sleep(1)
+            else:
+                self.log.warning('Failed to turn on the screen.')
+                return False
+        if disp.locked:
             lockid = util.genid('com.android.systemui', 'lock_icon')
-            lockob = self.dev(resourceId=lockid)
-            if lockob.exists:
-                dispw = self.dev.info['displayWidth']
-                disph = self.dev.info['displayHeight']
+            snap = self.snapshot()
+            lockno = snap.first(resourceId=lockid)
+            if lockno is not None:
+                dispw, disph = snap.size
+                lockx, locky = lockno.center
+                self.dev.drag(lockx, locky, dispw / 2, disph / 2, steps=5)
                 lockob = self.dev(resourceId=lockid)
-                if lockob.exists:
-                    lockob.drag.to(x=dispw / 2, y=disph / 2, steps=5)
-                    lockob = self.dev(resourceId=lockid)
-                    if lockob.wait.gone(timeout=2000):
-                        return True
-                else:
-                    self.log.warning('Failed to unlock the display')
-                    return False
+                if lockob.wait.gone(timeout=2000):
+                    return True
         return True
 
     def keyboard_close(self):
@@ -514,8 +697,7 @@ class Common(object):
             self.dev.press.back()
             self.dev.wait.update()
             time.sleep(1)
-        cmd = 'shell input keyevent 111'
-        self.adb.cmd(*cmd.split()).communicate()
+        self.shell('input keyevent 111')
         if not self._is_keyboard_shown():
             return True
         self.log.warning('Failed to close the keyboard.')
@@ -524,16 +706,19 @@ class Common(object):
     def recent_apps_clear(self):
         """Clear all the recent apps on the DUT."""
         self.recent_apps_show()
-        if self.dev(text='Your recent screens appear here').exists:
+        emptytxt = 'Your recent screens appear here'
+        snap = self.snapshot_wait(
+            lambda x: (x.exists(text=emptytxt) or
+                       x.exists(description='Clear all')),
+            timeout=3000)
+        if snap is not None and snap.exists(text=emptytxt):
             self.backto_homescreen()
             return True
-        if self.dev(description='Clear all').wait.exists(timeout=3000):
+        if snap is not None:
             self.log.info('Clear recent apps.')
-            self.dev.wait.update()
-            if self.dev(description='Clear all').exists:
-                self.dev(description='Clear all').click.wait()
-                if self.dev(description='Clear all').wait.gone(timeout=24000):
-                    return True
+            self.dev(description='Clear all').click.wait()
+            if self.dev(description='Clear all').wait.gone(timeout=24000):
+                return True
         self.log.warning('Failed to clear recent apps.')
         return False
 
@@ -543,11 +728,9 @@ class Common(object):
         Args:
             pkg (str): Package name of the app.
         """
-        cmd = 'shell am force-stop %s' % pkg
-        self.adb.cmd(*cmd.split()).communicate()
-        if not self.is_pkg(pkg, 2):
-            return True
-        return False
+        self.shell('am force-stop %s' % pkg)
+        self.foreground.invalidate()
+        return self.foreground.wait(lambda curpkg: curpkg != pkg, 2)
 
     def press_enter(self):
         """Press the enter key from the keyboard.
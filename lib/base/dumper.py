@@ -0,0 +1,199 @@
+"""Screendump Writer Module
+
+Screendumps are taken on failures, right before recovery. The test thread
+fetches the screenshot and the UI hierarchy itself, so the screen is grabbed
+before recovery changes it, then hands the data off: compressing and writing
+it is left to a small pool of background threads.
+
+With an artifact store, see store.py, the files are stored by content
+instead, so identical screens are kept once.
+
+The queue is bounded: when a failure storm fills it, further screendumps
+are dropped with a warning instead of piling up in memory or on disk.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import atexit
+import gzip
+import logging
+import Queue
+import threading
+
+QUEUE_SIZE = 8
+WORKERS = 2
+
+
+class Screendump(object):
+    """One screendump job.
+
+    Attributes:
+        done (threading.Event): Set once the files have been written.
+        error (Exception): What went wrong, None on success.
+        paths (list): Files written.
+    """
+
+    def __init__(self, png, xml, basepath, log, store=None, tcname='-',
+                 devname='-'):
+        """Summary
+
+        Args:
+            png (str): PNG data of the screenshot, or None.
+            xml (str): UI hierarchy XML, or None.
+            basepath (str): Path the extensions are appended to, or the
+                name the artifacts are indexed as in the store.
+            log (logging.LoggerAdapter): Logger of the test case.
+            store (store.Store, optional): Artifact store to write to.
+            tcname (str, optional): Name of the test case, for the store.
+            devname (str, optional): MDEVICE or SDEVICE, for the store.
+        """
+        self.png = png
+        self.xml = xml
+        self.basepath = basepath
+        self.log = log
+        self.store = store
+        self.tcname = tcname
+        self.devname = devname
+        self.done = threading.Event()
+        self.error = None
+        self.paths = []
+
+    def __call__(self):
+        try:
+            xml = self.xml
+            if isinstance(xml, unicode):
+                xml = xml.encode('utf-8')
+            if self.png is not None:
+                self.paths.append(self.write_png(self.png))
+                self.log.info('[Screen] %s', self.paths[-1])
+            if xml is not None:
+                self.paths.append(self.write_xml(xml))
+                self.log.info('[Dump] %s', self.paths[-1])
+        except Exception as err:  # pylint: disable=I0011,W0703
+            self.error = err
+            self.log.warning('Failed to write the screendump: %s', err)
+        finally:
+            self.done.set()
+
+    def write_png(self, png):
+        """Write the screenshot, PNG is already compressed."""
+        if self.store is not None:
+            return self.store.put(png, '.png', 'screendump',
+                                  self.basepath + '.png', self.tcname,
+                                  self.devname)
+        path = self.basepath + '.png'
+        with open(path, 'wb') as stream:
+            stream.write(png)
+        return path
+
+    def write_xml(self, xml):
+        """Write the UI hierarchy gzipped."""
+        if self.store is not None:
+            return self.store.put(xml, '.xml.gz', 'screendump',
+                                  self.basepath + '.xml', self.tcname,
+                                  self.devname)
+        path = self.basepath + '.xml.gz'
+        with gzip.open(path, 'wb') as stream:
+            stream.write(xml)
+        return path
+
+
+class ScreendumpWriter(object):
+    """Pool of threads running screendump jobs from a bounded queue.
+
+    Attributes:
+        dropped (int): Jobs dropped because the queue was full.
+        queue (Queue.Queue): Jobs waiting for a thread.
+    """
+
+    def __init__(self, workers=WORKERS, maxsize=QUEUE_SIZE):
+        """Summary
+
+        Args:
+            workers (int, optional): Number of threads.
+            maxsize (int, optional): Jobs waiting before new ones are dropped.
+        """
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self._threads = []
+        for index in xrange(workers):
+            thread = threading.Thread(target=self._run,
+                                      name='screendump-%d' % index)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    break
+                job()
+            finally:
+                self.queue.task_done()
+
+    def submit(self, job):
+        """Queue a job without blocking.
+
+        Returns:
+            queued (bool): False if the queue was full and the job dropped.
+        """
+        try:
+            self.queue.put_nowait(job)
+        except Queue.Full:
+            self.dropped += 1
+            job.log.warning('Screendump queue full, dropped %s.',
+                            job.basepath)
+            job.done.set()
+            return False
+        return True
+
+    def join(self):
+        """Wait until every queued job has been written."""
+        self.queue.join()
+
+    def stop(self):
+        """Write the queued jobs and stop the threads."""
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+_WRITER = []
+_WRITER_LOCK = threading.Lock()
+
+
+def writer():
+    """Get the shared screendump writer, starting it on first use."""
+    with _WRITER_LOCK:
+        if not _WRITER:
+            _WRITER.append(ScreendumpWriter())
+            atexit.register(_WRITER[0].stop)
+        return _WRITER[0]
+
+
+def submit(png, xml, basepath, log=None, store=None, tcname='-',
+           devname='-'):
+    """Hand a captured screendump to the shared writer.
+
+    Args:
+        png (str): PNG data of the screenshot, or None.
+        xml (str): UI hierarchy XML, or None.
+        basepath (str): Path the extensions are appended to, or the name
+            the artifacts are indexed as in the store.
+        log (logging.LoggerAdapter, optional): Logger of the test case.
+        store (store.Store, optional): Artifact store to write to.
+        tcname (str, optional): Name of the test case, for the store.
+        devname (str, optional): MDEVICE or SDEVICE, for the store.
+
+    Returns:
+        job (Screendump): job.done can be waited on.
+    """
+    job = Screendump(png, xml, basepath,
+                     log or logging.getLogger('SCREENDUMP'), store, tcname,
+                     devname)
+    writer().submit(job)
+    return job
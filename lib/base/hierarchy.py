@@ -0,0 +1,195 @@
+"""UI Hierarchy Module
+
+A UI hierarchy dump is parsed once into nodes indexed by text, resourceId,
+description and className. UIAutomator style selectors are then answered
+locally, so checking several elements of one screen costs a single dump RPC
+instead of one RPC per selector.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import re
+import time
+
+from xml.etree import cElementTree
+
+BOUNDS = re.compile(r'\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]')
+FLAGS = re.compile(r'^\(\?[iLmsux]+\)')
+
+ATTRS = {
+    'text': 'text',
+    'resourceId': 'resource-id',
+    'description': 'content-desc',
+    'className': 'class',
+    'packageName': 'package',
+}
+
+BOOLS = {
+    'checkable': 'checkable',
+    'checked': 'checked',
+    'clickable': 'clickable',
+    'enabled': 'enabled',
+    'focusable': 'focusable',
+    'focused': 'focused',
+    'longClickable': 'long-clickable',
+    'scrollable': 'scrollable',
+    'selected': 'selected',
+}
+
+_REGEXES = {}
+
+
+def _regex(pattern):
+    """Compile a Java String.matches() pattern as a full match regex."""
+    regex = _REGEXES.get(pattern)
+    if regex is None:
+        flags = FLAGS.match(pattern)
+        head = flags.group(0) if flags else ''
+        regex = re.compile('%s(?:%s)\\Z' % (head, pattern[len(head):]))
+        _REGEXES[pattern] = regex
+    return regex
+
+
+class Node(object):
+    """One element of the UI hierarchy.
+
+    Attributes:
+        attrib (dict): Raw attributes of the dump node.
+        bounds (tuple): (left, top, right, bottom) on the screen.
+        order (int): Position of the node in document order.
+    """
+
+    __slots__ = ('attrib', 'bounds', 'order')
+
+    def __init__(self, attrib, order):
+        self.attrib = attrib
+        self.order = order
+        found = BOUNDS.match(attrib.get('bounds', ''))
+        if found is None:
+            self.bounds = (0, 0, 0, 0)
+        else:
+            self.bounds = tuple(int(x) for x in found.groups())
+
+    def __getattr__(self, name):
+        if name in ATTRS:
+            return self.attrib.get(ATTRS[name], '')
+        if name in BOOLS:
+            return self.attrib.get(BOOLS[name]) == 'true'
+        raise AttributeError(name)
+
+    @property
+    def center(self):
+        """Center (x, y) of the node on the screen."""
+        left, top, right, bottom = self.bounds
+        return ((left + right) // 2, (top + bottom) // 2)
+
+    def __repr__(self):
+        return '<Node %s text=%r id=%r>' % (
+            self.className, self.text, self.resourceId)
+
+
+def _matches(node, key, value):
+    """Check a node against one selector criterion."""
+    if key in ATTRS:
+        return getattr(node, key) == value
+    if key in BOOLS:
+        return getattr(node, key) == bool(value)
+    for attr in ATTRS:
+        if not key.startswith(attr):
+            continue
+        actual = getattr(node, attr)
+        how = key[len(attr):]
+        if how == 'Matches':
+            return _regex(value).match(actual) is not None
+        elif how == 'Contains':
+            return value in actual
+        elif how == 'StartsWith':
+            return actual.startswith(value)
+    if key == 'index':
+        return node.attrib.get('index') == str(value)
+    raise ValueError('Unsupported selector: %s' % key)
+
+
+class Hierarchy(object):
+    """Indexed snapshot of one UI hierarchy dump.
+
+    Attributes:
+        nodes (list): All nodes in document order.
+        stamp (float): Time the dump was parsed.
+    """
+
+    INDEXED = ('text', 'resourceId', 'description', 'className')
+
+    def __init__(self, xml, stamp=None):
+        """Summary
+
+        Args:
+            xml (str): Output of uiautomator.Device.dump().
+            stamp (float, optional): Time the dump was taken.
+        """
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        self.stamp = time.time() if stamp is None else stamp
+        self.nodes = []
+        self._index = dict((key, {}) for key in self.INDEXED)
+        for elem in cElementTree.fromstring(xml).iter('node'):
+            node = Node(elem.attrib, len(self.nodes))
+            self.nodes.append(node)
+            for key in self.INDEXED:
+                self._index[key].setdefault(getattr(node, key), []).append(
+                    node)
+
+    @property
+    def size(self):
+        """(width, height) of the screen, from the root node."""
+        if not self.nodes:
+            return (0, 0)
+        left, top, right, bottom = self.nodes[0].bounds
+        return (right - left, bottom - top)
+
+    def values(self, key):
+        """Get the distinct values of an indexed attribute, e.g. text."""
+        return self._index[key].keys()
+
+    def find(self, **selector):
+        """Find the nodes that match a UIAutomator style selector.
+
+        Supported keys are text, resourceId, description, className and
+        packageName with the Matches, Contains and StartsWith variants, the
+        boolean flags such as scrollable or clickable, index and instance.
+
+        Returns:
+            nodes (list): Matching nodes in document order.
+        """
+        selector = dict(selector)
+        instance = selector.pop('instance', None)
+        nodes = None
+        for key in self.INDEXED:
+            if key in selector:
+                hits = self._index[key].get(selector.pop(key), [])
+                if nodes is None:
+                    nodes = hits
+                else:
+                    keep = set(id(node) for node in hits)
+                    nodes = [node for node in nodes if id(node) in keep]
+        if nodes is None:
+            nodes = self.nodes
+        for key, value in selector.iteritems():
+            nodes = [node for node in nodes if _matches(node, key, value)]
+        if instance is not None:
+            return nodes[instance: instance + 1]
+        return list(nodes)
+
+    def first(self, **selector):
+        """Get the first node that matches the selector, or None."""
+        nodes = self.find(**selector)
+        return nodes[0] if nodes else None
+
+    def exists(self, **selector):
+        """Check if any node matches the selector."""
+        return bool(self.find(**selector))
+
+    def count(self, **selector):
+        """Count the nodes that match the selector."""
+        return len(self.find(**selector))
@@ -1,25 +1,290 @@
-"""Logging module."""
+"""Logging module.
 
+Loggers only enqueue their records. A background writer thread formats them
+and writes them to the console and, when configured, to a log file that is
+rotated by size and age and gzipped on rollover. The file can be written as
+JSON lines carrying tcname and devname as fields.
+
+The queue holds at most MAX_QUEUED records. When the writer falls that far
+behind, new records are dropped instead of growing the memory of the
+process, and the writer logs how many were lost. The queued records are
+written at exit.
+
+The file output is configured with configure(), or from the environment:
+    LOG_FILE - Path to the log file.
+    LOG_FORMAT - text (default) or json.
+"""
+
+import atexit
+import gzip
+import json
 import logging
-import yaml
+import logging.handlers
+import os
+import Queue
+import shutil
+import threading
+import time
+
+TEXT_FORMAT = ' '.join(['%(asctime)s', ':', '[%(levelname)s]',
+                        '[%(name)s]', '[%(devname)s]',
+                        '[%(funcName)s]', '%(message)s'])
+
+MAX_BYTES = 50 * 1024 * 1024
+INTERVAL = 24 * 60 * 60
+BACKUP_COUNT = 10
+MAX_QUEUED = 10000
+STOP_TIMEOUT = 10
+
+
+class QueueHandler(logging.Handler):
+    """Handler that only puts the record on the queue of a log writer."""
+
+    def __init__(self, logwriter):
+        logging.Handler.__init__(self)
+        self.writer = logwriter
+
+    def prepare(self, record):
+        """Render the message so the record no longer refers to args."""
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        if not hasattr(record, 'devname'):
+            record.devname = getattr(record, 'device', '')
+        return record
+
+    def emit(self, record):
+        try:
+            self.writer.put(self.prepare(record))
+        except Exception:  # pylint: disable=I0011,W0703
+            self.handleError(record)
+
+
+class LogWriter(object):
+    """Background thread that hands queued records to its handlers.
+
+    Attributes:
+        dropped (int): Records dropped because the queue was full.
+        handlers (list): Handlers the records are written to.
+        queue (Queue.Queue): Records waiting to be written.
+    """
+
+    def __init__(self, handlers, maxsize=MAX_QUEUED):
+        self.queue = Queue.Queue(maxsize)
+        self.handlers = list(handlers)
+        self.dropped = 0
+        self._reported = 0
+        self._lock = threading.Lock()
+        self._drop_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, record):
+        """Queue a record, or drop it if the queue is full."""
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            with self._drop_lock:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            with self._lock:
+                self._write(record)
+                self._report()
+
+    def _write(self, record):
+        """Hand a record to the handlers, the lock must be held."""
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _report(self):
+        """Log the records dropped since the last report, lock held."""
+        with self._drop_lock:
+            dropped = self.dropped
+        if dropped == self._reported:
+            return
+        count, self._reported = dropped - self._reported, dropped
+        self._write(logging.makeLogRecord({
+            'name': 'LOG', 'devname': '', 'funcName': '_report',
+            'levelno': logging.WARNING, 'levelname': 'WARNING',
+            'msg': '%d log records dropped, the queue was full.' % count,
+        }))
+
+    def add(self, handler):
+        """Write records to one more handler."""
+        with self._lock:
+            self.handlers.append(handler)
+
+    def remove(self, handler):
+        """Stop writing records to a handler and close it."""
+        with self._lock:
+            if handler in self.handlers:
+                self.handlers.remove(handler)
+        handler.close()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Write the queued records and stop the thread.
+
+        Args:
+            timeout (float, optional): Seconds to wait for the writer.
+        """
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            pass
+        self._thread.join(timeout)
+        with self._lock:
+            self._report()
+            for handler in self.handlers:
+                handler.flush()
+                handler.close()
+
+
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """File handler rotating by size and age into gzipped backups.
+
+    Backups are named <file>.1.gz (newest) up to <file>.<backup_count>.gz.
+    """
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, interval=INTERVAL,
+                 backup_count=BACKUP_COUNT):
+        """Summary
+
+        Args:
+            filename (str): Path to the log file.
+            max_bytes (int, optional): Roll over beyond this size, 0 never.
+            interval (float, optional): Roll over after these seconds,
+                0 never.
+            backup_count (int, optional): Number of backups to keep.
+        """
+        logging.handlers.RotatingFileHandler.__init__(
+            self, filename, 'a', max_bytes, backup_count, delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return 1
+        return logging.handlers.RotatingFileHandler.shouldRollover(
+            self, record)
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        base = self.baseFilename
+        for index in xrange(self.backupCount - 1, 0, -1):
+            sfn = '%s.%d.gz' % (base, index)
+            dfn = '%s.%d.gz' % (base, index + 1)
+            if os.path.exists(sfn):
+                if os.path.exists(dfn):
+                    os.remove(dfn)
+                os.rename(sfn, dfn)
+        if os.path.exists(base):
+            if self.backupCount > 0:
+                with open(base, 'rb') as src:
+                    with gzip.open('%s.1.gz' % base, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+            os.remove(base)
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+        self.stream = self._open()
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'tcname': record.name,
+            'devname': getattr(record, 'devname', ''),
+            'func': record.funcName,
+            'message': record.getMessage(),
+        }
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry)
+
+
+_WRITER = []
+_FILE_HANDLER = []
+_WRITER_LOCK = threading.Lock()
+
+
+def writer():
+    """Get the shared log writer, starting it on first use."""
+    with _WRITER_LOCK:
+        if not _WRITER:
+            console = logging.StreamHandler()
+            console.setLevel(logging.DEBUG)
+            console.setFormatter(logging.Formatter(TEXT_FORMAT))
+            _WRITER.append(LogWriter([console]))
+            atexit.register(_WRITER[0].stop)
+            if os.environ.get('LOG_FILE'):
+                _configure(os.environ['LOG_FILE'],
+                           os.environ.get('LOG_FORMAT', 'text'))
+        return _WRITER[0]
+
+
+def _configure(path, fmt, max_bytes=MAX_BYTES, interval=INTERVAL,
+               backup_count=BACKUP_COUNT):
+    """Replace the file output of the shared writer."""
+    dirpath = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(dirpath):
+        os.makedirs(dirpath)
+    handler = CompressedRotatingFileHandler(path, max_bytes, interval,
+                                            backup_count)
+    handler.setLevel(logging.DEBUG)
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    if _FILE_HANDLER:
+        _WRITER[0].remove(_FILE_HANDLER.pop())
+    _FILE_HANDLER.append(handler)
+    _WRITER[0].add(handler)
+
+
+def configure(path, fmt='text', max_bytes=MAX_BYTES, interval=INTERVAL,
+              backup_count=BACKUP_COUNT):
+    """Also write the log to a rotated file.
+
+    Args:
+        path (str): Path to the log file.
+        fmt (str, optional): text or json.
+        max_bytes (int, optional): Roll over beyond this size, 0 never.
+        interval (float, optional): Roll over after these seconds, 0 never.
+        backup_count (int, optional): Number of gzipped backups to keep.
+    """
+    writer()
+    with _WRITER_LOCK:
+        _configure(path, fmt, max_bytes, interval, backup_count)
+
+
+def queue_handler():
+    """Get a handler that feeds the shared log writer."""
+    handler = QueueHandler(writer())
+    handler.setLevel(logging.DEBUG)
+    return handler
+
 
 def logger(testCase, device='MAIN'):
     """Retrieve Python logger."""
     log = logging.getLogger(testCase)
     if not len(log.handlers):
         log.setLevel(logging.DEBUG)
-        log_format = ' '.join(['%(asctime)s', ':', '[%(levelname)s]',
-                               '[%(name)s]', '[%(device)s]',
-                               '[%(funcName)s]', '%(message)s'])
-        log_formatter = logging.Formatter(log_format)
-        stream_handler = logging.StreamHandler()
-        stream_handler.setLevel(logging.DEBUG)
-        stream_handler.setFormatter(log_formatter)
-        log.addHandler(stream_handler)
-        # file_handler = logging.FileHandler(log_dirpath, 'w')
-        # file_handler.setLevel(logging.DEBUG)
-        # file_handler.setFormatter(log_formatter)
-        # log.addHandler(file_handler)
+        log.addHandler(queue_handler())
     return logging.LoggerAdapter(log, {'device': device})
 
 def test(testCase, device):
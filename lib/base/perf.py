@@ -0,0 +1,335 @@
+"""Performance Instrumentation Module
+
+Opt-in timing of every Common method, every adb command, every persistent
+shell command, every shell and exec-out call through the adb server socket,
+every uiautomator JSON-RPC call and every time.sleep made on behalf of a
+test case. Timings are aggregated into histograms per test case,
+device and operation, and a summary with count, p50, p95 and max is written
+at exit.
+
+Enable it with the MTBF_PERF=1 environment variable, or call enable() before
+the test case objects are created. When it is disabled nothing is patched
+or wrapped, so there is no overhead on the test path. disable() puts the
+patched functions back.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import atexit
+import functools
+import inspect
+import math
+import os
+import sys
+import threading
+import time
+
+BUCKET_BASE = 1.05
+BUCKET_MIN = 1e-6
+
+ENABLED = bool(os.environ.get('MTBF_PERF'))
+
+_CTX = threading.local()
+_LOCK = threading.Lock()
+_HISTOGRAMS = {}
+_ORIGINALS = {}
+_DUMP_AT_EXIT = []
+_SLEEP = time.sleep
+
+
+class Histogram(object):
+    """Log-bucketed latency histogram with bounded memory.
+
+    Buckets grow by BUCKET_BASE, so percentiles are within 5%.
+
+    Attributes:
+        count (int): Number of samples.
+        maxval (float): Largest sample in seconds.
+        total (float): Sum of the samples in seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maxval = 0.0
+        self._buckets = {}
+
+    def add(self, value):
+        """Add one sample in seconds."""
+        index = 0
+        if value > BUCKET_MIN:
+            index = int(math.log(value / BUCKET_MIN, BUCKET_BASE)) + 1
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.maxval = max(self.maxval, value)
+
+    def percentile(self, pct):
+        """Estimate a percentile, e.g. 0.95, in seconds."""
+        if not self.count:
+            return 0.0
+        rank = pct * self.count
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                return min(BUCKET_MIN * BUCKET_BASE ** index, self.maxval)
+        return self.maxval
+
+
+def context():
+    """Get the (tcname, devname) the current thread is working for."""
+    return getattr(_CTX, 'ctx', None)
+
+
+def record(ctx, opname, seconds):
+    """Add a timing to the histogram of a context and an operation.
+
+    Args:
+        ctx (tuple): (tcname, devname), or None if unknown.
+        opname (str): Name of the operation.
+        seconds (float): Duration.
+    """
+    if not ENABLED:
+        return
+    key = (ctx or ('-', '-')) + (opname,)
+    with _LOCK:
+        hist = _HISTOGRAMS.get(key)
+        if hist is None:
+            hist = _HISTOGRAMS[key] = Histogram()
+        hist.add(seconds)
+
+
+def _timed_method(name, func):
+    """Wrap a Common method to time it and set the thread's context."""
+    @functools.wraps(func)
+    def timed(self, *args, **kwargs):
+        """Timed method."""
+        if not ENABLED:
+            return func(self, *args, **kwargs)
+        prev = context()
+        ctx = (getattr(self, 'tcname', '-'), getattr(self, 'devname', '-'))
+        _CTX.ctx = ctx
+        start = time.time()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            record(ctx, name, time.time() - start)
+            _CTX.ctx = prev
+    timed.perf_timed = True
+    return timed
+
+
+def _timed_call(opname, func):
+    """Wrap a callable to time it under the current thread's context."""
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        """Timed call."""
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(context(), opname(args) if callable(opname) else opname,
+                   time.time() - start)
+    timed.perf_timed = True
+    return timed
+
+
+def instrument(cls):
+    """Time every method defined on cls and its base classes."""
+    for klass in inspect.getmro(cls):
+        if klass is object or '_perf_instrumented' in klass.__dict__:
+            continue
+        for name, func in klass.__dict__.items():
+            if name.startswith('__') or not inspect.isfunction(func):
+                continue
+            if getattr(func, 'perf_timed', False):
+                continue
+            setattr(klass, name, _timed_method(name, func))
+        klass._perf_instrumented = True
+
+
+class _TimedPopen(object):
+    """Popen proxy that times communicate()."""
+
+    def __init__(self, proc, opname, start):
+        self._proc = proc
+        self._opname = opname
+        self._start = start
+
+    def communicate(self, *args, **kwargs):
+        """Wait for the process and record the time since its spawn."""
+        try:
+            return self._proc.communicate(*args, **kwargs)
+        finally:
+            record(context(), self._opname, time.time() - self._start)
+
+    def __getattr__(self, name):
+        return getattr(self._proc, name)
+
+
+class TimedAdb(object):
+    """uiautomator.Adb proxy that times every adb command."""
+
+    def __init__(self, adb):
+        self._adb = adb
+
+    def cmd(self, *args, **kwargs):
+        """Spawn an adb command, timed from spawn to communicate()."""
+        start = time.time()
+        proc = self._adb.cmd(*args, **kwargs)
+        return _TimedPopen(proc, 'adb:%s' % (args[0] if args else ''), start)
+
+    def __getattr__(self, name):
+        return getattr(self._adb, name)
+
+
+class TimedAdbClient(object):
+    """adbclient.AdbClient proxy that times shell and exec-out calls."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def _timed(self, opname, func, serial, cmd):
+        """Call func(serial, cmd) and record it under opname and cmd."""
+        start = time.time()
+        try:
+            return func(serial, cmd)
+        finally:
+            record(context(), '%s:%s' % (opname, _words(cmd)),
+                   time.time() - start)
+
+    def shell(self, serial, cmd):
+        """Timed AdbClient.shell."""
+        return self._timed('adbc', self._client.shell, serial, cmd)
+
+    def exec_out(self, serial, cmd):
+        """Timed AdbClient.exec_out."""
+        return self._timed('adbc-exec', self._client.exec_out, serial, cmd)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def _words(cmd, count=2):
+    """First words of a command line, to name its operation."""
+    return ' '.join(cmd.split()[:count])
+
+
+def _shell_opname(args):
+    """Name a ShellSession.run call after the command."""
+    return 'shell:%s' % (_words(args[1]) if len(args) > 1 else '')
+
+
+def _rpc_opname(args):
+    """Name a JSON-RPC call after the method."""
+    return 'rpc:%s' % getattr(args[0], 'method', '?')
+
+
+def _sleep(seconds):
+    """time.sleep that is recorded when called for a test case."""
+    if context() is None:
+        return _SLEEP(seconds)
+    start = time.time()
+    try:
+        return _SLEEP(seconds)
+    finally:
+        record(context(), 'sleep', time.time() - start)
+
+
+def enable():
+    """Turn the instrumentation on for objects created from now on."""
+    global ENABLED  # pylint: disable=I0011,W0603
+    with _LOCK:
+        ENABLED = True
+        if _ORIGINALS:
+            return
+        from . import shell
+        _patch(shell.ShellSession, 'run',
+               _timed_call(_shell_opname, shell.ShellSession.run.im_func))
+        try:
+            import uiautomator
+            rpc = getattr(uiautomator, 'JsonRPCMethod', None)
+            if rpc is not None:
+                _patch(rpc, '__call__',
+                       _timed_call(_rpc_opname, rpc.__call__.im_func))
+        except ImportError:
+            pass
+        _patch(time, 'sleep', _sleep)
+        if not _DUMP_AT_EXIT:
+            _DUMP_AT_EXIT.append(True)
+            atexit.register(dump)
+
+
+def disable():
+    """Turn the instrumentation off and put the patched functions back.
+
+    Classes already instrumented and proxies already attached stay in
+    place, but record nothing until enable() is called again.
+    """
+    global ENABLED  # pylint: disable=I0011,W0603
+    with _LOCK:
+        ENABLED = False
+        for (owner, name), func in _ORIGINALS.items():
+            setattr(owner, name, func)
+        _ORIGINALS.clear()
+
+
+def _patch(owner, name, func):
+    """Replace an attribute and keep the original for disable()."""
+    _ORIGINALS[(owner, name)] = owner.__dict__[name]
+    setattr(owner, name, func)
+
+
+def attach(common):
+    """Instrument a Common object if the instrumentation is enabled.
+
+    Called by Common.__init__, does nothing when disabled.
+    """
+    if not ENABLED:
+        return
+    enable()
+    instrument(type(common))
+    if not isinstance(common.adb, TimedAdb):
+        common.adb = TimedAdb(common.adb)
+    if not isinstance(common.adbc, TimedAdbClient):
+        common.adbc = TimedAdbClient(common.adbc)
+
+
+def summary():
+    """Format the histograms, slowest total first.
+
+    Returns:
+        text (str): One line per test case, device and operation.
+    """
+    with _LOCK:
+        items = _HISTOGRAMS.items()
+    items.sort(key=lambda item: -item[1].total)
+    lines = ['%-14s %-8s %-34s %7s %9s %9s %9s %9s' % (
+        'TC', 'DEVICE', 'OPERATION', 'COUNT', 'TOTAL(s)', 'P50(ms)',
+        'P95(ms)', 'MAX(ms)')]
+    for (tcname, devname, opname), hist in items:
+        lines.append('%-14s %-8s %-34s %7d %9.2f %9.1f %9.1f %9.1f' % (
+            tcname, devname, opname[:34], hist.count, hist.total,
+            hist.percentile(.5) * 1000, hist.percentile(.95) * 1000,
+            hist.maxval * 1000))
+    return '\n'.join(lines)
+
+
+def reset():
+    """Drop every recorded timing."""
+    with _LOCK:
+        _HISTOGRAMS.clear()
+
+
+def dump(path=None):
+    """Write the summary to a file, LOG_PATH/perf-summary.txt by default."""
+    if not _HISTOGRAMS:
+        return None
+    if path is None:
+        logpath = os.environ.get('LOG_PATH') or sys.path[0]
+        path = os.path.join(logpath, 'perf-summary.txt')
+    with open(path, 'w') as stream:
+        stream.write(summary() + '\n')
+    return path
@@ -0,0 +1,244 @@
+"""Process Registry Module
+
+The harness registers the processes it spawns, e.g. persistent adb shells
+and logcat streams, under the serial of their device, and the cleanup hooks
+of other resources, e.g. uiautomator servers. cleanup() then stops exactly
+those, instead of scanning every process on the host.
+
+The processes of a cleanup are stopped in parallel: all of them are sent
+SIGTERM at once, and those still running at the timeout are killed.
+
+On hosts with /proc, the harness and the processes it registers are also
+listed in LOG_PATH/harness.pids with their start time. A full cleanup
+stops those an earlier run left behind, and only those: a pid whose start
+time changed belongs to another process now.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import signal
+import sys
+import threading
+import time
+
+PIDFILE = 'harness.pids'
+
+_LOCK = threading.Lock()
+_PROCS = {}
+_HOOKS = {}
+_LISTED = []
+
+
+def _pidfile():
+    """Get the path to the pidfile, LOG_PATH/harness.pids by default."""
+    logpath = os.environ.get('LOG_PATH') or sys.path[0]
+    return os.path.join(logpath, PIDFILE)
+
+
+def _starttime(pid):
+    """Get the start time of a running process, None if unknown or gone."""
+    try:
+        with open('/proc/%d/stat' % pid) as stream:
+            stat = stream.read()
+    except (IOError, OSError):
+        return None
+    # The command name in parentheses may hold spaces, count after it.
+    fields = stat[stat.rfind(')') + 2:].split()
+    if len(fields) < 20 or fields[0] == 'Z':
+        return None
+    return fields[19]
+
+
+def _list(pids, mode='a'):
+    """Write processes to the pidfile, best effort."""
+    lines = []
+    for pid in pids:
+        start = _starttime(pid)
+        if start is not None:
+            lines.append('%d %s\n' % (pid, start))
+    if not lines:
+        return
+    try:
+        with open(_pidfile(), mode) as stream:
+            stream.writelines(lines)
+    except (IOError, OSError):
+        pass
+
+
+class _Stray(object):
+    """Process left behind by an earlier run, with the Popen methods used.
+
+    Attributes:
+        pid (int): Process ID.
+        start (str): Start time read from the pidfile.
+    """
+
+    def __init__(self, pid, start):
+        """Summary
+
+        Args:
+            pid (int): Process ID.
+            start (str): Start time read from the pidfile.
+        """
+        self.pid = pid
+        self.start = start
+
+    def poll(self):
+        """Get None while the process runs, like Popen.poll()."""
+        return None if _starttime(self.pid) == self.start else 0
+
+    def terminate(self):
+        """Send SIGTERM."""
+        os.kill(self.pid, signal.SIGTERM)
+
+    def kill(self):
+        """Send SIGKILL."""
+        os.kill(self.pid, signal.SIGKILL)
+
+    def wait(self):
+        """Block until the process is gone."""
+        while self.poll() is None:
+            time.sleep(.05)
+
+
+def _strays():
+    """Get the still running processes of the pidfile from earlier runs."""
+    try:
+        with open(_pidfile()) as stream:
+            lines = stream.readlines()
+    except (IOError, OSError):
+        return []
+    ours = set([os.getpid()])
+    for procs in _PROCS.values():
+        ours.update(proc.pid for proc in procs)
+    strays = []
+    for line in lines:
+        try:
+            pid, start = line.split()
+            pid = int(pid)
+        except ValueError:
+            continue
+        if pid not in ours and _starttime(pid) == start:
+            strays.append(_Stray(pid, start))
+    return strays
+
+
+def register(proc, serial=None):
+    """Register a spawned process.
+
+    Args:
+        proc (subprocess.Popen): Process to stop on cleanup.
+        serial (str, optional): Serial of its device, None for the host.
+    """
+    with _LOCK:
+        _PROCS.setdefault(serial, set()).add(proc)
+        pids = [proc.pid]
+        if not _LISTED:
+            _LISTED.append(True)
+            pids.insert(0, os.getpid())
+        _list(pids)
+
+
+def unregister(proc, serial=None):
+    """Forget a process that has been stopped by its owner."""
+    with _LOCK:
+        procs = _PROCS.get(serial)
+        if procs is not None:
+            procs.discard(proc)
+            if not procs:
+                del _PROCS[serial]
+
+
+def on_cleanup(hook, serial=None, key=None):
+    """Register a callable run on every cleanup of a device.
+
+    A hook registered under the key of an earlier one replaces it, e.g.
+    the server of a new uiautomator.Device replaces the stale one.
+
+    Args:
+        hook (callable): Called without arguments, e.g. dev.server.stop.
+        serial (str, optional): Serial of its device, None for the host.
+        key (str, optional): Name of the resource, the hook by default.
+    """
+    with _LOCK:
+        _HOOKS.setdefault(serial, {})[hook if key is None else key] = hook
+
+
+def registered(serial=None):
+    """Get the registered processes of a device that are still running."""
+    with _LOCK:
+        procs = list(_PROCS.get(serial, ()))
+    return [proc for proc in procs if proc.poll() is None]
+
+
+def _run_hooks(hooks, deadline):
+    """Run cleanup hooks on threads until they finish or the deadline."""
+    threads = []
+    for hook in hooks:
+        thread = threading.Thread(target=_run_hook, args=(hook,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+
+
+def _run_hook(hook):
+    """Run one cleanup hook, errors do not stop the cleanup."""
+    try:
+        hook()
+    except Exception:  # pylint: disable=I0011,W0703
+        pass
+
+
+def _signal(proc, kill):
+    """Terminate or kill a process, ignoring the ones already gone."""
+    try:
+        if kill:
+            proc.kill()
+        else:
+            proc.terminate()
+    except OSError:
+        pass
+
+
+def cleanup(serials=None, timeout=5):
+    """Stop the registered processes and run the hooks of devices.
+
+    The hooks run once, a cleanup forgets them like the processes.
+
+    Args:
+        serials (list, optional): Device serials, every registered device,
+            the host processes and the strays of earlier runs by default.
+        timeout (float, optional): Seconds before SIGKILL.
+
+    Returns:
+        killed (int): Number of processes that needed SIGKILL.
+    """
+    with _LOCK:
+        procs = []
+        if serials is None:
+            serials = set(_PROCS) | set(_HOOKS)
+            procs.extend(_strays())
+            _list([os.getpid()], 'w')
+            if not _LISTED:
+                _LISTED.append(True)
+        hooks = []
+        for serial in serials:
+            procs.extend(_PROCS.pop(serial, ()))
+            hooks.extend(_HOOKS.pop(serial, {}).values())
+    deadline = time.time() + timeout
+    _run_hooks(hooks, deadline)
+    running = [proc for proc in procs if proc.poll() is None]
+    for proc in running:
+        _signal(proc, False)
+    while running and time.time() < deadline:
+        time.sleep(.05)
+        running = [proc for proc in running if proc.poll() is None]
+    for proc in running:
+        _signal(proc, True)
+    for proc in running:
+        proc.wait()
+    return len(running)
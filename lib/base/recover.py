@@ -0,0 +1,261 @@
+"""Recovery Module
+
+Brings a DUT back to the homescreen between MTBF iterations, escalating
+from the cheapest action to the most expensive one:
+
+    home - Press HOME.
+    force_stop - Force stop the foreground package, unless it is the
+        launcher or the system UI, see keep_pkgs(), then HOME.
+    recents - Clear the recent apps, then HOME.
+    uiautomator - Restart the uiautomator server, then HOME.
+    reboot - Reboot the device and wait for a new boot to complete.
+
+Every tier is timed and its success counted per test case. Once a tier has
+been tried MIN_TRIES times for a test case and succeeds less than MIN_RATE
+of the time, recovery of that test case starts above it. Every
+EXPLORE_EVERY-th recovery starts from the bottom again, so the learned start
+tier follows changes in the DUT's behavior.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import threading
+import time
+
+from ConfigParser import Error as ConfigError
+
+from . import cfg
+from . import util
+from . import watcher
+
+TIERS = ('home', 'force_stop', 'recents', 'uiautomator', 'reboot')
+
+MIN_TRIES = 3
+MIN_RATE = 0.25
+EXPLORE_EVERY = 10
+BOOT_TIMEOUT = 300
+
+LAUNCHER = 'com.tct.launcher'
+SYSTEMUI = 'com.android.systemui'
+
+# Changes on every boot, so the old boot's sys.boot_completed=1 is not
+# mistaken for the new one while the device is still going down.
+BOOT_ID = 'cat /proc/sys/kernel/random/boot_id'
+
+_LOCK = threading.Lock()
+_STATS = {}
+_RUNS = {}
+
+
+class TierStats(object):
+    """Timing and success of one tier for one test case.
+
+    Attributes:
+        count (int): Number of attempts.
+        seconds (float): Total duration of the attempts.
+        successes (int): Attempts after which the DUT was recovered.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.successes = 0
+        self.seconds = 0.0
+
+    def add(self, seconds, success):
+        """Add one attempt."""
+        self.count += 1
+        self.seconds += seconds
+        if success:
+            self.successes += 1
+
+    def rate(self):
+        """Success rate of the attempts."""
+        return self.successes / self.count if self.count else 0.0
+
+    def mean(self):
+        """Mean duration of an attempt in seconds."""
+        return self.seconds / self.count if self.count else 0.0
+
+
+def keep_pkgs():
+    """Get the packages the force_stop tier never stops.
+
+    The launcher is read from the [Packages] launcher entry of apps.ini,
+    like the other package names, LAUNCHER without one.
+    """
+    try:
+        launcher = cfg.aget('Packages', 'launcher')
+    except (IOError, ConfigError):
+        launcher = LAUNCHER
+    return (launcher, SYSTEMUI)
+
+
+def stats(tcname, tier):
+    """Get the statistics of a tier for a test case."""
+    with _LOCK:
+        key = (tcname, tier)
+        if key not in _STATS:
+            _STATS[key] = TierStats()
+        return _STATS[key]
+
+
+def start_tier(tcname):
+    """Get the index of the tier the recovery of a test case starts at."""
+    with _LOCK:
+        runs = _RUNS[tcname] = _RUNS.get(tcname, 0) + 1
+        if runs % EXPLORE_EVERY == 0:
+            return 0
+        for index, tier in enumerate(TIERS[:-1]):
+            tstats = _STATS.get((tcname, tier))
+            if (tstats is None or tstats.count < MIN_TRIES or
+                    tstats.rate() >= MIN_RATE):
+                return index
+        return len(TIERS) - 1
+
+
+def summary():
+    """Format the statistics of every test case and tier.
+
+    Returns:
+        text (str): One line per test case and tier, in tier order.
+    """
+    with _LOCK:
+        items = _STATS.items()
+    items.sort(key=lambda item: (item[0][0], TIERS.index(item[0][1])))
+    lines = ['%-14s %-12s %7s %9s %9s' % ('TC', 'TIER', 'COUNT', 'RATE(%)',
+                                         'MEAN(s)')]
+    for (tcname, tier), tstats in items:
+        lines.append('%-14s %-12s %7d %9.1f %9.2f' % (
+            tcname, tier, tstats.count, tstats.rate() * 100, tstats.mean()))
+    return '\n'.join(lines)
+
+
+def reset():
+    """Drop every statistic and learned start tier."""
+    with _LOCK:
+        _STATS.clear()
+        _RUNS.clear()
+
+
+class Recovery(object):
+    """Escalating recovery of the DUT of a Common object.
+
+    Attributes:
+        common (common.Common): Test case library of the DUT.
+        verify (callable): Returns True when the DUT is recovered.
+    """
+
+    def __init__(self, common, verify=None):
+        """Summary
+
+        Args:
+            common (common.Common): Test case library of the DUT.
+            verify (callable, optional): Returns True when the DUT is
+                recovered, the homescreen is shown by default.
+        """
+        self.common = common
+        self.verify = verify or self.is_homescreen
+
+    def is_homescreen(self):
+        """Check the homescreen with a single hierarchy dump."""
+        return self.common.snapshot().exists(description='ALL APPS')
+
+    def _home(self):
+        """Press HOME."""
+        self.common.dev.press.home()
+        self.common.foreground.invalidate()
+
+    def tier_home(self):
+        """Press HOME."""
+        self._home()
+
+    def tier_force_stop(self):
+        """Force stop the foreground package, then press HOME."""
+        pkg = self.common.get_current_pkg()
+        if pkg and pkg not in keep_pkgs():
+            self.common.log.info('Force stop %s.', pkg)
+            self.common.pkg_force_stop(pkg)
+        self._home()
+
+    def tier_recents(self):
+        """Clear the recent apps, then press HOME."""
+        self.common.recent_apps_clear()
+        self._home()
+
+    def _start_uiautomator(self):
+        """Start the uiautomator server and register its watchers."""
+        dev = self.common.dev
+        dev.server.start()
+        if not watcher.host():
+            util.init_watchers(dev)
+
+    def tier_uiautomator(self):
+        """Restart the uiautomator server, then press HOME."""
+        self.common.dev.server.stop()
+        self._start_uiautomator()
+        self._home()
+
+    def _boot_state(self):
+        """Get the boot id and sys.boot_completed, None while unreachable."""
+        try:
+            res = self.common.shell(BOOT_ID + '; getprop sys.boot_completed')
+        except IOError:
+            return None
+        res = res.split()
+        return tuple(res) if len(res) == 2 else None
+
+    def tier_reboot(self):
+        """Reboot the DUT, wait for a new boot and drop its caches.
+
+        Raises:
+            IOError: The DUT did not complete a new boot in BOOT_TIMEOUT.
+        """
+        com = self.common
+        serial = com.session.serial
+        old = self._boot_state()
+        com.log.warning('Reboot %s.', serial)
+        com.adb.cmd('reboot').communicate()
+        com.session.close()
+        deadline = time.time() + BOOT_TIMEOUT
+        while True:
+            state = self._boot_state()
+            if (state is not None and state[1] == '1' and
+                    (old is None or state[0] != old[0])):
+                break
+            if time.time() > deadline:
+                raise IOError('%s did not boot in %ds.' % (serial,
+                                                           BOOT_TIMEOUT))
+            time.sleep(2)
+        util.invalidate_device(serial)
+        com.telephony.invalidate()
+        com.foreground.invalidate()
+        self._start_uiautomator()
+        com.screen_turn_on()
+        self._home()
+
+    def recover(self, tcname=None):
+        """Escalate through the tiers until the DUT is recovered.
+
+        Args:
+            tcname (str, optional): Test case to learn for, the one of
+                the Common object by default.
+
+        Returns:
+            tier (str): Tier that recovered the DUT, None if none did.
+        """
+        tcname = tcname or self.common.tcname
+        for tier in TIERS[start_tier(tcname):]:
+            start = time.time()
+            try:
+                getattr(self, 'tier_%s' % tier)()
+                success = self.verify()
+            except Exception as err:  # pylint: disable=I0011,W0703
+                self.common.log.warning('Recovery %s failed: %s', tier, err)
+                success = False
+            stats(tcname, tier).add(time.time() - start, success)
+            if success:
+                self.common.log.info('Recovered by %s.', tier)
+                return tier
+        self.common.log.error('Failed to recover the DUT.')
+        return None
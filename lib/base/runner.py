@@ -0,0 +1,249 @@
+"""Device Runner Module
+
+Every configured device (MDEVICE, SDEVICE, ...) gets its own worker thread,
+so blocking adb and uiautomator calls on one phone do not hold up the other.
+Work is queued per device and every job hands back its result or error.
+Test case objects, and so their Common instance and logger, are created
+per device through util.tcget.
+
+The adb device tracker tells the runner as soon as a device disconnects:
+its queued jobs then fail at once with IOError instead of timing out inside
+uiautomator, until the device is back.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import Queue
+import sys
+import threading
+
+from . import util
+
+DEVNAMES = ('MDEVICE', 'SDEVICE')
+
+
+def devnames():
+    """Get the device names that have a serial number configured."""
+    return [name for name in DEVNAMES if os.environ.get(name)]
+
+
+class Job(object):
+    """Pending call on a device worker.
+
+    Attributes:
+        devname (str): Device the job runs on.
+        done (threading.Event): Set when the job finished.
+        error (tuple): sys.exc_info() if the call raised.
+        result: Return value of the call.
+    """
+
+    def __init__(self, devname, func, args, kwargs):
+        self.devname = devname
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.done = threading.Event()
+        self.error = None
+        self.result = None
+
+    def run(self):
+        """Call the function and keep its outcome."""
+        try:
+            self.result = self.func(self.devname, *self.args, **self.kwargs)
+        except BaseException:
+            self.error = sys.exc_info()
+        self.done.set()
+
+    def get(self, timeout=None):
+        """Wait for the job and return its result, or re-raise its error.
+
+        Args:
+            timeout (float, optional): Seconds to wait.
+        """
+        if not self.done.wait(timeout):
+            raise RuntimeError('Job on %s timed out.' % self.devname)
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+class Worker(threading.Thread):
+    """Thread that runs the jobs of one device in order.
+
+    Attributes:
+        online (threading.Event): Cleared while the device is disconnected.
+    """
+
+    def __init__(self, devname):
+        threading.Thread.__init__(self, name='worker-%s' % devname)
+        self.daemon = True
+        self.devname = devname
+        self.jobs = Queue.Queue()
+        self.log = util.logger('RUNNER', devname)
+        self.online = threading.Event()
+        self.online.set()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            if self.online.is_set():
+                job.run()
+            else:
+                err = IOError('%s is disconnected.' % self.devname)
+                job.error = (IOError, err, None)
+                job.done.set()
+            if job.error is not None:
+                self.log.error('%s failed: %s', job.func.__name__,
+                               job.error[1])
+
+
+class Results(object):
+    """Thread-safe pass/fail tallies per device, test case and unit."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def record(self, devname, tcname, unit, passed):
+        """Count one iteration of a test unit.
+
+        Args:
+            devname (str): Device the iteration ran on.
+            tcname (str): Name of the test case.
+            unit (str): Name of the test unit.
+            passed (bool): Outcome of the iteration.
+        """
+        key = (devname, tcname, unit)
+        with self._lock:
+            count = self._counts.setdefault(key, [0, 0])
+            count[0 if passed else 1] += 1
+
+    def items(self):
+        """Get ((devname, tcname, unit), (passed, failed)) pairs."""
+        with self._lock:
+            return [(key, tuple(val)) for key, val in self._counts.items()]
+
+    def totals(self):
+        """Merge every device into tcname -> unit -> (passed, failed)."""
+        merged = {}
+        for (_, tcname, unit), (npass, nfail) in self.items():
+            units = merged.setdefault(tcname, {})
+            opass, ofail = units.get(unit, (0, 0))
+            units[unit] = (opass + npass, ofail + nfail)
+        return merged
+
+
+class Runner(object):
+    """Run jobs on every device at once, one worker thread per device.
+
+    Attributes:
+        devnames (list): Device names served by the runner.
+        results (Results): Shared pass/fail tallies.
+    """
+
+    def __init__(self, names=None):
+        """Summary
+
+        Args:
+            names (list, optional): Device names, devnames() by default.
+        """
+        self.devnames = list(devnames() if names is None else names)
+        self.results = Results()
+        self._workers = dict((name, Worker(name)) for name in self.devnames)
+        for worker in self._workers.values():
+            worker.start()
+        self._serials = dict((os.environ.get(name), name)
+                             for name in self.devnames)
+        self._tracker = util.device_tracker()
+        self._tracker.subscribe(self._on_connect, self._on_disconnect)
+
+    def _on_connect(self, serial, state):
+        """Let the worker of a device that came back run again."""
+        # pylint: disable=I0011,W0613
+        devname = self._serials.get(serial)
+        if devname is not None:
+            self._workers[devname].log.info('%s connected.', serial)
+            self._workers[devname].online.set()
+
+    def _on_disconnect(self, serial, state):
+        """Fail the jobs of a device that went away."""
+        devname = self._serials.get(serial)
+        if devname is not None:
+            self._workers[devname].log.error('%s disconnected (%s).',
+                                             serial, state or 'gone')
+            self._workers[devname].online.clear()
+
+    def online(self, devname):
+        """Check if a device is connected, as far as the tracker knows."""
+        return self._workers[devname].online.is_set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def submit(self, devname, func, *args, **kwargs):
+        """Queue func(devname, *args, **kwargs) on the device's worker.
+
+        Returns:
+            job (Job): Handle of the pending call.
+        """
+        job = Job(devname, func, args, kwargs)
+        self._workers[devname].jobs.put(job)
+        return job
+
+    def broadcast(self, func, *args, **kwargs):
+        """Queue the same call on every device.
+
+        Returns:
+            jobs (dict): Device name to Job.
+        """
+        return dict((name, self.submit(name, func, *args, **kwargs))
+                    for name in self.devnames)
+
+    def run_all(self, func, *args, **kwargs):
+        """Run the same call on every device at once and wait for all.
+
+        Every job is waited for before the first error is re-raised, so no
+        worker is still running the call when this returns.
+
+        Returns:
+            results (dict): Device name to the return value.
+        """
+        jobs = self.broadcast(func, *args, **kwargs)
+        for job in jobs.values():
+            job.done.wait()
+        return dict((name, job.get()) for name, job in jobs.items())
+
+    def run_tc(self, tcname, func, *args, **kwargs):
+        """Run func(tc, *args, **kwargs) with each device's TC object.
+
+        For example runner.run_tc('Messaging', Messaging.backto_homescreen)
+        brings both phones to the homescreen at once.
+
+        Returns:
+            results (dict): Device name to the return value.
+        """
+        def _call(devname):
+            """Look up the device's TC object and call func with it."""
+            return func(util.tcget(tcname, devname), *args, **kwargs)
+        _call.__name__ = getattr(func, '__name__', 'run_tc')
+        return self.run_all(_call)
+
+    def stop(self, wait=True):
+        """Stop the workers once their queued jobs are done.
+
+        Args:
+            wait (bool, optional): Block until the workers exit.
+        """
+        self._tracker.unsubscribe(self._on_connect, self._on_disconnect)
+        for worker in self._workers.values():
+            worker.jobs.put(None)
+        if wait:
+            for worker in self._workers.values():
+                worker.join()
@@ -0,0 +1,197 @@
+"""Plan Scheduler Module
+
+A test plan (att-3glte-full.yaml, the stability ini, ...) maps sections to
+test units and their iteration counts. The scheduler expands the plan into
+single iterations and splits them into one contiguous share per device.
+A device that runs out of work steals from the back of the longest
+remaining share, and the per-device results are merged back into totals
+per section.
+
+An iteration that raises a device error (IOError, OSError) on a device
+that has gone offline is put back and the device stops; the online devices
+steal its share. On a device that is still online it counts as failed.
+Iterations left once every worker has stopped are run on the devices that
+are still online.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import collections
+import threading
+
+from . import cfg
+from . import runner
+from . import util
+from . import yml
+
+
+def plan_from_yml(path):
+    """Read a plan from a YAML file of section -> unit -> iterations."""
+    return yml.YML(path).get()
+
+
+def plan_from_cfg():
+    """Read the plan of the stability config file of common.ini."""
+    scfg = cfg.sread()
+    return dict((section, dict(scfg.items(section)))
+                for section in scfg.sections())
+
+
+def expand(plan, sections=None):
+    """Expand a plan into a list of (section, unit) iterations.
+
+    Sections and units are ordered by name, so a given plan always expands
+    the same way.
+
+    Args:
+        plan (dict): Section to a dict of unit to iteration count.
+        sections (list, optional): Only expand these sections.
+    """
+    units = []
+    for section in sorted(plan):
+        if sections is not None and section not in sections:
+            continue
+        for unit in sorted(plan[section] or {}):
+            units.extend([(section, unit)] * int(plan[section][unit]))
+    return units
+
+
+class Scheduler(object):
+    """Share a plan's iterations across devices with work stealing.
+
+    Attributes:
+        results (runner.Results): Pass/fail tallies of this plan only.
+        runner (runner.Runner): Device workers that run the iterations.
+        stolen (int): Number of iterations moved to another device.
+        units (list): Every (section, unit) iteration of the plan.
+    """
+
+    def __init__(self, plan, devrunner, sections=None):
+        """Summary
+
+        Args:
+            plan (dict): Section to a dict of unit to iteration count.
+            devrunner (runner.Runner): Device workers.
+            sections (list, optional): Only run these sections.
+        """
+        self.runner = devrunner
+        self.results = runner.Results()
+        self.units = expand(plan, sections)
+        self.stolen = 0
+        self._lock = threading.Lock()
+        self._shares = {}
+        self._split()
+
+    def _split(self):
+        """Give every device one contiguous share of the iterations."""
+        names = self.runner.devnames
+        if not names:
+            raise ValueError('No device to run on, set MDEVICE or SDEVICE.')
+        size, extra = divmod(len(self.units), len(names))
+        start = 0
+        for index, name in enumerate(names):
+            end = start + size + (1 if index < extra else 0)
+            self._shares[name] = collections.deque(self.units[start: end])
+            start = end
+
+    def _next(self, devname):
+        """Take the next iteration of a device, stealing when it is idle.
+
+        Returns:
+            item (tuple): (section, unit), None once the plan is done or
+                the device is offline.
+        """
+        if not self.runner.online(devname):
+            return None
+        with self._lock:
+            share = self._shares[devname]
+            if share:
+                return share.popleft()
+            victim = max(self._shares.values(), key=len)
+            if victim:
+                self.stolen += 1
+                return victim.pop()
+            return None
+
+    def _drain(self, devname, execute):
+        """Run iterations on one device until the whole plan is done."""
+        log = util.logger('SCHEDULER', devname)
+        while True:
+            item = self._next(devname)
+            if item is None:
+                return
+            section, unit = item
+            try:
+                passed = bool(execute(devname, section, unit))
+            except (IOError, OSError) as err:
+                if not self.runner.online(devname):
+                    log.error('%s %s lost the device, put back: %s',
+                              section, unit, err)
+                    with self._lock:
+                        self._shares[devname].appendleft(item)
+                    return
+                log.error('%s %s raised: %s', section, unit, err)
+                passed = False
+            except Exception as err:  # pylint: disable=I0011,W0703
+                log.error('%s %s raised: %s', section, unit, err)
+                passed = False
+            self.results.record(devname, section, unit, passed)
+            self.runner.results.record(devname, section, unit, passed)
+
+    def _drain_all(self, devnames, execute):
+        """Drain on the given devices and wait for every one of them."""
+        log = util.logger('SCHEDULER')
+        jobs = dict((name, self.runner.submit(name, self._drain, execute))
+                    for name in devnames)
+        for job in jobs.values():
+            job.done.wait()
+        for devname, job in sorted(jobs.items()):
+            try:
+                job.get()
+            except IOError as err:
+                # The worker of an offline device refuses the job.
+                log.warning('%s did not run: %s', devname, err)
+
+    def run(self, execute):
+        """Run the plan on every device and wait for it to finish.
+
+        Args:
+            execute (callable): execute(devname, section, unit) runs one
+                iteration and returns True if it passed.
+
+        Returns:
+            totals (dict): Section to (passed, failed) of this plan.
+        """
+        self._drain_all(self.runner.devnames, execute)
+        while self.pending():
+            online = [name for name in self.runner.devnames
+                      if self.runner.online(name)]
+            if not online:
+                util.logger('SCHEDULER').error(
+                    '%d iterations not run, no device left online.',
+                    self.pending())
+                break
+            self._drain_all(online, execute)
+        return self.totals()
+
+    def pending(self):
+        """Count the iterations no device has taken."""
+        with self._lock:
+            return sum(len(share) for share in self._shares.values())
+
+    def totals(self):
+        """Merge the results of every device into per-section totals.
+
+        Only the iterations of this plan are counted, runner.results also
+        holds earlier runs.
+
+        Returns:
+            totals (dict): Section to (passed, failed).
+        """
+        totals = {}
+        for section, units in self.results.totals().iteritems():
+            npass = sum(count[0] for count in units.values())
+            nfail = sum(count[1] for count in units.values())
+            totals[section] = (npass, nfail)
+        return totals
@@ -0,0 +1,364 @@
+"""Persistent ADB Shell Module
+
+One long-lived `adb shell` process is kept per device. Commands are written
+to its stdin and the output is read back up to a sentinel line, so a state
+probe costs a pipe round trip instead of a process spawn and adb handshake.
+Older adbd serve `adb shell` on a PTY, which echoes the input and prints
+prompts, so the session turns both off when it opens, and the sentinel is
+sent quoted so that an echoed command line never reads as the sentinel.
+
+A command that times out is not run again, it may have had side effects;
+only a session the device dropped is reopened and the command resent.
+
+Long-running `adb logcat` streams are kept the same way and turn matching
+log lines into wake-up events for the state waits in Common.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import atexit
+import Queue
+import subprocess
+import threading
+import time
+import uuid
+
+from . import procs
+
+
+class ShellTimeout(IOError):
+    """A shell command did not finish in time.
+
+    The command may still be running on the device, so it must not be
+    retried.
+    """
+
+
+def adb_argv(adb, *args):
+    """Build an adb command line addressed to the device of adb.
+
+    Args:
+        adb (uiautomator.Adb): UIAutomator Adb.
+        *args: adb arguments, e.g. 'shell' or 'logcat'.
+    """
+    argv = [adb.adb()]
+    argv.extend(getattr(adb, 'adbHostPortOptions', []))
+    serial = adb.device_serial()
+    if serial:
+        argv.extend(['-s', serial])
+    argv.extend(args)
+    return argv
+
+
+def adb_shell(adb, cmd):
+    """Run one command through a fresh `adb shell` process.
+
+    The command line is handed to adb as a single argument without a host
+    shell, so pipes, ; and $? are run by the device shell on every host.
+
+    Args:
+        adb (uiautomator.Adb): UIAutomator Adb.
+        cmd (str): Shell command line.
+
+    Returns:
+        out (str): Output of the command, stdout and stderr merged.
+    """
+    proc = subprocess.Popen(adb_argv(adb, 'shell', cmd),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return proc.communicate()[0].replace('\r\n', '\n')
+
+
+class ShellSession(object):
+    """Long-lived adb shell session multiplexed with sentinel lines.
+
+    Attributes:
+        adb (uiautomator.Adb): UIAutomator Adb.
+        serial (str): Serial number of the device.
+        timeout (float): Seconds to wait for a command to finish.
+    """
+
+    def __init__(self, adb, timeout=60):
+        """Summary
+
+        Args:
+            adb (uiautomator.Adb): UIAutomator Adb.
+            timeout (float, optional): Seconds to wait for a command.
+        """
+        self.adb = adb
+        self.serial = adb.device_serial()
+        self.timeout = timeout
+        self._proc = None
+        self._lines = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """Spawn the shell process and its stdout reader thread."""
+        self._proc = subprocess.Popen(adb_argv(self.adb, 'shell'),
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT)
+        procs.register(self._proc, self.serial)
+        self._lines = Queue.Queue()
+        reader = threading.Thread(target=_pump,
+                                  args=(self._proc.stdout, self._lines))
+        reader.daemon = True
+        reader.start()
+        # Drop the PTY echo and prompts, and whatever they printed so far.
+        self._send('stty -echo 2>/dev/null; PS1=; PS2=\n')
+        try:
+            self._exchange('true', self.timeout)
+        except ShellTimeout:
+            raise IOError('Shell session to %s did not start.' % self.serial)
+
+    def _send(self, script):
+        """Write to the shell's stdin."""
+        try:
+            self._proc.stdin.write(script)
+            self._proc.stdin.flush()
+        except (IOError, OSError, ValueError):
+            raise IOError('Shell session to %s is closed.' % self.serial)
+
+    def _exchange(self, cmd, timeout):
+        """Send one command and collect its output up to the sentinel."""
+        uid = uuid.uuid4().hex
+        token = '__MTBF_%s__' % uid
+        # The quotes keep an echoed sentinel line from matching the token.
+        self._send('{ %s\n} </dev/null 2>&1\necho __MTBF_""%s__\n'
+                   % (cmd, uid))
+        out = []
+        while True:
+            try:
+                line = self._lines.get(timeout=timeout)
+            except Queue.Empty:
+                raise ShellTimeout('Shell command timed out: %s' % cmd)
+            if line is None:
+                raise IOError('Shell session to %s dropped.' % self.serial)
+            line = line.rstrip('\r\n')
+            if line.endswith(token):
+                head = line[:-len(token)]
+                if head:
+                    out.append(head)
+                return '\n'.join(out)
+            out.append(line)
+
+    def is_alive(self):
+        """Check if the shell process is still running."""
+        return self._proc is not None and self._proc.poll() is None
+
+    def run(self, cmd, timeout=None):
+        """Run a command on the device shell and return its output.
+
+        The session is reopened and the command resent once if the device
+        dropped the connection. After a timeout the session is closed, so
+        late output cannot leak into the next command, and the timeout is
+        raised.
+
+        Args:
+            cmd (str): Shell command line.
+            timeout (float, optional): Seconds to wait for the output.
+
+        Returns:
+            out (str): Output of the command, stdout and stderr merged.
+
+        Raises:
+            ShellTimeout: The command did not finish in time.
+            IOError: The session could not be opened or dropped twice.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        with self._lock:
+            for attempt in xrange(2):
+                try:
+                    if not self.is_alive():
+                        self.close()
+                        self._open()
+                    return self._exchange(cmd, timeout)
+                except ShellTimeout:
+                    self.close()
+                    raise
+                except IOError:
+                    self.close()
+                    if attempt:
+                        raise
+
+    def close(self):
+        """Terminate the shell process."""
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        procs.unregister(proc, self.serial)
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        if proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        proc.wait()
+
+
+def _pump(stream, lines):
+    """Copy lines from a pipe into a queue, then mark the EOF with None."""
+    try:
+        for line in iter(stream.readline, ''):
+            lines.put(line)
+    except (IOError, OSError, ValueError):
+        pass
+    lines.put(None)
+
+
+class LogcatStream(object):
+    """Background `adb logcat` reader that signals on matching lines.
+
+    Once the logcat process has failed to start or has exited, the stream is
+    unusable and is not respawned.
+
+    Attributes:
+        adb (uiautomator.Adb): UIAutomator Adb.
+        buffer (str): Logcat buffer, e.g. radio or events.
+        regex (re.RegexObject): Lines matching it set the event.
+        usable (bool): False once the logcat process has gone away.
+    """
+
+    def __init__(self, adb, buffer, regex):
+        """Summary
+
+        Args:
+            adb (uiautomator.Adb): UIAutomator Adb.
+            buffer (str): Logcat buffer, e.g. radio or events.
+            regex (re.RegexObject): Lines matching it set the event.
+        """
+        self.adb = adb
+        self.buffer = buffer
+        self.regex = regex
+        self.usable = True
+        self._proc = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+
+    def is_alive(self):
+        """Check if the logcat process is still running."""
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self):
+        """Start streaming if it is not running yet.
+
+        Returns:
+            alive (bool): True if the stream is running.
+        """
+        with self._lock:
+            if self.is_alive():
+                return True
+            if self._proc is not None:
+                self.usable = False
+            if not self.usable:
+                return False
+            argv = adb_argv(self.adb, 'logcat', '-b', self.buffer,
+                            '-v', 'brief', '-T', '1')
+            try:
+                self._proc = subprocess.Popen(argv,
+                                              stdout=subprocess.PIPE,
+                                              stderr=subprocess.STDOUT)
+            except OSError:
+                self.usable = False
+                return False
+            procs.register(self._proc, self.adb.device_serial())
+            reader = threading.Thread(target=self._read,
+                                      args=(self._proc.stdout,))
+            reader.daemon = True
+            reader.start()
+            return True
+
+    def _read(self, stream):
+        """Set the event for every line that matches the regex."""
+        try:
+            for line in iter(stream.readline, ''):
+                if self.regex.search(line):
+                    self._event.set()
+        except (IOError, OSError, ValueError):
+            pass
+        self._event.set()
+
+    def clear(self):
+        """Forget the events seen so far."""
+        self._event.clear()
+
+    def wait(self, timeout):
+        """Block until a matching line arrives or the timeout expires.
+
+        Returns:
+            seen (bool): True if a matching line arrived.
+        """
+        if not self.is_alive():
+            time.sleep(min(timeout, 1))
+            return False
+        return self._event.wait(timeout)
+
+    def close(self):
+        """Terminate the logcat process."""
+        with self._lock:
+            proc, self._proc = self._proc, None
+        if proc is not None:
+            procs.unregister(proc, self.adb.device_serial())
+        if proc is not None and proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+            proc.wait()
+
+
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+_STREAMS = {}
+
+
+def session(adb):
+    """Get the shared shell session of a device.
+
+    Args:
+        adb (uiautomator.Adb): UIAutomator Adb.
+    """
+    key = (adb.device_serial(),
+           tuple(getattr(adb, 'adbHostPortOptions', [])))
+    with _SESSIONS_LOCK:
+        if key not in _SESSIONS:
+            _SESSIONS[key] = ShellSession(adb)
+        return _SESSIONS[key]
+
+
+def logcat(adb, buffer, regex):
+    """Get the shared, started logcat stream of a device buffer.
+
+    Args:
+        adb (uiautomator.Adb): UIAutomator Adb.
+        buffer (str): Logcat buffer, e.g. radio or events.
+        regex (re.RegexObject): Lines matching it set the event.
+
+    Returns:
+        stream (LogcatStream): None if the stream is unusable.
+    """
+    key = (adb.device_serial(),
+           tuple(getattr(adb, 'adbHostPortOptions', [])),
+           buffer, regex.pattern)
+    with _SESSIONS_LOCK:
+        if key not in _STREAMS:
+            _STREAMS[key] = LogcatStream(adb, buffer, regex)
+        stream = _STREAMS[key]
+    if not stream.start():
+        return None
+    return stream
+
+
+@atexit.register
+def close_all():
+    """Close every shell session and logcat stream."""
+    with _SESSIONS_LOCK:
+        sessions = _SESSIONS.values() + _STREAMS.values()
+        _SESSIONS.clear()
+        _STREAMS.clear()
+    for sess in sessions:
+        sess.close()
@@ -0,0 +1,372 @@
+"""Device State Module
+
+Parsed snapshots of the DUT's dumpsys state, shared by the Common helpers so
+that a single device round trip answers several questions.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import re
+import threading
+import time
+
+
+SERVICE_STATES = (
+    ('mServiceState=0', 'InService'),
+    ('mServiceState=1', 'OutOfService'),
+    ('mServiceState=2', 'EmergencyOnly'),
+    ('mServiceState=3', 'NetworkOff'),
+)
+
+DATA_STATES = (
+    ('mDataConnectionState=0', 'Disconnected'),
+    ('mDataConnectionState=1', 'Connecting'),
+    ('mDataConnectionState=2', 'Connected'),
+    ('mDataConnectionState=3', 'Suspended'),
+)
+
+CALL_STATES = (
+    ('mCallState=2', 'InCall'),
+    ('mCallState=1', 'Ringing'),
+    ('mCallState=0', 'Idle'),
+)
+
+# Service state, signal, call state and data call list changes of the radio
+# log. DcTracker and DataState debug lines are left out, they log constantly.
+RADIO_EVENTS = re.compile(
+    'Poll ServiceState done|pollStateDone|VOICE_NETWORK_STATE_CHANGED|'
+    'SIGNAL_STRENGTH|CALL_STATE_CHANGED|DATA_CALL_LIST_CHANGED')
+
+RATS_2G = ('edge', 'gsm', 'gprs', '1xrtt')
+RATS_3G = ('umts', 'hspap', 'evdo', 'hsupa', 'hsdpa', 'hspa')
+
+
+def _first_state(res, states):
+    """Return the name of the first state whose marker is found in res."""
+    for marker, name in states:
+        if marker in res:
+            return name
+    return None
+
+
+class TelephonyState(object):
+    """Snapshot of `dumpsys telephony.registry`.
+
+    Attributes:
+        call (str): Idle, Ringing, InCall, or None.
+        data (str): Disconnected, Connecting, Connected, Suspended, or None.
+        service (str): InService, OutOfService, EmergencyOnly, NetworkOff,
+            or None.
+        ssline (str): Lower-cased first mServiceState line, used for RAT.
+        stamp (float): Time the snapshot was taken.
+    """
+
+    def __init__(self, res, stamp=None):
+        """Summary
+
+        Args:
+            res (str): Output of `dumpsys telephony.registry`.
+            stamp (float, optional): Time the snapshot was taken.
+        """
+        self.stamp = time.time() if stamp is None else stamp
+        self.service = _first_state(res, SERVICE_STATES)
+        self.data = _first_state(res, DATA_STATES)
+        self.call = _first_state(res, CALL_STATES)
+        self.ssline = ''
+        for line in res.splitlines():
+            if 'mServiceState' in line:
+                self.ssline = line.lower().strip()
+                break
+        is_2g = any(x in self.ssline for x in RATS_2G)
+        is_3g = any(x in self.ssline for x in RATS_3G)
+        is_lte = 'lte' in self.ssline
+        self.rats = {
+            '2G': is_2g,
+            '3G': is_3g,
+            'LTE': is_lte,
+            '2G3G': is_2g or is_3g,
+            '3GLTE': is_3g or is_lte,
+            '2G3GLTE': is_2g or is_3g or is_lte,
+        }
+
+    def network(self, network):
+        """Check if the DUT is registered on the specified network.
+
+        Args:
+            network (str): 2G, 3G, LTE, 2G3G, 3GLTE, or 2G3GLTE.
+        """
+        return self.rats[network]
+
+
+class TelephonyRegistry(object):
+    """TTL cache of the DUT's TelephonyState.
+
+    Attributes:
+        shell (callable): Runs a shell command on the DUT, returns output.
+        ttl (float): Seconds a snapshot stays fresh.
+    """
+
+    def __init__(self, shell, ttl=0.5):
+        """Summary
+
+        Args:
+            shell (callable): Runs a shell command on the DUT.
+            ttl (float, optional): Seconds a snapshot stays fresh.
+        """
+        self.shell = shell
+        self.ttl = ttl
+        self._state = None
+        self._lock = threading.Lock()
+
+    def snapshot(self, maxage=None):
+        """Get the telephony state, refreshing it if it is stale.
+
+        Args:
+            maxage (float, optional): Override the TTL for this call.
+        """
+        if maxage is None:
+            maxage = self.ttl
+        with self._lock:
+            now = time.time()
+            if self._state is None or now - self._state.stamp > maxage:
+                res = self.shell('dumpsys telephony.registry')
+                self._state = TelephonyState(res, now)
+            return self._state
+
+    def invalidate(self):
+        """Drop the cached snapshot."""
+        with self._lock:
+            self._state = None
+
+
+FOCUS_CMD = 'dumpsys window windows'
+FOCUS_GREP = (" | grep -E 'mCurrentFocus|mFocusedApp'; "
+              "echo GREP_STATUS=$?")
+
+GREP_STATUS = re.compile(r'^GREP_STATUS=(\d+)\s*$', re.M)
+
+
+class GrepDump(object):
+    """Run a dump filtered with grep on the DUT, or the full dump.
+
+    Filtering on the DUT keeps the transfer to a few lines. The filtered
+    command echoes GREP_STATUS=$? after each of its greps. grep exits 0 on
+    a match and 1 on none, so both are answers, an empty one included. Any
+    other status means the build has no working grep -E, and the full dump
+    is used from then on.
+
+    Attributes:
+        grep (bool): Filter on the DUT.
+        shell (callable): Runs a shell command on the DUT, returns output.
+    """
+
+    def __init__(self, shell):
+        """Summary
+
+        Args:
+            shell (callable): Runs a shell command on the DUT.
+        """
+        self.shell = shell
+        self.grep = True
+
+    def run(self, grepcmd, fullcmd):
+        """Get the filtered output, or the full one without grep.
+
+        Args:
+            grepcmd (str): Filtered command, GREP_STATUS after each grep.
+            fullcmd (str): Unfiltered command.
+        """
+        if self.grep:
+            res = self.shell(grepcmd)
+            statuses = GREP_STATUS.findall(res)
+            if statuses and all(status in ('0', '1') for status in statuses):
+                return GREP_STATUS.sub('', res)
+            self.grep = False
+        return self.shell(fullcmd)
+
+
+def focused_pkg(res):
+    """Get the focused package from `dumpsys window windows` output.
+
+    Args:
+        res (str): Full or grep-filtered output of the dumpsys.
+    """
+    lines1 = []
+    for line in res.splitlines():
+        if 'mCurrentFocus' in line or 'mFocusedApp' in line:
+            lines1.append(line.strip())
+    target_line = ''
+    for line in lines1:
+        if 'ActivityRecord' in line:
+            temp = line.split('ActivityRecord')
+            if len(temp) > 1:
+                target_line = temp[1]
+                break
+    pkg_name = ''
+    for line in target_line.split():
+        if '/' in line:
+            pkg_name = line.split('/')[0]
+    return pkg_name
+
+
+class ForegroundTracker(object):
+    """Short-lived cache of the DUT's foreground package.
+
+    The focus lines are filtered with grep on the DUT, see GrepDump, so
+    only two lines cross adb instead of the whole window dump.
+
+    Attributes:
+        dump (GrepDump): Runs the window dump on the DUT.
+        ttl (float): Seconds an answer stays fresh.
+    """
+
+    def __init__(self, shell, ttl=0.3):
+        """Summary
+
+        Args:
+            shell (callable): Runs a shell command on the DUT.
+            ttl (float, optional): Seconds an answer stays fresh.
+        """
+        self.dump = GrepDump(shell)
+        self.ttl = ttl
+        self._pkg = None
+        self._stamp = 0
+        self._lock = threading.Lock()
+
+    def _query(self):
+        """Ask the DUT for its foreground package."""
+        return focused_pkg(self.dump.run(FOCUS_CMD + FOCUS_GREP, FOCUS_CMD))
+
+    def current(self, maxage=None):
+        """Get the foreground package, querying the DUT if stale.
+
+        Args:
+            maxage (float, optional): Override the TTL for this call.
+
+        Returns:
+            pkg (str): Package name, or '' if it could not be found.
+        """
+        if maxage is None:
+            maxage = self.ttl
+        with self._lock:
+            now = time.time()
+            if self._pkg is None or now - self._stamp > maxage:
+                self._pkg = self._query()
+                self._stamp = now
+            return self._pkg
+
+    def invalidate(self):
+        """Drop the cached answer."""
+        with self._lock:
+            self._pkg = None
+
+    def wait(self, check, timeout, interval=.1, maxinterval=1):
+        """Poll the foreground package until check accepts it.
+
+        The first check may use the cached answer, the following ones query
+        the DUT, backing off from interval to maxinterval seconds.
+
+        Args:
+            check (callable): Takes the package name, returns True when done.
+            timeout (float): Time out in seconds, 0 checks once.
+            interval (float, optional): First delay between queries.
+            maxinterval (float, optional): Longest delay between queries.
+
+        Returns:
+            done (bool): True if check accepted the package in time.
+        """
+        deadline = time.time() + timeout
+        maxage = None
+        while True:
+            if check(self.current(maxage)):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 1.5, maxinterval)
+            maxage = 0
+
+
+SCREEN_ON = re.compile('mScreenOnFully=(true|false)')
+LOCKED = re.compile('mShowingLockscreen=(true|false)')
+KEYBOARD = re.compile('mInputShown=(true|false)')
+
+DISPLAY_CMD = 'dumpsys window policy; dumpsys input_method'
+DISPLAY_GREP = ("dumpsys window policy | "
+                "grep -E 'mScreenOnFully|mShowingLockscreen'; "
+                "echo GREP_STATUS=$?; "
+                "dumpsys input_method | grep mInputShown; "
+                "echo GREP_STATUS=$?")
+
+
+def _is_true(regex, res):
+    """Check if the first match of regex in res reads true."""
+    sres = regex.search(res)
+    return sres is not None and sres.group(1) == 'true'
+
+
+class DisplayState(object):
+    """Snapshot of the DUT's window policy and input method state.
+
+    Attributes:
+        keyboard (bool): The soft keyboard is shown.
+        locked (bool): The lockscreen is showing.
+        screen_on (bool): The screen is fully on.
+        stamp (float): Time the snapshot was taken.
+    """
+
+    def __init__(self, res, stamp=None):
+        """Summary
+
+        Args:
+            res (str): Output of the window policy and input method dumps.
+            stamp (float, optional): Time the snapshot was taken.
+        """
+        self.stamp = time.time() if stamp is None else stamp
+        self.screen_on = _is_true(SCREEN_ON, res)
+        self.locked = _is_true(LOCKED, res)
+        self.keyboard = _is_true(KEYBOARD, res)
+
+
+class DisplayQuery(object):
+    """Fetch the DUT's DisplayState in a single shell round trip.
+
+    Both dumps run in one shell invocation and are filtered with grep on
+    the DUT, see GrepDump.
+
+    Attributes:
+        dump (GrepDump): Runs the dumps on the DUT.
+        ttl (float): Seconds a snapshot stays fresh, 0 to always query.
+    """
+
+    def __init__(self, shell, ttl=0):
+        """Summary
+
+        Args:
+            shell (callable): Runs a shell command on the DUT.
+            ttl (float, optional): Seconds a snapshot stays fresh.
+        """
+        self.dump = GrepDump(shell)
+        self.ttl = ttl
+        self._state = None
+        self._lock = threading.Lock()
+
+    def _query(self, now):
+        """Ask the DUT for its display state."""
+        return DisplayState(self.dump.run(DISPLAY_GREP, DISPLAY_CMD), now)
+
+    def snapshot(self, maxage=None):
+        """Get the display state, querying the DUT if stale.
+
+        Args:
+            maxage (float, optional): Override the TTL for this call.
+        """
+        if maxage is None:
+            maxage = self.ttl
+        with self._lock:
+            now = time.time()
+            if self._state is None or now - self._state.stamp > maxage:
+                self._state = self._query(now)
+            return self._state
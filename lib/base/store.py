@@ -0,0 +1,253 @@
+"""Artifact Store Module
+
+Screenshots, UI hierarchy dumps and image comparison crops are stored by
+content. Each artifact is hashed with SHA-1 and written once under
+
+    <root>/blobs/<first 2 hex digits>/<digest><ext>
+
+so the many identical screens of repeated failures cost a single file. XML
+is gzipped, PNG is stored as is. A blob is shared by every put of its
+content and may be pruned at any time, so the paths handed out are
+read-only references for logs and reports; copy a blob before working on
+it. A sqlite3 index maps every put to its test
+case, device, time, kind and original name, and prune() enforces the age and
+size retention on both.
+
+List the index with:
+    python -m lib.base.store [ROOT]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import gzip
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+MAX_AGE = 7 * 24 * 60 * 60
+MAX_BYTES = 2 * 1024 * 1024 * 1024
+PRUNE_EVERY = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    ext TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    time REAL NOT NULL,
+    tcname TEXT NOT NULL,
+    devname TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_time ON entries (time);
+CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
+"""
+
+
+class Store(object):
+    """Content-addressed artifact store with a sqlite3 index.
+
+    Attributes:
+        max_age (float): Entries older than these seconds are pruned.
+        max_bytes (int): Least recently used blobs beyond this total size
+            are pruned.
+        root (str): Folder holding the blobs and the index.
+    """
+
+    def __init__(self, root, max_age=MAX_AGE, max_bytes=MAX_BYTES):
+        """Summary
+
+        Args:
+            root (str): Folder holding the blobs and the index.
+            max_age (float, optional): Retention age in seconds.
+            max_bytes (int, optional): Retention size in bytes.
+        """
+        self.root = root
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        if not os.path.exists(os.path.join(root, 'blobs')):
+            os.makedirs(os.path.join(root, 'blobs'))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, 'index.sqlite'),
+                                   check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._puts = 0
+
+    def path(self, digest, ext):
+        """Path to the blob of a digest."""
+        return os.path.join(self.root, 'blobs', digest[:2], digest + ext)
+
+    def _write(self, path, data, compress):
+        """Write a blob through a temporary file, so it appears whole."""
+        dirpath = os.path.dirname(path)
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        temp = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                 threading.current_thread().ident)
+        if compress:
+            with open(temp, 'wb') as raw:
+                with gzip.GzipFile('', 'wb', 9, raw, mtime=0) as stream:
+                    stream.write(data)
+        else:
+            with open(temp, 'wb') as stream:
+                stream.write(data)
+        try:
+            os.rename(temp, path)
+        except OSError:
+            # Windows does not replace an existing file. The name is the
+            # content hash, so a blob another writer stored first is ours.
+            os.remove(temp)
+            if not os.path.exists(path):
+                raise
+        return os.path.getsize(path)
+
+    def put(self, data, ext, kind, name, tcname='-', devname='-'):
+        """Store an artifact once and index this put of it.
+
+        Args:
+            data (str): Content of the artifact.
+            ext (str): Extension of the blob, .gz ones are compressed.
+            kind (str): e.g. screendump, tempdump or crop.
+            name (str): Original file name.
+            tcname (str, optional): Name of the test case.
+            devname (str, optional): MDEVICE or SDEVICE.
+
+        Returns:
+            path (str): Path to the blob, read-only.
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.path(digest, ext)
+        now = time.time()
+        if not os.path.exists(path):
+            size = self._write(path, data, ext.endswith('.gz'))
+        else:
+            size = None
+        with self._lock:
+            with self._db:
+                if size is None:
+                    cur = self._db.execute('UPDATE blobs SET used = ? '
+                                           'WHERE digest = ?', (now, digest))
+                    if not cur.rowcount:
+                        # Pruned since the existence check, write it again.
+                        size = self._write(path, data, ext.endswith('.gz'))
+                if size is not None:
+                    self._db.execute('INSERT OR REPLACE INTO blobs '
+                                     'VALUES (?, ?, ?, ?)',
+                                     (digest, ext, size, now))
+                self._db.execute('INSERT INTO entries VALUES '
+                                 '(?, ?, ?, ?, ?, ?)',
+                                 (now, tcname, devname, kind, name, digest))
+            self._puts += 1
+            prune = self._puts % PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+        return path
+
+    def entries(self, tcname=None, devname=None, kind=None):
+        """List the indexed puts, oldest first.
+
+        Returns:
+            entries (list): (time, tcname, devname, kind, name, path).
+        """
+        query = ('SELECT e.time, e.tcname, e.devname, e.kind, e.name, '
+                 'e.digest, b.ext FROM entries e JOIN blobs b '
+                 'ON e.digest = b.digest')
+        where = []
+        args = []
+        for column, value in (('tcname', tcname), ('devname', devname),
+                              ('kind', kind)):
+            if value is not None:
+                where.append('e.%s = ?' % column)
+                args.append(value)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY e.time'
+        with self._lock:
+            rows = self._db.execute(query, args).fetchall()
+        return [row[:5] + (self.path(row[5], row[6]),) for row in rows]
+
+    def prune(self, max_age=None, max_bytes=None):
+        """Drop old entries, then unreferenced and least recently used blobs.
+
+        Args:
+            max_age (float, optional): Retention age, self.max_age default.
+            max_bytes (int, optional): Retention size, self.max_bytes default.
+
+        Returns:
+            removed (int): Number of blobs removed.
+        """
+        max_age = self.max_age if max_age is None else max_age
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM entries WHERE time < ?',
+                                 (time.time() - max_age,))
+                doomed = self._db.execute(
+                    'SELECT digest, ext FROM blobs WHERE digest NOT IN '
+                    '(SELECT digest FROM entries)').fetchall()
+                total = self._db.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM blobs WHERE digest '
+                    'IN (SELECT digest FROM entries)').fetchone()[0]
+                if total > max_bytes:
+                    rows = self._db.execute(
+                        'SELECT digest, ext, size FROM blobs WHERE digest '
+                        'IN (SELECT digest FROM entries) ORDER BY used')
+                    for digest, ext, size in rows.fetchall():
+                        if total <= max_bytes:
+                            break
+                        doomed.append((digest, ext))
+                        total -= size
+                self._db.executemany('DELETE FROM entries WHERE digest = ?',
+                                     [(digest,) for digest, _ in doomed])
+                self._db.executemany('DELETE FROM blobs WHERE digest = ?',
+                                     [(digest,) for digest, _ in doomed])
+            for digest, ext in doomed:
+                try:
+                    os.remove(self.path(digest, ext))
+                except OSError:
+                    pass
+        return len(doomed)
+
+    def close(self):
+        """Close the index."""
+        with self._lock:
+            self._db.close()
+
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def store(root=None):
+    """Get the shared store, LOG_PATH/store by default."""
+    if root is None:
+        logpath = os.environ.get('LOG_PATH') or sys.path[0]
+        root = os.path.join(logpath, 'store')
+    root = os.path.abspath(root)
+    with _STORES_LOCK:
+        if root not in _STORES:
+            _STORES[root] = Store(root)
+            _STORES[root].prune()
+        return _STORES[root]
+
+
+def main(argv=None):
+    """Print the index of a store."""
+    argv = sys.argv[1:] if argv is None else argv
+    sto = store(argv[0] if argv else None)
+    for stamp, tcname, devname, kind, name, path in sto.entries():
+        print '%s %-14s %-8s %-10s %-40s %s' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp)),
+            tcname, devname, kind, name, path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
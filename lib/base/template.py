@@ -0,0 +1,210 @@
+"""Template Library Module
+
+Every reference image under res_path() is loaded once as a grayscale array,
+optionally with an image pyramid. One captured frame can then be matched
+against many templates in a single call, optionally inside a region of
+interest, instead of reading the screenshot and the template from disk for
+each check.
+
+OpenCV is imported on first use, so importing this module stays cheap.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import threading
+
+from . import util
+
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp')
+MIN_SIDE = 8
+
+
+def _pyramid(img, levels):
+    """Build an image pyramid of at most levels levels."""
+    # pylint: disable=I0011,E1101
+    import cv2
+    pyr = [img]
+    for _ in xrange(1, levels):
+        if min(pyr[-1].shape[:2]) < 2 * MIN_SIDE:
+            break
+        pyr.append(cv2.pyrDown(pyr[-1]))
+    return pyr
+
+
+def _fits(tpl, img):
+    """Check if the template tpl fits inside the image img."""
+    return tpl.shape[0] <= img.shape[0] and tpl.shape[1] <= img.shape[1]
+
+
+class Match(object):
+    """Result of matching one template against a frame.
+
+    Attributes:
+        name (str): Name of the template.
+        score (float): TM_CCOEFF_NORMED score of the best location.
+        left (int): X of the top left corner on the frame.
+        top (int): Y of the top left corner on the frame.
+        width (int): Width of the template.
+        height (int): Height of the template.
+        similarity (float): Normalized dot product of the crop and the
+            template, the same measure util.img_comp decides on.
+    """
+
+    def __init__(self, name, score, left, top, width, height, similarity):
+        self.name = name
+        self.score = score
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+        self.similarity = similarity
+
+    @property
+    def center(self):
+        """Center (x, y) of the match on the frame."""
+        return (self.left + self.width // 2, self.top + self.height // 2)
+
+    @property
+    def found(self):
+        """Check if the match passes the util.img_comp threshold."""
+        return self.similarity > util.IMG_THRESHOLD
+
+    def __repr__(self):
+        return '<Match %s score=%.3f sim=%.3f at (%d, %d)>' % (
+            self.name, self.score, self.similarity, self.left, self.top)
+
+
+class TemplateLibrary(object):
+    """Preloaded grayscale templates.
+
+    Attributes:
+        levels (int): Number of pyramid levels, 1 for full size only.
+        root (str): Directory the templates were loaded from.
+        templates (dict): Template name to its pyramid, full size first.
+    """
+
+    def __init__(self, root=None, levels=1):
+        """Summary
+
+        Args:
+            root (str, optional): Directory of the templates, res_path() by
+                default.
+            levels (int, optional): Number of pyramid levels.
+        """
+        self.root = util.res_path() if root is None else root
+        self.levels = max(1, levels)
+        self.templates = {}
+        self.load()
+
+    def load(self):
+        """Load every image below root, named by its relative path.
+
+        For example res/browser/home.png is named 'browser/home'.
+        """
+        # pylint: disable=I0011,E1101
+        import cv2
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() not in IMAGE_EXTS:
+                    continue
+                path = os.path.join(dirpath, filename)
+                img = cv2.imread(path, 0)
+                if img is None:
+                    continue
+                name = os.path.splitext(os.path.relpath(path, self.root))[0]
+                self.add(name.replace(os.sep, '/'), img)
+
+    def add(self, name, img):
+        """Add or replace a template.
+
+        Args:
+            name (str): Name of the template.
+            img (numpy.ndarray): Template image, BGR or grayscale.
+        """
+        self.templates[name] = _pyramid(util.img_gray(img), self.levels)
+
+    def _locate(self, fpyr, tpyr):
+        """Find the best location of a template pyramid on a frame pyramid.
+
+        The search runs on the coarsest level both share and is refined on
+        the full size frame around the coarse hit.
+        """
+        # pylint: disable=I0011,E1101
+        import cv2
+        tpl = tpyr[0]
+        height, width = tpl.shape[:2]
+        level = min(len(fpyr), len(tpyr)) - 1
+        while level > 0 and not _fits(tpyr[level], fpyr[level]):
+            level -= 1
+        frame = fpyr[0]
+        if level > 0:
+            res = cv2.matchTemplate(fpyr[level], tpyr[level],
+                                    cv2.TM_CCOEFF_NORMED)
+            _, _, _, tleft = cv2.minMaxLoc(res)
+            scale = 2 ** level
+            fhgt, fwid = frame.shape[:2]
+            left = min(max(tleft[0] * scale - scale, 0), fwid - width)
+            top = min(max(tleft[1] * scale - scale, 0), fhgt - height)
+            right = min(fwid, left + width + 2 * scale)
+            bottom = min(fhgt, top + height + 2 * scale)
+            frame = frame[top: bottom, left: right]
+        else:
+            left = top = 0
+        res = cv2.matchTemplate(frame, tpl, cv2.TM_CCOEFF_NORMED)
+        _, score, _, tleft = cv2.minMaxLoc(res)
+        return score, left + tleft[0], top + tleft[1]
+
+    def match(self, frame, names=None, roi=None):
+        """Match many templates against one frame.
+
+        Args:
+            frame (numpy.ndarray or str): Captured frame or its path.
+            names (list, optional): Names of the templates, all by default.
+            roi (tuple, optional): (left, top, width, height) to search in.
+
+        Returns:
+            matches (dict): Template name to Match, or to None if the
+                template is unknown or larger than the searched region.
+        """
+        gray = util.img_gray(frame)
+        offx = offy = 0
+        if roi is not None:
+            offx, offy, roiw, roih = roi
+            gray = gray[offy: offy + roih, offx: offx + roiw]
+        if names is None:
+            names = self.templates.keys()
+        fpyr = _pyramid(gray, self.levels)
+        matches = {}
+        for name in names:
+            tpyr = self.templates.get(name)
+            if tpyr is None or not _fits(tpyr[0], gray):
+                matches[name] = None
+                continue
+            score, left, top = self._locate(fpyr, tpyr)
+            height, width = tpyr[0].shape[:2]
+            crop = gray[top: top + height, left: left + width]
+            similarity = util.img_similarity(crop, tpyr[0])
+            matches[name] = Match(name, score, offx + left, offy + top,
+                                  width, height, similarity)
+        return matches
+
+
+_LIBRARIES = {}
+_LIBRARIES_LOCK = threading.Lock()
+
+
+def library(root=None, levels=1):
+    """Get the shared template library of a directory.
+
+    Args:
+        root (str, optional): Directory of the templates, res_path() by
+            default.
+        levels (int, optional): Number of pyramid levels.
+    """
+    key = (root, levels)
+    with _LIBRARIES_LOCK:
+        if key not in _LIBRARIES:
+            _LIBRARIES[key] = TemplateLibrary(root, levels)
+        return _LIBRARIES[key]
@@ -1,8 +1,13 @@
-"""Utility module."""
+"""Utility module.
+
+OpenCV, NumPy and uiautomator are imported by the functions that use them,
+so importing this module for logger() or genid() stays cheap.
+"""
 
 from __future__ import absolute_import
 from __future__ import division
 
+import collections
 import functools
 import importlib
 import logging
@@ -12,33 +17,32 @@ import re
 import string
 import subprocess
 import sys
+import threading
+import time
 
-import cv2
-import uiautomator
+from . import adbclient
+from . import log as logpipe
+from . import procs
+from . import store
+from . import watcher
 
-import numpy
-import psutil
+IMG_THRESHOLD = 0.976
+TRACKER_TIMEOUT = 1
 
-from PIL import Image
+_LOGGER_LOCK = threading.Lock()
 
 
 def logger(tcname, devname='MAINRUN'):
-    """Retrieve Python logger."""
+    """Retrieve Python logger.
+
+    Records are written by the background writer of log.py, see
+    log.configure() for the rotated file and JSON lines output.
+    """
     log = logging.getLogger(tcname)
-    if not len(log.handlers):
-        log.setLevel(logging.DEBUG)
-        log_format = ' '.join(['%(asctime)s', ':', '[%(levelname)s]',
-                               '[%(name)s]', '[%(devname)s]',
-                               '[%(funcName)s]', '%(message)s'])
-        log_formatter = logging.Formatter(log_format)
-        stream_handler = logging.StreamHandler()
-        stream_handler.setLevel(logging.DEBUG)
-        stream_handler.setFormatter(log_formatter)
-        log.addHandler(stream_handler)
-        # file_handler = logging.FileHandler(log_dirpath, 'w')
-        # file_handler.setLevel(logging.DEBUG)
-        # file_handler.setFormatter(log_formatter)
-        # log.addHandler(file_handler)
+    with _LOGGER_LOCK:
+        if not len(log.handlers):
+            log.setLevel(logging.DEBUG)
+            log.addHandler(logpipe.queue_handler())
     return logging.LoggerAdapter(log, {'devname': devname})
 
 
@@ -72,47 +76,169 @@ def res_path():
     return respath
 
 
-def memoize(obj):
+class _Memoizer(object):
+    """Cache of one memoized function, see memoize().
+
+    Attributes:
+        cache (OrderedDict): Key to (time, value), least recently used first.
+        maxsize (int): Number of entries kept, None for no bound.
+        tags (dict): Tag, e.g. a device serial, to the keys it covers.
+        ttl (float): Seconds an entry is used, None for ever.
+    """
+
+    def __init__(self, func, maxsize, ttl, tag):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.tag = tag
+        self.cache = collections.OrderedDict()
+        self.tags = {}
+        self._keytags = {}
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def __get__(self, obj, objtype=None):
+        """Bind to an instance when used on a method, self is in the key."""
+        if obj is None:
+            return self
+        return functools.partial(self.__call__, obj)
+
+    def __call__(self, *args, **kwargs):
+        key = (args, frozenset(kwargs.iteritems()))
+        try:
+            hash(key)
+        except TypeError:
+            return self.func(*args, **kwargs)
+        while True:
+            with self._lock:
+                entry = self.cache.pop(key, None)
+                if entry is not None and (
+                        self.ttl is None or
+                        time.time() - entry[0] < self.ttl):
+                    self.cache[key] = entry
+                    return entry[1]
+                self._forget(key)
+                keylock = self._pending.get(key)
+                if keylock is None:
+                    keylock = self._pending[key] = threading.Lock()
+                    keylock.acquire()
+                    break
+            # Another thread computes this key, wait and look again.
+            with keylock:
+                pass
+        try:
+            value = self.func(*args, **kwargs)
+            tag = self.tag(*args, **kwargs) if self.tag else None
+            with self._lock:
+                self.cache[key] = (time.time(), value)
+                if tag is not None:
+                    self.tags.setdefault(tag, set()).add(key)
+                    self._keytags[key] = tag
+                while self.maxsize is not None and (
+                        len(self.cache) > self.maxsize):
+                    self._forget(next(iter(self.cache)))
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            keylock.release()
+
+    def _forget(self, key):
+        """Drop an entry, the lock must be held."""
+        self.cache.pop(key, None)
+        tag = self._keytags.pop(key, None)
+        keys = self.tags.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+    def invalidate(self, tag):
+        """Drop the entries of a tag."""
+        with self._lock:
+            for key in self.tags.pop(tag, ()):
+                self.cache.pop(key, None)
+                self._keytags.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self.cache.clear()
+            self.tags.clear()
+            self._keytags.clear()
+
+
+_MEMOIZERS = []
+
+
+def memoize(obj=None, maxsize=128, ttl=None, tag=None):
     """Memoize
 
-    Citation - https://wiki.python.org/moin/PythonDecoratorLibrary#Memoize
-    Description - Cache the returned object of a host function. If the  host
-    function gets called at different call sites with the same argument, do not
-    evaluate the body of the host function, just return the cached object.
+    Cache the returned object of a host function. If the host function gets
+    called with the same arguments again, do not evaluate its body, just
+    return the cached object. Safe to call from many threads, a key is only
+    computed once at a time and exceptions are not cached.
+
+    Use it as @memoize or @memoize(maxsize=16, ttl=60, tag=serial_of).
+
+    Args:
+        obj (callable, optional): Host function.
+        maxsize (int, optional): Least recently used entries beyond this
+            number are dropped, None for no bound.
+        ttl (float, optional): Seconds an entry is used, None for ever.
+        tag (callable, optional): Called with the arguments of the host
+            function, returns the device serial its entry belongs to, so
+            invalidate_device() can drop it.
     """
-    cache = obj.cache = {}
-
-    @functools.wraps(obj)
-    def memoizer(*args, **kwargs):
-        """Memoizer"""
-        key = str(args) + str(kwargs)
-        if key not in cache:
-            cache[key] = obj(*args, **kwargs)
-        return cache[key]
+    if obj is None:
+        return functools.partial(memoize, maxsize=maxsize, ttl=ttl, tag=tag)
+    memoizer = _Memoizer(obj, maxsize, ttl, tag)
+    _MEMOIZERS.append(memoizer)
     return memoizer
 
 
-@memoize
+def invalidate_device(serial):
+    """Drop every memoized object of a device, e.g. after a reboot.
+
+    Args:
+        serial (str): Serial number of the device.
+    """
+    for memoizer in _MEMOIZERS:
+        memoizer.invalidate(serial)
+
+
+def _devname_serial(*args, **kwargs):
+    """Tag of a memoized function whose last argument is a devname."""
+    devname = kwargs.get('devname', args[-1] if args else None)
+    return os.environ.get(devname) if devname else None
+
+
+@memoize(tag=_devname_serial)
 def get_dev(devname):
     """Get uiautomator device object."""
+    import uiautomator
     srl = os.environ.get(devname)
     log = logger('GETDEVICE')
     log.info('%s @ %s', devname, srl)
     is_dev_connected(srl)
     dev = uiautomator.Device(srl)
-    init_watchers(dev)
+    procs.on_cleanup(dev.server.stop, srl, 'uiautomator')
+    if not watcher.host():
+        init_watchers(dev)
     return dev
 
 
-@memoize
+@memoize(tag=_devname_serial)
 def get_adb(devname):
     """Get uiautomator adb object."""
+    import uiautomator
     srl = os.environ.get(devname)
     adb = uiautomator.Adb(srl)
     return adb
 
 
-@memoize
+@memoize(tag=_devname_serial)
 def tcget(tcname, devname):
     """Retrieve TC object."""
     dev = get_dev(devname)
@@ -122,105 +248,91 @@ def tcget(tcname, devname):
     return tcob(dev, adb, tcname, devname)
 
 
-def is_dev_connected(*args):
-    """Check if all devices are attached."""
-    proc = subprocess.Popen(
-        'adb devices'.split(),
-        stdout=subprocess.PIPE)
-    output = proc.communicate()
-    for arg in args:
-        if arg not in output[0]:
-            raise ValueError('Device NOT found.')
-
-
-def uiauto_cleanup():
-    """Stop UIAutomator & ADB server, and cleanup Python processes."""
-    try:
-        with open(os.devnull, 'w') as fnull:
-            cmd = 'adb kill-server'
-            proc = subprocess.Popen(cmd.split(), stdout=fnull, stderr=fnull)
-            proc.communicate()
-        crpid = str(os.getpid())
-        for proc in psutil.process_iter():
-            pinfo = proc.as_dict(attrs=['pid', 'name', 'cmdline'])
-            pname = str(pinfo['name'])
-            prcid = str(pinfo['pid'])
-            pcmdl = str(pinfo['cmdline'])
-            if ('python' in pname and
-                    prcid != crpid and
-                    'ami.py' not in pcmdl and
-                    'arsserver.py' not in pcmdl):
-                proc.kill()
-    except BaseException:
-        pass
-
-
-def init_watchers(dev):
-    """Initialize all the watchers."""
-
-    dev.watchers.remove()
-
-    dev.watcher('not_responding').when(
-        textMatches='(?i).*%s.*' % re.escape('responding')
-    ).click(textMatches='(?i).*%s.*' % re.escape('ok'))
+def _on_disconnect(serial, state):
+    """Drop the memoized objects of a device that went away."""
+    # pylint: disable=I0011,W0613
+    invalidate_device(serial)
 
-    dev.watcher('unfortunately').when(
-        textMatches='(?i).*%s.*' % re.escape('unfortunately')
-    ).click(textMatches='(?i).*%s.*' % re.escape('ok'))
 
-    dev.watcher('remind_me_later').when(
-        textMatches='(?i).*%s.*' % re.escape('remind me later')
-    ).click(textMatches='(?i).*%s.*' % re.escape('remind me later'))
+def device_tracker():
+    """Get the shared device tracker of the adb server.
 
-    dev.watcher('pkginstaller').when(
-        resourceIdMatches='(?i).*%s.*' % re.escape('permission_allow_button')
-    ).click(textMatches='(?i).*%s.*' % re.escape('allow'))
-
-    dev.watcher('radio').when(
-        textMatches='(?i).*%s.*' % re.escape('Plug in Earphone')
-    ).click(textMatches='(?i).*%s.*' % re.escape('Continue'))
-
-    dev.watcher('compass').when(
-        textMatches='(?i).*%s.*' % re.escape('Exit')
-    ).when(
-        resourceIdMatches='(?i).*%s.*' % re.escape('alertTitle')
-    ).click(text='Yes')
+    The memoized objects of a device are invalidated when it disconnects.
+    """
+    tracker = adbclient.tracker()
+    tracker.subscribe(on_disconnect=_on_disconnect)
+    return tracker
 
-    dev.watcher('internet_not_available').when(
-        textMatches='(?i).*%s.*' % re.escape('Internet not available via')
-    ).click(textMatches='(?i).*%s.*' % re.escape('Cancel'))
 
-    dev.watcher('smart_suite').when(
-        textMatches='(?i).*%s.*' % re.escape('Exit')
-    ).click(text='OK')
+def is_dev_connected(*args):
+    """Check if all devices are attached."""
+    tracker = device_tracker()
+    if tracker.ready.wait(TRACKER_TIMEOUT):
+        for arg in args:
+            if not tracker.is_connected(arg):
+                raise ValueError('Device NOT found.')
+        return
+    try:
+        output = [srl for srl, _ in adbclient.client().devices()]
+    except IOError:
+        proc = subprocess.Popen(
+            'adb devices'.split(),
+            stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+    for arg in args:
+        if arg not in output:
+            raise ValueError('Device NOT found.')
 
-    dev.watcher('retransmit').when(
-        textMatches='(?i).*%s.*' % re.escape('Re-transmit')
-    ).click(textMatches='(?i).*%s.*' % re.escape('OK'))
 
-    txt = 'Update apps automatically when on Wi-Fi?'
-    dev.watcher('storefront-update').when(
-        textMatches='(?i).*%s.*' % re.escape(txt)
-    ).click(textMatches='(?i).*%s.*' % re.escape('Not now'))
+def uiauto_cleanup(serials=None, restart_adb=False, timeout=5):
+    """Stop the uiautomator servers and the processes the harness spawned.
 
-    txt = 'Your message will be discarded'
-    dev.watcher('msg-discard').when(
-        textMatches='(?i).*%s.*' % re.escape(txt)
-    ).click(textMatches='(?i).*%s.*' % re.escape('OK'))
+    Only the processes registered in procs.py are stopped, in parallel,
+    with those an earlier run left behind when serials is None.
+    Like the cleanup itself, restarting adb is best effort and never raises.
 
-    txt = 'Due to Connectivity Issue'
-    dev.watcher('msg-connectivity-issue-direct-tv').when(
-        textMatches='(?i).*%s.*' % re.escape(txt)
-    ).click(textMatches='(?i).*%s.*' % re.escape('OK'))
+    Args:
+        serials (list, optional): Devices to clean up, all by default.
+        restart_adb (bool, optional): Also reconnect the devices to the adb
+            server, or restart the adb server when serials is None.
+        timeout (float, optional): Seconds before the processes are killed.
+    """
+    procs.cleanup(serials, timeout)
+    if not restart_adb:
+        return
+    if serials is None:
+        try:
+            adbclient.client().kill()
+        except IOError:
+            _adb_quiet('kill-server')
+        return
+    for serial in serials:
+        _adb_quiet('-s', serial, 'reconnect')
+
+
+def _adb_quiet(*args):
+    """Run an adb command, discarding its output and errors."""
+    with open(os.devnull, 'w') as fnull:
+        try:
+            proc = subprocess.Popen(('adb',) + args, stdout=fnull,
+                                    stderr=fnull)
+        except OSError:
+            return
+        proc.communicate()
 
-    dev.watcher('ad1').when(
-        textMatches='(?i).*%s.*' % re.escape('NO THANKS')
-    ).click(textMatches='(?i).*%s.*' % re.escape('NO THANKS'))
 
-    dev.watcher('storefront_skip').when(
-        textMatches='(?i).*%s.*' % re.escape('Complete account setup')
-    ).click(textMatches='(?i).*%s.*' % re.escape('SKIP'))
+def init_watchers(dev):
+    """Initialize the watchers of the watcher table on the device.
 
+    Args:
+        dev (uiautomator.Device): UIAutomator Device.
+    """
+    dev.watchers.remove()
+    for item in watcher.WATCHERS:
+        devwatcher = dev.watcher(item.name)
+        for selector in item.selectors():
+            devwatcher = devwatcher.when(**selector)
+        devwatcher.click(**item.click)
     dev.watchers.run()
 
 
@@ -237,19 +349,47 @@ def _gen_id_txt_watcher(dev, id1, txt1):
     dev.watcher(name).when(resourceId=id1).click(textMatches=txt1)
 
 
-def img_comp(bip, sip):
+def img_comp(bip, sip, debug=False):
     """
-    bip = Big image path.
-    sip = Small image path.
+    bip = Big image path or image array.
+    sip = Small image path or image array.
+    debug = Store the crops in the artifact store, named after bip or this
+            prefix.
     Guess where the small image sip is in the big image bip, crop the guessed
     location from the big image bip, and then compare the cropped image to the
     small image sip.
     """
     # pylint: disable=I0011,E1101
-    res = _img_comparison(bip, sip)
+    res = _img_comparison(bip, sip, debug)
     # log = logger('IMGCOMP')
     # log.info('Similarity level: {:.2f}%'.format(float(res) * 100.0))
-    return res > numpy.float64(0.976)
+    return res > IMG_THRESHOLD
+
+
+def img_decode(data, flags=None):
+    """Decode PNG/JPEG data held in memory into an image array.
+
+    Args:
+        data (str): Encoded image data.
+        flags (int, optional): cv2.imdecode flags, BGR color by default.
+    """
+    # pylint: disable=I0011,E1101
+    import cv2
+    import numpy
+    if flags is None:
+        flags = cv2.IMREAD_COLOR
+    return cv2.imdecode(numpy.frombuffer(data, numpy.uint8), flags)
+
+
+def img_gray(img):
+    """Get an image path or a BGR/grayscale array as a grayscale array."""
+    # pylint: disable=I0011,E1101
+    import cv2
+    if isinstance(img, basestring):
+        return cv2.imread(img, 0)
+    if img.ndim == 3:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return img
 
 
 def _img_search(bip, sip):
@@ -258,38 +398,43 @@ def _img_search(bip, sip):
     Citation: Adapted from code on http://stackoverflow.com/
     """
     # pylint: disable=I0011,E1101
-    shot = cv2.imread(bip, 0).copy()
-    imgfind = cv2.imread(sip, 0)
-    width, height = imgfind.shape[:: -1]
+    import cv2
+    shot = img_gray(bip)
+    imgfind = img_gray(sip)
+    height, width = imgfind.shape[:2]
     mtempl = cv2.matchTemplate(shot, imgfind, cv2.TM_CCOEFF_NORMED)
     _, _, _, tleft = cv2.minMaxLoc(mtempl)
-    bright = (tleft[0] + width, tleft[1] + height)
-    cropshot = shot[tleft[1]: bright[1], tleft[0]: bright[0]]
-    img1 = Image.fromarray(cropshot)
-    img2 = Image.fromarray(imgfind)
-    return (img1, img2)
+    cropshot = shot[tleft[1]: tleft[1] + height, tleft[0]: tleft[0] + width]
+    return (cropshot, imgfind)
+
+
+def img_similarity(img1, img2):
+    """Normalized dot product of two equally sized grayscale arrays."""
+    import numpy
+    vecta = img1.ravel().astype(numpy.float64)
+    vectb = img2.ravel().astype(numpy.float64)
+    a_norm = numpy.linalg.norm(vecta, 2)
+    b_norm = numpy.linalg.norm(vectb, 2)
+    return numpy.dot(vecta / a_norm, vectb / b_norm)
 
 
-def _img_comparison(bip, sip):
+def _img_comparison(bip, sip, debug=False):
     """Compare sip to bip.
 
     Citation: Code adapted from http://stackoverflow.com/
     """
-    # pylint: disable=I0011,E0632
+    # pylint: disable=I0011,E0632,E1101
     img1, img2 = _img_search(bip, sip)
-    img1.save(bip.split('.')[0] + '_img1_cropped.png', 'PNG')
-    img2.save(bip.split('.')[0] + '_img2_imgtofind.png', 'PNG')
-    vectors = []
-    norms = []
-    for image in [img1, img2]:
-        vector = []
-        for pixel_tuple in image.getdata():
-            vector.append(numpy.average(pixel_tuple))
-        vectors.append(vector)
-        norms.append(numpy.linalg.norm(vector, 2))
-    vecta, vectb = vectors
-    a_norm, b_norm = norms
-    return numpy.dot(vecta / a_norm, vectb / b_norm)
+    if debug is True and isinstance(bip, basestring):
+        debug = bip.split('.')[0]
+    if isinstance(debug, basestring):
+        import cv2
+        name = os.path.basename(debug)
+        for suffix, img in (('_img1_cropped.png', img1),
+                            ('_img2_imgtofind.png', img2)):
+            png = cv2.imencode('.png', img)[1].tostring()
+            store.store().put(png, '.png', 'crop', name + suffix)
+    return img_similarity(img1, img2)
 
 
 def genid(pkg, uiid):
@@ -0,0 +1,153 @@
+"""Watcher Module
+
+The dialog watchers are declared once in WATCHERS. The same table is used
+to register uiautomator watchers on the device, see util.init_watchers(),
+and by WatcherEngine, which handles the dialogs on the host from a UI
+hierarchy snapshot instead.
+
+uiautomator evaluates every device watcher on every selector miss. The
+engine only runs when Common takes a snapshot. The distinct texts and
+resource IDs of a snapshot are joined and lowercased once, and all trigger
+needles are searched in that one string, so a screen is checked for every
+dialog in a single pass.
+
+Set the MTBF_WATCHERS=host environment variable to use the engine instead
+of the device watchers. Dialogs are then dismissed by Common.snapshot(),
+Common.snapshot_wait() and Common.dismiss_dialogs() only, not while a
+uiautomator selector waits.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import re
+
+ATTRS = ('text', 'resourceId')
+
+
+class Watcher(object):
+    """One dialog watcher.
+
+    Attributes:
+        click (dict): Selector of the element clicked to dismiss the dialog.
+        name (str): Name of the watcher.
+        when (tuple): (attr, needle) conditions that must all be met. attr
+            is text or resourceId, needle is a case-insensitive substring.
+    """
+
+    __slots__ = ('name', 'when', 'click')
+
+    def __init__(self, name, when, click):
+        self.name = name
+        self.when = tuple(when)
+        self.click = click
+
+    def selectors(self):
+        """Get the uiautomator when() selectors of the conditions."""
+        return [{'%sMatches' % attr: '(?i).*%s.*' % re.escape(needle)}
+                for attr, needle in self.when]
+
+
+def host():
+    """Check if the dialogs are handled on the host, see MTBF_WATCHERS."""
+    return os.environ.get('MTBF_WATCHERS') == 'host'
+
+
+def _contains(needle):
+    """Selector of a case-insensitive text substring."""
+    return {'textMatches': '(?i).*%s.*' % re.escape(needle)}
+
+
+WATCHERS = (
+    Watcher('not_responding', [('text', 'responding')], _contains('ok')),
+    Watcher('unfortunately', [('text', 'unfortunately')], _contains('ok')),
+    Watcher('remind_me_later', [('text', 'remind me later')],
+            _contains('remind me later')),
+    Watcher('pkginstaller', [('resourceId', 'permission_allow_button')],
+            _contains('allow')),
+    Watcher('radio', [('text', 'Plug in Earphone')], _contains('Continue')),
+    Watcher('compass', [('text', 'Exit'), ('resourceId', 'alertTitle')],
+            {'text': 'Yes'}),
+    Watcher('internet_not_available',
+            [('text', 'Internet not available via')], _contains('Cancel')),
+    Watcher('smart_suite', [('text', 'Exit')], {'text': 'OK'}),
+    Watcher('retransmit', [('text', 'Re-transmit')], _contains('OK')),
+    Watcher('storefront-update',
+            [('text', 'Update apps automatically when on Wi-Fi?')],
+            _contains('Not now')),
+    Watcher('msg-discard', [('text', 'Your message will be discarded')],
+            _contains('OK')),
+    Watcher('msg-connectivity-issue-direct-tv',
+            [('text', 'Due to Connectivity Issue')], _contains('OK')),
+    Watcher('ad1', [('text', 'NO THANKS')], _contains('NO THANKS')),
+    Watcher('storefront_skip', [('text', 'Complete account setup')],
+            _contains('SKIP')),
+)
+
+
+class WatcherEngine(object):
+    """Host-side handler of the dialogs.
+
+    Attributes:
+        hits (dict): Watcher name to the number of dialogs it dismissed.
+        watchers (list): Watchers, in table order.
+    """
+
+    def __init__(self, watchers=WATCHERS):
+        """Summary
+
+        Args:
+            watchers (tuple, optional): Watcher table.
+        """
+        self.watchers = list(watchers)
+        self.hits = {}
+        self._needles = dict((attr, set()) for attr in ATTRS)
+        for item in self.watchers:
+            for attr, needle in item.when:
+                self._needles[attr].add(needle.lower())
+
+    def _seen(self, snap):
+        """Get the (attr, needle) conditions met by a snapshot."""
+        seen = set()
+        for attr, needles in self._needles.iteritems():
+            if not needles:
+                continue
+            joined = '\n'.join(snap.values(attr)).lower()
+            for needle in needles:
+                if needle in joined:
+                    seen.add((attr, needle))
+        return seen
+
+    def triggered(self, snap):
+        """Get the watchers whose conditions are all met by a snapshot.
+
+        Args:
+            snap (hierarchy.Hierarchy): UI hierarchy snapshot.
+        """
+        seen = self._seen(snap)
+        if not seen:
+            return []
+        return [item for item in self.watchers
+                if all((attr, needle.lower()) in seen
+                       for attr, needle in item.when)]
+
+    def handle(self, dev, snap):
+        """Dismiss every dialog shown in a snapshot in a single pass.
+
+        Args:
+            dev (uiautomator.Device): UIAutomator Device.
+            snap (hierarchy.Hierarchy): UI hierarchy snapshot.
+
+        Returns:
+            names (list): Names of the watchers that clicked.
+        """
+        names = []
+        for item in self.triggered(snap):
+            node = snap.first(**item.click)
+            if node is None:
+                continue
+            dev.click(*node.center)
+            self.hits[item.name] = self.hits.get(item.name, 0) + 1
+            names.append(item.name)
+        return names
@@ -1,15 +1,70 @@
-"""Utility module."""
+"""Utility module.
+
+YAML files are parsed with the LibYAML loader when it is available. The
+parsed content of the last MAX_CACHED files is kept pickled in memory, keyed
+by path, mtime and size like the ini files of cfg.py, so an unchanged plan
+file is neither read nor parsed again, and every caller gets its own copy.
+"""
 
 from __future__ import absolute_import
 from __future__ import division
 
-import os, sys
+import collections
+import cPickle
+import os
+import threading
+
 import yaml
 
+try:
+    _LOADER = yaml.CLoader
+except AttributeError:
+    _LOADER = yaml.Loader
+
+MAX_CACHED = 32
+
+_COMPILED = collections.OrderedDict()
+_LOCK = threading.Lock()
+
+
+def load(path):
+    """Load a YAML file through the compiled cache.
+
+    Args:
+        path (str): Path to the YAML file.
+
+    Returns:
+        A fresh copy of the parsed content.
+    """
+    path = os.path.abspath(path)
+    fstat = os.stat(path)
+    key = (path, fstat.st_mtime, fstat.st_size)
+    with _LOCK:
+        blob = _COMPILED.pop(key, None)
+        if blob is not None:
+            _COMPILED[key] = blob
+    if blob is None:
+        with open(path, 'rb') as stream:
+            data = yaml.load(stream, Loader=_LOADER)
+        try:
+            blob = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            return data
+        with _LOCK:
+            for old in [k for k in _COMPILED if k[0] == path]:
+                del _COMPILED[old]
+            _COMPILED[key] = blob
+            while len(_COMPILED) > MAX_CACHED:
+                _COMPILED.popitem(last=False)
+    return cPickle.loads(blob)
+
+
 class YML(object):
+    """YAML file content with nested key access."""
+
     def __init__(self, file):
-        self._file=open(file)
-        self._yml=yaml.load(self._file)
+        self._path = file
+        self._yml = load(file)
 
     def get(self, *args):
         ret = self._yml
@@ -0,0 +1,247 @@
+"""Tests of the adb host protocol client against a local fake adb server.
+
+Run from the repository root with:
+    python -m unittest discover tests
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import socket
+import SocketServer
+import threading
+import time
+import unittest
+
+from lib.base import adbclient
+
+
+def _msg(text):
+    """Length-prefix a message like the adb server does."""
+    return '%04x%s' % (len(text), text)
+
+
+def _devices(devices):
+    """Format a host:devices payload."""
+    return ''.join('%s\t%s\n' % pair for pair in devices)
+
+
+class FakeAdbHandler(SocketServer.BaseRequestHandler):
+    """One connection to the fake adb server."""
+
+    def _read(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def handle(self):
+        server = self.server
+        try:
+            while True:
+                req = self._read(int(self._read(4), 16))
+                server.requests.append(req)
+                if not self._answer(server, req):
+                    return
+        except (EOFError, socket.error):
+            pass
+
+    def _answer(self, server, req):
+        """Answer a request, False once the connection is done."""
+        sock = self.request
+        if req == 'host:version':
+            sock.sendall('OKAY' + _msg('0029'))
+        elif req == 'host:devices':
+            sock.sendall('OKAY' + _msg(_devices(server.devices)))
+        elif req.startswith('host:transport:'):
+            if req.split(':', 2)[2] not in dict(server.devices):
+                sock.sendall('FAIL' + _msg('device not found'))
+                return False
+            sock.sendall('OKAY')
+            return True
+        elif req == 'host:track-devices':
+            sock.sendall('OKAY')
+            sent = None
+            while not server.stopped.is_set():
+                with server.changed:
+                    if sent == server.devices:
+                        server.changed.wait(.1)
+                    current = list(server.devices)
+                if current != sent:
+                    sock.sendall(_msg(_devices(current)))
+                    sent = current
+        elif req.startswith('shell:') or req.startswith('exec:'):
+            cmd = req.split(':', 1)[1]
+            if cmd == 'hang':
+                server.stopped.wait(5)
+                return False
+            sock.sendall('OKAY' + server.outputs.get(cmd, ''))
+        else:
+            sock.sendall('FAIL' + _msg('unknown request %s' % req))
+        return False
+
+
+class FakeAdbServer(SocketServer.ThreadingTCPServer):
+    """Fake adb server speaking the smart socket protocol.
+
+    Attributes:
+        devices (list): (serial, state) pairs it reports.
+        outputs (dict): Shell or exec command to its output.
+        requests (list): Every request received.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 FakeAdbHandler)
+        self.devices = [('FAKE0001', 'device')]
+        self.outputs = {}
+        self.requests = []
+        self.changed = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={'poll_interval': .05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        """Port the fake server listens on."""
+        return self.server_address[1]
+
+    def set_devices(self, devices):
+        """Report a new device list to the trackers."""
+        with self.changed:
+            self.devices = list(devices)
+            self.changed.notify_all()
+
+    def stop(self):
+        """Shut the server and its connections down."""
+        self.stopped.set()
+        self.shutdown()
+        self.server_close()
+
+
+class AdbClientTest(unittest.TestCase):
+    """AdbClient requests."""
+
+    def setUp(self):
+        self.server = FakeAdbServer()
+        self.client = adbclient.AdbClient('127.0.0.1', self.server.port,
+                                          timeout=1)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_version(self):
+        self.assertEqual(self.client.version(), 0x29)
+
+    def test_devices(self):
+        self.server.devices = [('A1', 'device'), ('B2', 'offline')]
+        self.assertEqual(self.client.devices(),
+                         [('A1', 'device'), ('B2', 'offline')])
+
+    def test_shell(self):
+        self.server.outputs['getprop ro.serialno'] = 'FAKE0001\r\n'
+        out = self.client.shell('FAKE0001', 'getprop ro.serialno')
+        self.assertEqual(out, 'FAKE0001\n')
+        self.assertEqual(self.server.requests,
+                         ['host:transport:FAKE0001',
+                          'shell:getprop ro.serialno'])
+
+    def test_exec_out_is_raw(self):
+        png = '\x89PNG\r\n\x1a\n' + ''.join(chr(i) for i in xrange(256))
+        self.server.outputs['screencap -p'] = png
+        self.assertEqual(self.client.exec_out('FAKE0001', 'screencap -p'),
+                         png)
+
+    def test_fail_reply(self):
+        with self.assertRaises(IOError) as ctx:
+            self.client.shell('GONE', 'true')
+        self.assertIn('device not found', str(ctx.exception))
+
+    def test_timeout(self):
+        self.client.timeout = .3
+        start = time.time()
+        self.assertRaises(socket.timeout, self.client.shell, 'FAKE0001',
+                          'hang')
+        self.assertLess(time.time() - start, 2)
+
+    def test_shell_async(self):
+        self.server.outputs['echo a'] = 'a\n'
+        results = [self.client.shell_async('FAKE0001', 'echo a')
+                   for _ in xrange(4)]
+        self.assertEqual([res.get(5) for res in results], ['a\n'] * 4)
+
+
+class ParseDevicesTest(unittest.TestCase):
+    """parse_devices()."""
+
+    def test_parse(self):
+        payload = 'A1\tdevice\nB2\toffline\n\nbroken line\nC3\tunauthorized'
+        self.assertEqual(adbclient.parse_devices(payload),
+                         [('A1', 'device'), ('B2', 'offline'),
+                          ('C3', 'unauthorized')])
+
+    def test_empty(self):
+        self.assertEqual(adbclient.parse_devices(''), [])
+
+
+class DeviceTrackerTest(unittest.TestCase):
+    """DeviceTracker following host:track-devices."""
+
+    def setUp(self):
+        self.server = FakeAdbServer()
+        client = adbclient.AdbClient('127.0.0.1', self.server.port,
+                                     timeout=1)
+        self.tracker = adbclient.DeviceTracker(client, retry=.1)
+        self.events = []
+        self.seen = threading.Event()
+
+        def _connect(serial, state):
+            self.events.append(('connect', serial, state))
+            self.seen.set()
+
+        def _disconnect(serial, state):
+            self.events.append(('disconnect', serial, state))
+            self.seen.set()
+
+        self.tracker.subscribe(_connect, _disconnect)
+        self.tracker.start()
+        self.assertTrue(self.seen.wait(5))
+        self.seen.clear()
+
+    def tearDown(self):
+        self.tracker.stop()
+        self.server.stop()
+
+    def test_initial_list(self):
+        self.assertTrue(self.tracker.ready.is_set())
+        self.assertTrue(self.tracker.is_connected('FAKE0001'))
+        self.assertEqual(self.events, [('connect', 'FAKE0001', 'device')])
+
+    def test_offline(self):
+        self.server.set_devices([('FAKE0001', 'offline')])
+        self.assertTrue(self.seen.wait(5))
+        self.assertEqual(self.events[-1],
+                         ('disconnect', 'FAKE0001', 'offline'))
+        self.assertFalse(self.tracker.is_connected('FAKE0001'))
+        self.seen.clear()
+        self.server.set_devices([('FAKE0001', 'device')])
+        self.assertTrue(self.seen.wait(5))
+        self.assertEqual(self.events[-1], ('connect', 'FAKE0001', 'device'))
+
+    def test_gone(self):
+        self.server.set_devices([])
+        self.assertTrue(self.seen.wait(5))
+        self.assertEqual(self.events[-1], ('disconnect', 'FAKE0001', None))
+        self.assertEqual(self.tracker.state('FAKE0001'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
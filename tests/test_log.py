@@ -0,0 +1,72 @@
+"""Tests of the queued log writer.
+
+Run from the repository root with:
+    python -m unittest discover tests
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import logging
+import threading
+import unittest
+
+from lib.base import log
+
+
+class ListHandler(logging.Handler):
+    """Handler that keeps the messages, and can be held up by an event."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def emit(self, record):
+        self.entered.set()
+        self.gate.wait(5)
+        self.messages.append(record.getMessage())
+
+
+class LogWriterTest(unittest.TestCase):
+    """LogWriter and QueueHandler."""
+
+    def setUp(self):
+        self.handler = ListHandler()
+        self.writer = log.LogWriter([self.handler], maxsize=3)
+        self.log = logging.getLogger('test_log.%s' % self.id())
+        self.log.propagate = False
+        self.log.setLevel(logging.DEBUG)
+        self.log.addHandler(log.QueueHandler(self.writer))
+
+    def tearDown(self):
+        self.handler.gate.set()
+        for handler in list(self.log.handlers):
+            self.log.removeHandler(handler)
+
+    def test_stop_writes_queued_records(self):
+        for index in xrange(3):
+            self.log.info('record %d', index)
+        self.writer.stop()
+        self.assertEqual(self.handler.messages,
+                         ['record 0', 'record 1', 'record 2'])
+
+    def test_full_queue_drops_and_reports(self):
+        self.handler.gate.clear()
+        self.log.info('first')
+        self.assertTrue(self.handler.entered.wait(5))
+        for index in xrange(10):
+            self.log.info('record %d', index)
+        self.assertEqual(self.writer.dropped, 7)
+        self.handler.gate.set()
+        self.writer.stop()
+        self.assertEqual(self.handler.messages,
+                         ['first',
+                          '7 log records dropped, the queue was full.',
+                          'record 0', 'record 1', 'record 2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+"""Tests of the memoize decorator.
+
+Run from the repository root with:
+    python -m unittest discover tests
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import threading
+import time
+import unittest
+
+from lib.base import util
+
+
+def counter(calls, delay=0):
+    """Host function that records its calls and returns their number."""
+    lock = threading.Lock()
+
+    def _count(*args):
+        with lock:
+            calls.append(args)
+            ncalls = len(calls)
+        time.sleep(delay)
+        return ncalls
+
+    return _count
+
+
+class MemoizeTest(unittest.TestCase):
+    """memoize() caching, expiry and invalidation."""
+
+    def setUp(self):
+        self.calls = []
+        self._nmemoizers = len(util._MEMOIZERS)
+
+    def tearDown(self):
+        del util._MEMOIZERS[self._nmemoizers:]
+
+    def test_cached(self):
+        func = util.memoize(counter(self.calls))
+        self.assertEqual([func(1), func(1), func(2)], [1, 1, 2])
+
+    def test_ttl_expiry(self):
+        func = util.memoize(ttl=.05)(counter(self.calls))
+        self.assertEqual(func('a'), 1)
+        self.assertEqual(func('a'), 1)
+        time.sleep(.1)
+        self.assertEqual(func('a'), 2)
+
+    def test_lru_eviction(self):
+        func = util.memoize(maxsize=2)(counter(self.calls))
+        func('a')
+        func('b')
+        func('a')
+        func('c')
+        self.assertEqual(list(func.cache),
+                         [(('a',), frozenset()), (('c',), frozenset())])
+        func('a')
+        func('b')
+        self.assertEqual(self.calls, [('a',), ('b',), ('c',), ('b',)])
+
+    def test_invalidate_device(self):
+        func = util.memoize(tag=lambda *args: args[0])(counter(self.calls))
+        func('S1', 'x')
+        func('S1', 'y')
+        func('S2', 'x')
+        util.invalidate_device('S1')
+        self.assertEqual(sorted(func.tags), ['S2'])
+        func('S1', 'x')
+        func('S2', 'x')
+        self.assertEqual(len(self.calls), 4)
+
+    def test_eviction_drops_tag(self):
+        func = util.memoize(maxsize=1, tag=lambda *args: args[0])(
+            counter(self.calls))
+        func('S1')
+        func('S2')
+        self.assertEqual(func.tags, {'S2': set([(('S2',), frozenset())])})
+
+    def test_unhashable_arguments(self):
+        func = util.memoize(counter(self.calls))
+        func([1])
+        func([1])
+        self.assertEqual(len(self.calls), 2)
+
+    def test_concurrent_calls_compute_once(self):
+        func = util.memoize(counter(self.calls, delay=.1))
+        results = []
+
+        def _call():
+            results.append(func('key'))
+
+        threads = [threading.Thread(target=_call) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, [('key',)])
+        self.assertEqual(results, [1] * 8)
+
+    def test_exceptions_not_cached(self):
+        calls = []
+
+        def _fail():
+            calls.append(None)
+            raise IOError('flaky')
+
+        func = util.memoize(_fail)
+        self.assertRaises(IOError, func)
+        self.assertRaises(IOError, func)
+        self.assertEqual(len(calls), 2)
+
+    def test_method(self):
+
+        class Host(object):
+            """Object with a memoized method."""
+
+            def __init__(self, name):
+                self.name = name
+                self.calls = 0
+
+            @util.memoize
+            def greet(self, other):
+                """Count the calls."""
+                self.calls += 1
+                return '%s greets %s' % (self.name, other)
+
+        first, second = Host('a'), Host('b')
+        self.assertEqual(first.greet('x'), 'a greets x')
+        self.assertEqual(first.greet('x'), 'a greets x')
+        self.assertEqual(second.greet('x'), 'b greets x')
+        self.assertEqual((first.calls, second.calls), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""Tests of the process registry.
+
+Run from the repository root with:
+    python -m unittest discover tests
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from lib.base import procs
+
+
+class CleanupTest(unittest.TestCase):
+    """cleanup() of registered processes, hooks and strays."""
+
+    def setUp(self):
+        self.logpath = tempfile.mkdtemp(prefix='mtbf-procs-')
+        self._logpath = os.environ.get('LOG_PATH')
+        os.environ['LOG_PATH'] = self.logpath
+        self.spawned = []
+
+    def tearDown(self):
+        for proc in self.spawned:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        if self._logpath is None:
+            del os.environ['LOG_PATH']
+        else:
+            os.environ['LOG_PATH'] = self._logpath
+        shutil.rmtree(self.logpath, ignore_errors=True)
+
+    def _sleep(self):
+        """Spawn a process that runs until it is stopped."""
+        proc = subprocess.Popen(['sleep', '30'])
+        self.spawned.append(proc)
+        return proc
+
+    def _pids(self):
+        """Pids listed in the pidfile."""
+        with open(os.path.join(self.logpath, procs.PIDFILE)) as stream:
+            return [int(line.split()[0]) for line in stream]
+
+    def test_registered(self):
+        proc = self._sleep()
+        procs.register(proc, 'S1')
+        self.assertEqual(procs.registered('S1'), [proc])
+        self.assertIn(proc.pid, self._pids())
+        self.assertEqual(procs.cleanup(['S1'], timeout=2), 0)
+        self.assertIsNotNone(proc.poll())
+        self.assertEqual(procs.registered('S1'), [])
+
+    def test_hooks_run_once(self):
+        calls = []
+        procs.on_cleanup(lambda: calls.append('old'), 'S1', 'server')
+        procs.on_cleanup(lambda: calls.append('new'), 'S1', 'server')
+        procs.cleanup(['S1'])
+        procs.cleanup(['S1'])
+        self.assertEqual(calls, ['new'])
+
+    def test_strays_of_earlier_runs(self):
+        stray = self._sleep()
+        with open(os.path.join(self.logpath, procs.PIDFILE), 'w') as stream:
+            stream.write('%d %s\n' % (stray.pid, procs._starttime(stray.pid)))
+            stream.write('%d 1\n' % self._sleep().pid)
+        procs.cleanup(timeout=2)
+        self.assertIsNotNone(stray.poll())
+        self.assertEqual([proc.poll() for proc in self.spawned[1:]], [None])
+        self.assertEqual(self._pids(), [os.getpid()])
+
+    def test_cleanup_of_serials_keeps_strays(self):
+        stray = self._sleep()
+        with open(os.path.join(self.logpath, procs.PIDFILE), 'w') as stream:
+            stream.write('%d %s\n' % (stray.pid, procs._starttime(stray.pid)))
+        procs.cleanup(['S1'])
+        self.assertIsNone(stray.poll())
+
+
+if __name__ == '__main__':
+    unittest.main()
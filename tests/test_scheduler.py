@@ -0,0 +1,185 @@
+"""Tests of the plan scheduler on device workers without devices.
+
+Run from the repository root with:
+    python -m unittest discover tests
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import threading
+import time
+import unittest
+
+from lib.base import runner
+from lib.base import scheduler
+from lib.base import util
+
+PLAN = {
+    'Messaging': {'sms': 3, 'mms': 2},
+    'Browser': {'open': 4},
+    'Telephony': {'call': 0},
+}
+
+
+class FakeTracker(object):
+    """Device tracker that never reports a change."""
+
+    def subscribe(self, on_connect=None, on_disconnect=None):
+        """Ignore the callbacks."""
+        pass
+
+    def unsubscribe(self, on_connect=None, on_disconnect=None):
+        """Ignore the callbacks."""
+        pass
+
+
+class ExpandTest(unittest.TestCase):
+    """expand()."""
+
+    def test_sorted_iterations(self):
+        self.assertEqual(scheduler.expand(PLAN),
+                         [('Browser', 'open')] * 4 +
+                         [('Messaging', 'mms')] * 2 +
+                         [('Messaging', 'sms')] * 3)
+
+    def test_sections(self):
+        self.assertEqual(scheduler.expand(PLAN, ['Messaging']),
+                         [('Messaging', 'mms')] * 2 +
+                         [('Messaging', 'sms')] * 3)
+
+    def test_string_counts_and_empty_sections(self):
+        plan = {'A': {'u': '2'}, 'B': None}
+        self.assertEqual(scheduler.expand(plan), [('A', 'u')] * 2)
+
+
+class SchedulerTest(unittest.TestCase):
+    """Scheduler with two device workers."""
+
+    def setUp(self):
+        self._tracker = util.device_tracker
+        util.device_tracker = FakeTracker
+        self.runner = runner.Runner(['MDEVICE', 'SDEVICE'])
+
+    def tearDown(self):
+        self.runner.stop()
+        util.device_tracker = self._tracker
+
+    def _offline(self, devname):
+        """Mark a device disconnected, as the tracker would."""
+        self.runner._workers[devname].online.clear()
+
+    def test_no_device(self):
+        with runner.Runner([]) as empty:
+            self.assertRaises(ValueError, scheduler.Scheduler, PLAN, empty)
+
+    def test_split(self):
+        sched = scheduler.Scheduler(PLAN, self.runner)
+        units = scheduler.expand(PLAN)
+        self.assertEqual(list(sched._shares['MDEVICE']), units[:5])
+        self.assertEqual(list(sched._shares['SDEVICE']), units[5:])
+
+    def test_run(self):
+        sched = scheduler.Scheduler(PLAN, self.runner)
+        totals = sched.run(lambda devname, section, unit: unit != 'mms')
+        self.assertEqual(totals, {'Browser': (4, 0), 'Messaging': (3, 2)})
+        self.assertEqual(sched.pending(), 0)
+
+    def test_steal(self):
+        seen = {'MDEVICE': [], 'SDEVICE': []}
+
+        def _execute(devname, section, unit):
+            if devname == 'MDEVICE':
+                time.sleep(.05)
+            seen[devname].append((section, unit))
+            return True
+
+        sched = scheduler.Scheduler(PLAN, self.runner)
+        totals = sched.run(_execute)
+        self.assertEqual(totals, {'Browser': (4, 0), 'Messaging': (5, 0)})
+        self.assertGreater(sched.stolen, 0)
+        self.assertGreater(len(seen['SDEVICE']), 4)
+
+    def test_offline_device_requeues(self):
+        seen = []
+
+        def _execute(devname, section, unit):
+            if devname == 'SDEVICE':
+                self._offline(devname)
+                raise IOError('device gone')
+            seen.append((section, unit))
+            return True
+
+        sched = scheduler.Scheduler(PLAN, self.runner)
+        totals = sched.run(_execute)
+        self.assertEqual(totals, {'Browser': (4, 0), 'Messaging': (5, 0)})
+        self.assertEqual(len(seen), 9)
+
+    def test_transient_error_counts_as_failed(self):
+        errors = []
+
+        def _execute(devname, section, unit):
+            time.sleep(.01)
+            if devname == 'SDEVICE' and not errors:
+                errors.append(unit)
+                raise IOError('transient')
+            return True
+
+        sched = scheduler.Scheduler(PLAN, self.runner)
+        totals = sched.run(_execute)
+        self.assertEqual(sum(npass for npass, _ in totals.values()), 8)
+        self.assertEqual(sum(nfail for _, nfail in totals.values()), 1)
+        devices = set(key[0] for key, _ in sched.results.items())
+        self.assertEqual(devices, set(['MDEVICE', 'SDEVICE']))
+
+    def test_leftovers_run_after_the_others_finished(self):
+        mdone = threading.Event()
+        mruns = []
+
+        def _execute(devname, section, unit):
+            if devname == 'SDEVICE':
+                mdone.wait(5)
+                time.sleep(.1)
+                self._offline(devname)
+                raise IOError('device gone')
+            mruns.append(unit)
+            if len(mruns) == 3:
+                mdone.set()
+            return True
+
+        sched = scheduler.Scheduler({'A': {'u': 4}}, self.runner)
+        totals = sched.run(_execute)
+        self.assertEqual(totals, {'A': (4, 0)})
+        self.assertEqual(len(mruns), 4)
+        self.assertEqual(sched.pending(), 0)
+
+    def test_offline_device_never_steals(self):
+        self._offline('SDEVICE')
+        seen = set()
+
+        def _execute(devname, section, unit):
+            seen.add(devname)
+            return True
+
+        sched = scheduler.Scheduler(PLAN, self.runner)
+        totals = sched.run(_execute)
+        self.assertEqual(totals, {'Browser': (4, 0), 'Messaging': (5, 0)})
+        self.assertEqual(seen, set(['MDEVICE']))
+
+    def test_all_offline_leaves_pending(self):
+        self._offline('MDEVICE')
+        self._offline('SDEVICE')
+        sched = scheduler.Scheduler(PLAN, self.runner)
+        self.assertEqual(sched.run(lambda *args: True), {})
+        self.assertEqual(sched.pending(), 9)
+
+    def test_totals_per_run(self):
+        first = scheduler.Scheduler(PLAN, self.runner)
+        first.run(lambda *args: True)
+        second = scheduler.Scheduler(PLAN, self.runner)
+        totals = second.run(lambda *args: True)
+        self.assertEqual(totals, {'Browser': (4, 0), 'Messaging': (5, 0)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""Tests of the persistent shell session against a local sh.
+
+The PTY cases run the shell under script(1), like the `adb shell` of older
+adbd, which echoes its input and prints prompts.
+
+Run from the repository root with:
+    python -m unittest discover tests
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from lib.base import shell
+
+FAKE_ADB = """#!/bin/sh
+while [ $# -gt 0 ] && [ "$1" != shell ]; do
+    shift
+done
+%s
+"""
+PIPE_SH = 'exec sh'
+PTY_SH = 'exec script -qfc sh /dev/null'
+
+
+class FakeAdb(object):
+    """uiautomator.Adb running a local shell instead of the device's."""
+
+    adbHostPortOptions = []
+
+    def __init__(self, path):
+        self.path = path
+
+    def adb(self):
+        """Path to the fake adb executable."""
+        return self.path
+
+    def device_serial(self):
+        """Serial number of the fake device."""
+        return 'FAKE0001'
+
+
+class ShellSessionTest(unittest.TestCase):
+    """ShellSession over a plain pipe."""
+
+    launcher = PIPE_SH
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='mtbf-shell-')
+        self._logpath = os.environ.get('LOG_PATH')
+        os.environ['LOG_PATH'] = self.workdir
+        path = os.path.join(self.workdir, 'adb')
+        with open(path, 'w') as stream:
+            stream.write(FAKE_ADB % self.launcher)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        self.session = shell.ShellSession(FakeAdb(path), timeout=10)
+
+    def tearDown(self):
+        self.session.close()
+        if self._logpath is None:
+            del os.environ['LOG_PATH']
+        else:
+            os.environ['LOG_PATH'] = self._logpath
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_output(self):
+        self.assertEqual(self.session.run('echo hello'), 'hello')
+        self.assertEqual(self.session.run('echo a; echo b'), 'a\nb')
+        self.assertEqual(self.session.run('true'), '')
+
+    def test_replies_stay_in_order(self):
+        for index in xrange(20):
+            self.assertEqual(self.session.run('echo %d' % index), str(index))
+
+    def test_output_without_newline(self):
+        self.assertEqual(self.session.run('printf partial'), 'partial')
+        self.assertEqual(self.session.run('echo next'), 'next')
+
+    def test_sentinel_text_in_command(self):
+        cmd = 'echo __MTBF_0__; echo done'
+        self.assertEqual(self.session.run(cmd), '__MTBF_0__\ndone')
+
+    def test_timeout_is_not_retried(self):
+        marker = os.path.join(self.workdir, 'runs')
+        cmd = 'echo run >> %s; sleep 5' % marker
+        self.assertRaises(shell.ShellTimeout, self.session.run, cmd, .5)
+        self.assertFalse(self.session.is_alive())
+        with open(marker) as stream:
+            self.assertEqual(stream.read(), 'run\n')
+        self.assertEqual(self.session.run('echo after'), 'after')
+
+    def test_reopen_after_drop(self):
+        self.assertEqual(self.session.run('echo before'), 'before')
+        self.session._proc.kill()
+        self.session._proc.wait()
+        self.assertEqual(self.session.run('echo after'), 'after')
+
+
+class PtyShellSessionTest(ShellSessionTest):
+    """ShellSession over a PTY that echoes its input."""
+
+    launcher = PTY_SH
+
+
+if __name__ == '__main__':
+    unittest.main()
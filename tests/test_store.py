@@ -0,0 +1,116 @@
+"""Tests of the content-addressed artifact store.
+
+Run from the repository root with:
+    python -m unittest discover tests
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from lib.base import store
+
+
+class StoreTest(unittest.TestCase):
+    """Store puts, index and retention."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='mtbf-store-')
+        self.store = store.Store(self.root)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _blobs(self):
+        """Paths of every blob on disk."""
+        paths = []
+        for dirpath, _, filenames in os.walk(os.path.join(self.root,
+                                                          'blobs')):
+            paths.extend(os.path.join(dirpath, name) for name in filenames)
+        return paths
+
+    def test_dedupe(self):
+        paths = set(self.store.put('same', '.png', 'tempdump', 'a%d.png' % i)
+                    for i in xrange(5))
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(len(self._blobs()), 1)
+        self.assertEqual(len(self.store.entries()), 5)
+
+    def test_gzip(self):
+        path = self.store.put('<hierarchy/>', '.xml.gz', 'screendump', 'a')
+        with gzip.open(path) as stream:
+            self.assertEqual(stream.read(), '<hierarchy/>')
+
+    def test_entries_filter(self):
+        self.store.put('one', '.png', 'tempdump', 'a', 'Messaging', 'MDEVICE')
+        self.store.put('two', '.png', 'crop', 'b', 'Browser', 'SDEVICE')
+        entries = self.store.entries(tcname='Browser')
+        self.assertEqual([entry[4] for entry in entries], ['b'])
+        self.assertEqual(self.store.entries(kind='crop')[0][1], 'Browser')
+
+    def test_prune_age(self):
+        old = self.store.put('old', '.png', 'tempdump', 'old')
+        new = self.store.put('new', '.png', 'tempdump', 'new')
+        self.store._db.execute('UPDATE entries SET time = ? WHERE name = ?',
+                               (time.time() - 100, 'old'))
+        self.assertEqual(self.store.prune(max_age=50), 1)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+        self.assertEqual([entry[4] for entry in self.store.entries()],
+                         ['new'])
+
+    def test_prune_keeps_referenced_blobs(self):
+        shared = self.store.put('shared', '.png', 'tempdump', 'first')
+        self.store.put('shared', '.png', 'tempdump', 'second')
+        self.store._db.execute('UPDATE entries SET time = ? WHERE name = ?',
+                               (time.time() - 100, 'first'))
+        self.assertEqual(self.store.prune(max_age=50), 0)
+        self.assertTrue(os.path.exists(shared))
+
+    def test_prune_size_drops_least_recently_used(self):
+        paths = []
+        for index in xrange(4):
+            paths.append(self.store.put(str(index) * 100, '.png', 'tempdump',
+                                        'n%d' % index))
+            digest = os.path.basename(paths[-1]).split('.')[0]
+            self.store._db.execute('UPDATE blobs SET used = ? '
+                                   'WHERE digest = ?', (index, digest))
+        self.assertEqual(self.store.prune(max_bytes=250), 2)
+        self.assertEqual([os.path.exists(path) for path in paths],
+                         [False, False, True, True])
+        self.assertEqual(len(self._blobs()), 2)
+
+    def test_put_after_prune_writes_again(self):
+        path = self.store.put('again', '.png', 'tempdump', 'a')
+        self.store.prune(max_age=-1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.store.put('again', '.png', 'tempdump', 'b'),
+                         path)
+        self.assertTrue(os.path.exists(path))
+
+    def test_rename_onto_existing_blob(self):
+        path = self.store.put('race', '.png', 'tempdump', 'a')
+        rename = os.rename
+
+        def _windows_rename(src, dst):
+            if os.path.exists(dst):
+                raise OSError(17, 'File exists')
+            rename(src, dst)
+
+        os.rename = _windows_rename
+        try:
+            self.assertEqual(self.store._write(path, 'race', False), 4)
+        finally:
+            os.rename = rename
+        self.assertEqual(self._blobs(), [path])
+
+
+if __name__ == '__main__':
+    unittest.main()